@@ -0,0 +1,221 @@
+"""
+Time-bucketed aggregation of numeric payload fields (/api/aggregate).
+
+A request is answered from the cheapest source that can serve it:
+
+1. the rollup tables, when the bucket width is a multiple of a rollup
+   resolution, every function is one the rollups keep and they are
+   complete for the window ('rollup_1m', 'rollup_1h' or 'rollup_1d');
+2. a JSON1 GROUP BY over the telemetry partitions ('sql');
+3. vectorized NumPy over the field's values, for the functions SQL lacks
+   (stddev, median, percentiles) ('numpy').
+
+Buckets start at multiples of the bucket width since the epoch (UTC), and
+the window is widened to whole buckets. Rollups keep rows that were deleted
+after they were rolled up, so counts can differ between sources once
+telemetry has been purged.
+
+NumPy is optional; without it only the SQL functions are available.
+"""
+import itertools
+import os
+import re
+from dotenv import load_dotenv
+from database import (
+    ROLLUP_RESOLUTIONS, now_ms, format_timestamp, get_rollups, get_rollup_horizon,
+    aggregate_telemetry, get_field_values
+)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Load environment variables
+load_dotenv()
+
+# Most buckets one request may ask for
+MAX_AGGREGATE_BUCKETS = int(os.getenv('MAX_AGGREGATE_BUCKETS', 10000))
+
+# Functions kept by the rollups and computed by the SQL GROUP BY
+SQL_FUNCTIONS = ('count', 'min', 'max', 'sum', 'avg', 'last')
+# Functions that need every value of a bucket (NumPy only)
+NUMPY_FUNCTIONS = ('stddev', 'median', 'p90', 'p95', 'p99')
+AGGREGATE_FUNCTIONS = SQL_FUNCTIONS + NUMPY_FUNCTIONS
+DEFAULT_FUNCTIONS = 'avg,min,max,count'
+
+# Bucket width units
+BUCKET_UNITS = {'s': 1000, 'm': 60000, 'h': 3600000, 'd': 86400000}
+
+# Window used when the request gives no 'since' (shortened to
+# MAX_AGGREGATE_BUCKETS buckets for narrow buckets)
+DEFAULT_WINDOW_MS = 7 * 86400000
+
+class AggregateError(ValueError):
+    """Raised for aggregation requests that cannot be served (bad bucket, function or window)."""
+
+def parse_bucket(bucket):
+    """
+    Parse a bucket width such as '30s', '5m', '1h' or '1d'.
+
+    Returns:
+        int: The width in milliseconds
+
+    Raises:
+        AggregateError: If the width is not a positive number of s/m/h/d
+    """
+    match = re.fullmatch(r'(\d+)([smhd])', (bucket or '').strip())
+    if not match or int(match.group(1)) == 0:
+        raise AggregateError(f"Invalid bucket: {bucket!r}. Use a number followed by s, m, h or d (e.g. 5m)")
+    return int(match.group(1)) * BUCKET_UNITS[match.group(2)]
+
+def parse_functions(functions):
+    """
+    Parse a comma separated list of aggregate functions (default avg,min,max,count).
+
+    Returns:
+        list: Function names in request order, without duplicates
+
+    Raises:
+        AggregateError: If a function is unknown, or needs NumPy and it is missing
+    """
+    names = []
+    for name in (functions or DEFAULT_FUNCTIONS).split(','):
+        name = name.strip().lower()
+        if not name or name in names:
+            continue
+        if name not in AGGREGATE_FUNCTIONS:
+            raise AggregateError(f"Unknown aggregate function: {name}. Use any of: {', '.join(AGGREGATE_FUNCTIONS)}")
+        if name in NUMPY_FUNCTIONS and np is None:
+            raise AggregateError(f"The {name} function requires the numpy package (pip install numpy)")
+        names.append(name)
+    if not names:
+        raise AggregateError("At least one aggregate function is required")
+    return names
+
+def aggregate(field, bucket='5m', functions=None, device_id=None, topic_id=None, since=None, until=None):
+    """
+    Aggregate a numeric payload field into time buckets.
+
+    Args:
+        field (str): Payload field ('value' also matches bare numeric payloads)
+        bucket (str, optional): Bucket width, see parse_bucket
+        functions (str, optional): Comma separated functions, see parse_functions
+        device_id (int, optional): Filter by device ID
+        topic_id (int, optional): Filter by topic ID
+        since (int, optional): Window start in epoch ms (default: 7 days before
+            until, or MAX_AGGREGATE_BUCKETS buckets if that is shorter)
+        until (int, optional): Window end in epoch ms (default: now)
+
+    Returns:
+        dict: field, bucket, bucket_ms, functions, source, since, until (the
+            widened window) and buckets: dicts with timestamp / timestamp_ms
+            (bucket start) and one key per function; empty buckets are left out
+
+    Raises:
+        AggregateError: If the request is invalid or spans too many buckets
+        ValueError: If the field name is invalid
+    """
+    width = parse_bucket(bucket)
+    names = parse_functions(functions)
+
+    # Widen the window to whole buckets
+    until = now_ms() if until is None else until
+    until = -(-until // width) * width
+    since = until - min(DEFAULT_WINDOW_MS, MAX_AGGREGATE_BUCKETS * width) if since is None else since
+    since = since // width * width
+    if since >= until:
+        raise AggregateError("since must be before until")
+    if (until - since) // width > MAX_AGGREGATE_BUCKETS:
+        raise AggregateError(f"The window spans more than {MAX_AGGREGATE_BUCKETS} buckets; use a larger bucket")
+
+    filters = {'device_id': device_id, 'topic_id': topic_id, 'since': since, 'until': until}
+    if any(name in NUMPY_FUNCTIONS for name in names):
+        source = 'numpy'
+        rows = _numpy_buckets(get_field_values(field, **filters), width, names)
+    else:
+        resolution = _rollup_resolution(width, until)
+        if resolution:
+            source = f'rollup_{resolution}'
+            rows = get_rollups(field, resolution, bucket_ms=width, limit=MAX_AGGREGATE_BUCKETS, **filters)
+        else:
+            source = 'sql'
+            rows = aggregate_telemetry(field, width, last='last' in names, **filters)
+
+    buckets = [dict({'timestamp': row['timestamp'], 'timestamp_ms': row['timestamp_ms']},
+                    **{name: row[name] for name in names})
+               for row in rows]
+    return {
+        'field': field,
+        'bucket': bucket,
+        'bucket_ms': width,
+        'functions': names,
+        'source': source,
+        'since': since,
+        'until': until,
+        'buckets': buckets,
+    }
+
+def _rollup_resolution(width, until):
+    """The coarsest rollup resolution that can serve the buckets, or None."""
+    horizon = None
+    for name, resolution in sorted(ROLLUP_RESOLUTIONS.items(), key=lambda item: -item[1]):
+        if width % resolution:
+            continue
+        if horizon is None:
+            horizon = get_rollup_horizon()
+        # Rows behind the watermark are not rolled up yet
+        if horizon is not None and horizon < until:
+            return None
+        return name
+    return None
+
+def _numpy_buckets(values, width, names):
+    """
+    Aggregate (timestamp_ms, value) pairs, sorted by time, per bucket with NumPy.
+
+    Returns:
+        list: Dicts with timestamp, timestamp_ms and the requested functions
+    """
+    if not values:
+        return []
+    data = np.fromiter(itertools.chain.from_iterable(values), dtype=np.float64, count=2 * len(values))
+    timestamps = data[0::2].astype(np.int64)
+    v = data[1::2]
+
+    # Rows are in time order, so each bucket is one contiguous run
+    bucket_starts = timestamps // width * width
+    starts = np.flatnonzero(np.r_[True, bucket_starts[1:] != bucket_starts[:-1]])
+    counts = np.diff(np.r_[starts, len(v)])
+    sums = np.add.reduceat(v, starts)
+    means = sums / counts
+
+    results = {
+        'count': counts,
+        'min': np.minimum.reduceat(v, starts),
+        'max': np.maximum.reduceat(v, starts),
+        'sum': sums,
+        'avg': means,
+        'last': v[starts + counts - 1],
+    }
+    if 'stddev' in names:
+        deviations = v - np.repeat(means, counts)
+        results['stddev'] = np.sqrt(np.add.reduceat(deviations * deviations, starts) / counts)
+
+    percentiles = {'median': 50, 'p90': 90, 'p95': 95, 'p99': 99}
+    if any(name in percentiles for name in names):
+        # Sort values within each bucket, then interpolate linearly between ranks
+        bucket_index = np.repeat(np.arange(len(starts)), counts)
+        ordered = v[np.lexsort((v, bucket_index))]
+        for name, q in percentiles.items():
+            if name not in names:
+                continue
+            rank = starts + (counts - 1) * (q / 100)
+            low = np.floor(rank).astype(np.int64)
+            high = np.ceil(rank).astype(np.int64)
+            results[name] = ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+    columns = {name: results[name].tolist() for name in names}
+    return [dict({'timestamp': format_timestamp(int(start)), 'timestamp_ms': int(start)},
+                 **{name: columns[name][i] for name in names})
+            for i, start in enumerate(bucket_starts[starts].tolist())]
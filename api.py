@@ -1,8 +1,19 @@
+import math
 from flask import Blueprint, request, jsonify
 from database import (
     get_client_by_api_key, get_all_topics, get_all_devices, 
-    get_telemetry_data, get_topic_by_name, get_device_by_name
+    get_telemetry_page, get_telemetry_since, get_topic_by_name, get_topic_by_id, get_device_by_name,
+    get_topic_schema, resolve_device_id, resolve_topic_id, store_telemetry_data,
+    parse_timestamp, decode_cursor, format_timestamp
 )
+from aggregates import aggregate
+from exporters import merge_schema
+from events import publish_telemetry
+from http_cache import conditional_get
+from json_codec import json_response
+
+# Largest page /api/data will return; use next_cursor to fetch more
+MAX_PAGE_SIZE = 1000
 
 # Create a Blueprint for the REST API
 api_bp = Blueprint('api', __name__, url_prefix='/api')
@@ -14,8 +25,22 @@ def authenticate():
         return None
     return get_client_by_api_key(api_key)
 
+# Parse an optional numeric filter parameter (min_value / max_value)
+def value_bound(name):
+    raw = request.args.get(name)
+    if raw is None or raw == '':
+        return None
+    try:
+        value = float(raw)
+    except ValueError:
+        value = None
+    if value is None or not math.isfinite(value):
+        raise ValueError(f"{name} must be a number: {raw}")
+    return value
+
 # Endpoint to get all topics for a client
 @api_bp.route('/topics', methods=['GET'])
+@conditional_get(vary=('X-API-Key',))
 def get_topics():
     client = authenticate()
     if not client:
@@ -24,8 +49,35 @@ def get_topics():
     topics = get_all_topics(client['id'])
     return jsonify({'topics': topics})
 
+# Endpoint to get the payload schema recorded for one of the client's topics
+@api_bp.route('/topics/<int:topic_id>/schema', methods=['GET'])
+@conditional_get(vary=('X-API-Key',))
+def get_topic_payload_schema(topic_id):
+    client = authenticate()
+    if not client:
+        return jsonify({'error': 'Authentication required'}), 401
+    
+    topic = get_topic_by_id(topic_id)
+    if not topic or topic['client_id'] != client['id']:
+        return jsonify({'error': f'Topic not found: {topic_id}'}), 404
+    
+    fields = []
+    for field, info in merge_schema(get_topic_schema(topic_id)).items():
+        fields.append({
+            'field': field,
+            'type': info['type'],
+            'types': info['types'],
+            'count': info['count'],
+            'first_seen': format_timestamp(info['first_seen']),
+            'first_seen_ms': info['first_seen'],
+            'last_seen': format_timestamp(info['last_seen']),
+            'last_seen_ms': info['last_seen'],
+        })
+    return jsonify({'topic_id': topic_id, 'topic': topic['name'], 'fields': fields})
+
 # Endpoint to get all devices for a client
 @api_bp.route('/devices', methods=['GET'])
+@conditional_get(vary=('X-API-Key',))
 def get_devices():
     client = authenticate()
     if not client:
@@ -44,46 +96,95 @@ def get_data():
     # Get query parameters
     device_name = request.args.get('device')
     topic_name = request.args.get('topic')
-    limit = request.args.get('limit', 100, type=int)
+    limit = min(max(request.args.get('limit', 100, type=int), 1), MAX_PAGE_SIZE)
+    
+    # Delta polling: only rows added after the caller's last_id, oldest first
+    since_id = request.args.get('since_id', type=int)
+    
+    # Optional time window and cursor from a previous page's next_cursor
+    try:
+        since = request.args.get('since')
+        since = parse_timestamp(since) if since else None
+        until = request.args.get('until')
+        until = parse_timestamp(until) if until else None
+        cursor = request.args.get('cursor')
+        cursor = decode_cursor(cursor) if cursor else None
+        if since_id is not None and (since is not None or until is not None or cursor):
+            raise ValueError("since_id cannot be combined with since, until or cursor")
+        # Filter on the numeric 'value' of the payload
+        min_value = value_bound('min_value')
+        max_value = value_bound('max_value')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
     device_id = None
     topic_id = None
     
-    # If device name is provided, get the device ID
+    # Resolve the client's device and topic, auto-creating them if not found
     if device_name:
-        device = get_device_by_name(device_name, client['id'])
-        if device:
-            device_id = device['id']
-        else:
-            # Auto-create device if not found
-            from database import create_device
-            device_id = create_device(device_name, f"Auto-created device for {device_name}", client['id'])
-            print(f"Auto-created device: {device_name} with ID: {device_id}")
+        device_id = resolve_device_id(client['id'], device_name)
+        if not device_id:
+            return jsonify({'error': f'Không thể tạo thiết bị: {device_name}'}), 500
     
-    # If topic name is provided, get the topic ID
     if topic_name:
-        topic = get_topic_by_name(topic_name)
-        if topic:
-            topic_id = topic['id']
-        else:
-            # Auto-create topic if not found
-            from database import create_topic
-            topic_id = create_topic(topic_name, f"Auto-created topic for {topic_name}", client['id'])
-            print(f"Auto-created topic: {topic_name} with ID: {topic_id}")
-    
-    # Get the telemetry data
-    data = get_telemetry_data(device_id, topic_id, limit)
+        topic_id = resolve_topic_id(client['id'], topic_name)
+        if not topic_id:
+            return jsonify({'error': f'Không thể tạo chủ đề: {topic_name}'}), 500
     
-    # Process payload - convert JSON strings to objects if possible
-    for item in data:
-        try:
-            if isinstance(item['payload'], str):
-                import json
-                item['payload'] = json.loads(item['payload'])
-        except (json.JSONDecodeError, TypeError):
-            pass
+    # Get one page of telemetry data, or the rows added since since_id
+    if since_id is not None:
+        data, last_id = get_telemetry_since(since_id, device_id, topic_id, limit, min_value, max_value)
+        response = {'data': data, 'last_id': last_id}
+    else:
+        data, next_cursor = get_telemetry_page(device_id, topic_id, limit, since, until, cursor,
+                                               min_value, max_value)
+        response = {'data': data, 'next_cursor': next_cursor}
     
-    return jsonify({'data': data})
+    # Stored payloads are JSON text and are spliced in as they are
+    return json_response(response, rows=data)
+
+# Endpoint to aggregate a numeric payload field into time buckets
+@api_bp.route('/aggregate', methods=['GET'])
+@conditional_get(vary=('X-API-Key',), until_arg='until')
+def get_aggregate():
+    client = authenticate()
+    if not client:
+        return jsonify({'error': 'Authentication required'}), 401
+
+    # Get query parameters
+    device_name = request.args.get('device')
+    topic_name = request.args.get('topic')
+    field = request.args.get('field')
+    if not field:
+        return jsonify({'error': 'field is required'}), 400
+    if not device_name and not topic_name:
+        return jsonify({'error': 'device or topic is required'}), 400
+
+    # Unlike /api/data, unknown names are not auto-created
+    device_id = None
+    topic_id = None
+    if device_name:
+        device = get_device_by_name(device_name, client['id'])
+        if not device:
+            return jsonify({'error': f'Device not found: {device_name}'}), 404
+        device_id = device['id']
+    if topic_name:
+        topic = get_topic_by_name(topic_name, client['id'])
+        if not topic:
+            return jsonify({'error': f'Topic not found: {topic_name}'}), 404
+        topic_id = topic['id']
+
+    try:
+        since = request.args.get('since')
+        since = parse_timestamp(since) if since else None
+        until = request.args.get('until')
+        until = parse_timestamp(until) if until else None
+        result = aggregate(field, request.args.get('bucket', '5m'), request.args.get('fn'),
+                           device_id, topic_id, since, until)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify(result)
 
 # HTTP endpoint to publish data (alternative to MQTT)
 @api_bp.route('/publish', methods=['POST'])
@@ -134,32 +235,22 @@ def publish_data():
             
         # Database operations with proper error handling
         try:
-            # Get or auto-create the topic if not found
-            topic = get_topic_by_name(topic_name, client['id'])
-            if not topic:
-                # Auto-create topic
-                from database import create_topic
-                topic_id = create_topic(topic_name, f"Auto-created topic for {topic_name}", client['id'])
-                if not topic_id:
-                    return jsonify({'error': f'Không thể tạo chủ đề: {topic_name}. Có thể đã tồn tại.'}), 500
-                print(f"Auto-created topic: {topic_name} with ID: {topic_id}")
-                topic = {'id': topic_id}
+            # Resolve (or auto-create) the topic and device
+            topic_id = resolve_topic_id(client['id'], topic_name)
+            if not topic_id:
+                return jsonify({'error': f'Không thể tạo chủ đề: {topic_name}'}), 500
             
-            # Get or create the device
-            from database import create_device, store_telemetry_data
-            device = get_device_by_name(device_name, client['id'])
-            if not device:
-                device_id = create_device(device_name, f"Auto-created device for {device_name}", client['id'])
-                if not device_id:
-                    return jsonify({'error': f'Không thể tạo thiết bị: {device_name}'}), 500
-                print(f"Auto-created device: {device_name} with ID: {device_id}")
-            else:
-                device_id = device['id']
+            device_id = resolve_device_id(client['id'], device_name)
+            if not device_id:
+                return jsonify({'error': f'Không thể tạo thiết bị: {device_name}'}), 500
             
             # Store the telemetry data with improved error handling
-            success = store_telemetry_data(device_id, topic['id'], payload)
+            success = store_telemetry_data(device_id, topic_id, payload)
             if not success:
                 return jsonify({'error': 'Lỗi khi lưu trữ dữ liệu telemetry'}), 500
+            
+            # Push the message to live /api/stream subscribers
+            publish_telemetry(client['id'], device_id, device_name, topic_id, topic_name, payload)
                 
             return jsonify({
                 'status': 'success', 
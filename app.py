@@ -1,15 +1,32 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, make_response
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, Response, stream_with_context, send_file
 from flask_bootstrap import Bootstrap
 from mqtt_server import mqtt_server
 from database import (
     init_db, create_client, get_all_clients, create_topic, get_all_topics,
-    get_all_devices, delete_topic, delete_device, get_telemetry_data, delete_client, get_telemetry_data_count,
-    cleanup_orphaned_data, update_client_api_key, get_topic_by_id, get_all_telemetry_by_topic, get_device_telemetry_data_full,
-    get_device_topic_telemetry_data, get_device_telemetry_data
+    get_all_devices, delete_topic, delete_device, get_telemetry_data, delete_client,
+    cleanup_orphaned_data, update_client_api_key, get_topic_by_id, get_device_by_id,
+    get_device_telemetry_data, get_cache_stats, iter_telemetry,
+    get_dashboard_stats, get_telemetry_stats, get_latest_by_device,
+    get_telemetry_page, get_telemetry_since, parse_timestamp, decode_cursor,
+    get_retention_policies, set_retention_policy, get_rollups, get_rollup_lag, ROLLUP_RESOLUTIONS, now_ms,
+    get_chart_fields,
+    release_db_connection, close_all_db_connections
 )
 from api import api_bp
+from exporters import EXPORT_FORMATS, ExportError, check_format, resolve_fields, iter_export
+from export_jobs import export_jobs
+from events import event_broker
+from retention import retention_purger
+from rollups import rollup_updater
+from recompression import payload_recompressor
+from downsample import chart_series
+from http_cache import conditional_get
+import json_codec
+from json_codec import json_response
 import threading
-import json
+import atexit
+import signal
+import sys
 import os
 from dotenv import load_dotenv
 from flask_login import login_required, login_user, logout_user, current_user, LoginManager
@@ -32,6 +49,9 @@ app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', os.urandom(24))
 app.config['DEBUG'] = os.getenv('FLASK_DEBUG', 'False').lower() in ('true', '1', 't')
 app.config['HOST'] = os.getenv('FLASK_HOST', '0.0.0.0')
 app.config['PORT'] = int(os.getenv('FLASK_PORT', 5000))
+
+# Most buckets /api/rollups returns when it picks the resolution itself
+ROLLUP_MAX_POINTS = int(os.getenv('ROLLUP_MAX_POINTS', 1000))
 Bootstrap(app)
 
 # Initialize Flask-Login
@@ -49,6 +69,9 @@ def custom_login_required(f):
 # Register the API blueprint
 app.register_blueprint(api_bp)
 
+# Hand the request thread's database connection back to the pool
+app.teardown_appcontext(release_db_connection)
+
 # Initialize the database
 init_db()
 
@@ -67,6 +90,20 @@ def start_mqtt_server():
 # Use this alternative approach
 with app.app_context():
     start_mqtt_server()
+    # Enforce retention policies, catch up rollups and compress payloads in the background
+    retention_purger.start()
+    rollup_updater.start()
+    payload_recompressor.start()
+
+# Drain the telemetry ingest queue, stop the retention purger, rollup
+# updater, payload recompressor and export workers, then close pooled
+# connections at exit (atexit runs handlers in reverse registration order)
+atexit.register(close_all_db_connections)
+atexit.register(export_jobs.shutdown)
+atexit.register(payload_recompressor.stop)
+atexit.register(rollup_updater.stop)
+atexit.register(retention_purger.stop)
+atexit.register(mqtt_server.stop)
 
 # Login route
 @app.route('/login', methods=['GET', 'POST'])
@@ -107,30 +144,11 @@ def index():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    clients = get_all_clients()
-    topics = get_all_topics()
-    devices = get_all_devices()
-    
-    # Get the latest telemetry data
+    # Get the latest telemetry data (timestamps come formatted from the query)
     latest_data = get_telemetry_data(limit=10)
-    for item in latest_data: # latest_data is a list of dicts
-        if item.get('timestamp'):
-            try:
-                # Assuming timestamp is stored as ISO 8601 with offset
-                dt_obj_aware = datetime.fromisoformat(item['timestamp'])
-                # Format for display, this will use the object's timezone (VN_TZ)
-                item['timestamp'] = dt_obj_aware.strftime('%Y-%m-%d %H:%M:%S')
-            except (ValueError, TypeError):
-                # Keep original if formatting fails (e.g. old data or already formatted)
-                pass # Or set to a default error string: item['timestamp'] = "Invalid date"
-    
-    # Count statistics
-    stats = {
-        'client_count': len(clients),
-        'topic_count': len(topics),
-        'device_count': len(devices),
-        'data_count': get_telemetry_data_count()  # Use a new function to get total count
-    }
+    
+    # Count statistics (maintained counters, no table scans)
+    stats = get_dashboard_stats()
     
     # Get MQTT broker information
     mqtt_info = {
@@ -210,7 +228,48 @@ def topics():
     
     topics = get_all_topics()
     clients = get_all_clients()
-    return render_template('topics.html', topics=topics, clients=clients)
+    return render_template('topics.html', topics=topics, clients=clients,
+                           policies=get_retention_policies(),
+                           retention=retention_purger.stats())
+
+def _retention_form_values():
+    """
+    Read max_age_days / max_rows from a retention form (blank means no limit).
+
+    Raises:
+        ValueError: If a value is not a number
+    """
+    max_age_days = request.form.get('max_age_days', '').strip()
+    max_rows = request.form.get('max_rows', '').strip()
+    return (float(max_age_days) if max_age_days else None,
+            int(max_rows) if max_rows else None)
+
+def _save_retention_policy(scope, scope_id):
+    """Save a retention form for a topic or client and flash the outcome."""
+    try:
+        max_age_days, max_rows = _retention_form_values()
+        success = set_retention_policy(scope, scope_id, max_age_days, max_rows)
+    except ValueError as e:
+        flash(f'Invalid retention settings: {e}', 'danger')
+        return redirect(url_for('topics'))
+
+    if success:
+        flash('Retention policy saved', 'success')
+    else:
+        flash(f'Failed to save retention policy. Please ensure the {scope} exists.', 'danger')
+    return redirect(url_for('topics'))
+
+# Set a topic's retention policy
+@app.route('/topics/retention/<int:topic_id>', methods=['POST'])
+@login_required
+def topic_retention_route(topic_id):
+    return _save_retention_policy('topic', topic_id)
+
+# Set a client's default retention policy for its topics
+@app.route('/clients/retention/<int:client_id>', methods=['POST'])
+@login_required
+def client_retention_route(client_id):
+    return _save_retention_policy('client', client_id)
 
 # Delete a topic
 @app.route('/topics/delete/<int:topic_id>', methods=['POST'])
@@ -273,34 +332,19 @@ def data():
     # Use the function get_device_telemetry_data which structures data by device
     device_data_from_db = get_device_telemetry_data(topic_id=topic_id, limit_per_device=limit_per_device_config)
     
-    # Process timestamps in device_data_from_db
-    for dev_id in device_data_from_db:
-        if 'telemetry' in device_data_from_db[dev_id] and device_data_from_db[dev_id]['telemetry']:
-            for tel_item in device_data_from_db[dev_id]['telemetry']:
-                if tel_item.get('timestamp'):
-                    try:
-                        dt_obj_aware = datetime.fromisoformat(tel_item['timestamp'])
-                        tel_item['timestamp'] = dt_obj_aware.strftime('%Y-%m-%d %H:%M:%S')
-                    except (ValueError, TypeError):
-                        pass
-    
     # Add current datetime for CSV export filename
     now = datetime.now(VN_TZ) # Use VN_TZ
     
     # Get all telemetry data for table view and export
     all_telemetry_for_table = get_telemetry_data(topic_id=topic_id, limit=100)
-    # Process timestamps in all_telemetry_for_table
-    for item in all_telemetry_for_table:
-        if item.get('timestamp'):
-            try:
-                dt_obj_aware = datetime.fromisoformat(item['timestamp'])
-                item['timestamp'] = dt_obj_aware.strftime('%Y-%m-%d %H:%M:%S')
-            except (ValueError, TypeError):
-                pass
+    
+    # Numeric fields each device card can chart, from the payload schema registry
+    chart_fields = get_chart_fields(topic_id=topic_id)
     
     return render_template('data.html', 
                          device_data=device_data_from_db, # Pass the processed data
                          data=all_telemetry_for_table, # Pass the processed data for table
+                         chart_fields=chart_fields,
                          devices=devices, 
                          topics=topics, 
                          clients=clients,  # Pass clients to the template
@@ -318,22 +362,90 @@ def about():
 
 # API endpoints for real-time updates
 @app.route('/api/stats', methods=['GET'])
+@conditional_get()
 def api_stats():
     """API endpoint for dashboard statistics"""
-    clients = get_all_clients()
-    topics = get_all_topics()
-    devices = get_all_devices()
-    
-    stats = {
-        'client_count': len(clients),
-        'topic_count': len(topics),
-        'device_count': len(devices),
-        'data_count': get_telemetry_data_count()
-    }
+    response = {'stats': get_dashboard_stats()}
+    
+    # Optional per-client/device/topic row count and time range
+    for scope in ('client', 'device', 'topic'):
+        scope_id = request.args.get(f'{scope}_id', type=int)
+        if scope_id is not None:
+            response[f'{scope}_stats'] = get_telemetry_stats(scope, scope_id)
+    
+    return jsonify(response)
+
+@app.route('/api/rollups', methods=['GET'])
+@conditional_get(until_arg='until')
+def api_rollups():
+    """
+    API endpoint for minute/hour/day aggregates of a numeric payload field.
+    
+    Query parameters: field (required), device_id, topic_id, since, until
+    (default: the 7 days before until) and resolution ('1m', '1h', '1d' or
+    'auto', the finest one giving at most ROLLUP_MAX_POINTS buckets).
+    """
+    field = request.args.get('field')
+    if not field:
+        return jsonify({"status": "error", "message": "Thiếu tham số field"}), 400
     
-    return jsonify({'stats': stats})
+    try:
+        until = request.args.get('until')
+        until = parse_timestamp(until) if until else None
+        since = request.args.get('since')
+        since = parse_timestamp(since) if since else None
+        end = until if until is not None else now_ms()
+        if since is None:
+            since = end - 7 * 86400000
+        resolution = request.args.get('resolution', 'auto')
+        if resolution == 'auto':
+            span = max(end - since, 0)
+            resolution = next((name for name, width in ROLLUP_RESOLUTIONS.items()
+                               if span / width <= ROLLUP_MAX_POINTS), list(ROLLUP_RESOLUTIONS)[-1])
+        rollups = get_rollups(
+            field, resolution,
+            device_id=request.args.get('device_id', type=int),
+            topic_id=request.args.get('topic_id', type=int),
+            since=since, until=until
+        )
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    
+    # lag: telemetry IDs received but not rolled up yet
+    return jsonify({'field': field, 'resolution': resolution, 'rollups': rollups, 'lag': get_rollup_lag()})
+
+@app.route('/api/chart_series', methods=['GET'])
+@conditional_get(until_arg='until')
+def api_chart_series():
+    """
+    API endpoint for a chart-sized series of a numeric payload field.
+
+    Query parameters: field (required), device_id, topic_id, points (default
+    500, at most CHART_MAX_POINTS), since and until (default: the 7 days
+    before until). The raw values are reduced with LTTB downsampling.
+    """
+    field = request.args.get('field')
+    if not field:
+        return jsonify({"status": "error", "message": "Thiếu tham số field"}), 400
+
+    try:
+        until = request.args.get('until')
+        until = parse_timestamp(until) if until else None
+        since = request.args.get('since')
+        since = parse_timestamp(since) if since else None
+        series = chart_series(
+            field, request.args.get('points', 500, type=int),
+            device_id=request.args.get('device_id', type=int),
+            topic_id=request.args.get('topic_id', type=int),
+            since=since, until=until
+        )
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    return jsonify(series)
 
 @app.route('/api/latest_data', methods=['GET'])
+@conditional_get()
 def api_latest_data():
     """API endpoint for latest telemetry data"""
     limit = request.args.get('limit', 10, type=int)
@@ -342,24 +454,45 @@ def api_latest_data():
     # Giới hạn limit tối đa là 1000 để tránh quá tải
     limit = min(max(limit, 1), 1000)
     
-    latest_data = get_telemetry_data(topic_id=topic_id, limit=limit)
+    # Delta polling: only rows added after the caller's last_id, oldest first
+    since_id = request.args.get('since_id', type=int)
     
-    # Process payload - convert JSON strings to objects if possible
-    for item in latest_data:
-        try:
-            if isinstance(item['payload'], str):
-                item['payload'] = json.loads(item['payload'])
-        except (json.JSONDecodeError, TypeError):
-            pass
-        # Process timestamp for API consistency
-        if item.get('timestamp'):
-            try:
-                dt_obj_aware = datetime.fromisoformat(item['timestamp'])
-                item['timestamp'] = dt_obj_aware.strftime('%Y-%m-%d %H:%M:%S')
-            except (ValueError, TypeError):
-                pass # Keep original if formatting fails
-    
-    return jsonify({'latest_data': latest_data})
+    # Optional time window and cursor from a previous page's next_cursor
+    try:
+        since = request.args.get('since')
+        since = parse_timestamp(since) if since else None
+        until = request.args.get('until')
+        until = parse_timestamp(until) if until else None
+        cursor = request.args.get('cursor')
+        cursor = decode_cursor(cursor) if cursor else None
+        if since_id is not None and (since is not None or until is not None or cursor):
+            raise ValueError("since_id cannot be combined with since, until or cursor")
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    
+    if since_id is not None:
+        latest_data, last_id = get_telemetry_since(since_id, topic_id=topic_id, limit=limit)
+        response = {'latest_data': latest_data, 'last_id': last_id}
+    else:
+        latest_data, next_cursor = get_telemetry_page(
+            topic_id=topic_id, limit=limit, since=since, until=until, cursor=cursor
+        )
+        response = {'latest_data': latest_data, 'next_cursor': next_cursor}
+    
+    # Stored payloads are JSON text and are spliced in as they are
+    return json_response(response, rows=latest_data)
+
+@app.route('/api/latest_by_device', methods=['GET'])
+def api_latest_by_device():
+    """API endpoint for the newest reading of each device per topic"""
+    latest = get_latest_by_device(
+        client_id=request.args.get('client_id', type=int),
+        device_id=request.args.get('device_id', type=int),
+        topic_id=request.args.get('topic_id', type=int)
+    )
+    
+    # Stored payloads are JSON text and are spliced in as they are
+    return json_response({'latest_by_device': latest}, rows=latest)
 
 @app.route('/api/mqtt_status', methods=['GET'])
 def api_mqtt_status():
@@ -372,8 +505,68 @@ def api_mqtt_status():
     
     return jsonify({'mqtt_info': mqtt_info})
 
+# Seconds of silence after which /api/stream sends a heartbeat (with fresh stats)
+STREAM_HEARTBEAT_INTERVAL = float(os.getenv('STREAM_HEARTBEAT_INTERVAL', 15))
+
+def _sse_frame(event_type, data, event_id=None):
+    """Format one Server-Sent Events message."""
+    frame = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{frame}event: {event_type}\ndata: {json_codec.dumps(data)}\n\n"
+
+@app.route('/api/stream', methods=['GET'])
+def api_stream():
+    """
+    Server-Sent Events stream of incoming telemetry.
+    
+    Sends a 'telemetry' event per received message (optionally filtered by
+    topic_id, device_id or client_id), a 'heartbeat' event with dashboard
+    stats and MQTT status when idle, and 'resync' if the client fell behind
+    and missed events.
+    """
+    subscription = event_broker.subscribe(
+        topic_id=request.args.get('topic_id', type=int),
+        device_id=request.args.get('device_id', type=int),
+        client_id=request.args.get('client_id', type=int)
+    )
+    
+    # Not wrapped in stream_with_context: the request (and its pooled
+    # connection) is torn down while the stream stays open
+    def generate():
+        try:
+            # Tell EventSource how long to wait before reconnecting
+            yield "retry: 3000\n\n"
+            while True:
+                event = subscription.get(timeout=STREAM_HEARTBEAT_INTERVAL)
+                if event is not None:
+                    yield _sse_frame(*event)
+                    continue
+                try:
+                    stats = get_dashboard_stats()
+                finally:
+                    release_db_connection()
+                yield _sse_frame('heartbeat', {
+                    'stats': stats,
+                    'mqtt_connected': mqtt_server.client.is_connected() if hasattr(mqtt_server.client, 'is_connected') else False
+                })
+        finally:
+            event_broker.unsubscribe(subscription)
+    
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop reverse proxies (nginx) from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/cache_stats', methods=['GET'])
+def api_cache_stats():
+    """API endpoint for in-memory cache hit/miss counters"""
+    return jsonify({'cache_stats': get_cache_stats(), 'stream_stats': event_broker.stats(),
+                    'retention_stats': retention_purger.stats(), 'rollup_stats': rollup_updater.stats(),
+                    'compression_stats': payload_recompressor.stats()})
+
 # API endpoint for device data with client and topic information
 @app.route('/api/device_data', methods=['GET'])
+@conditional_get()
 def api_device_data():
     """API endpoint for device-specific data"""
     topic_id = request.args.get('topic_id', type=int)
@@ -382,27 +575,19 @@ def api_device_data():
     # Giới hạn limit tối đa là 1000 bản ghi cho mỗi thiết bị để tránh quá tải
     limit = min(max(limit, 1), 1000)
     
+    # Delta polling: only devices with rows added after the caller's last_id
+    since_id = request.args.get('since_id', type=int)
+    
     # Get device-specific data
-    device_data = get_device_telemetry_data(topic_id=topic_id, limit_per_device=limit)
+    device_data = get_device_telemetry_data(topic_id=topic_id, limit_per_device=limit, since_id=since_id)
     
-    # Process payload - convert JSON strings to objects if possible
-    # And process timestamps for API consistency
-    for device_id_key, info in device_data.items(): # Use device_id_key to avoid conflict
-        for item in info.get('telemetry', []):
-            try:
-                if isinstance(item.get('payload'), str):
-                    item['payload'] = json.loads(item['payload'])
-            except (json.JSONDecodeError, TypeError):
-                pass
-            # Process timestamp
-            if item.get('timestamp'):
-                try:
-                    dt_obj_aware = datetime.fromisoformat(item['timestamp'])
-                    item['timestamp'] = dt_obj_aware.strftime('%Y-%m-%d %H:%M:%S')
-                except (ValueError, TypeError):
-                    pass # Keep original if formatting fails
+    rows = [item for info in device_data.values() for item in info.get('telemetry', [])]
     
-    return jsonify({'device_data': device_data})
+    response = {'device_data': device_data}
+    if since_id is not None:
+        response['last_id'] = max((item['id'] for item in rows), default=since_id)
+    # Stored payloads are JSON text and are spliced in as they are
+    return json_response(response, rows=rows)
 
 # Cleanup orphaned data
 @app.route('/cleanup-orphaned-data', methods=['POST'])
@@ -420,6 +605,82 @@ def cleanup_data_route():
     
     return redirect(url_for('data'))
 
+# Flush streamed CSV output to the client in pieces of about this size
+CSV_STREAM_BUFFER_SIZE = 64 * 1024
+
+def _payload_value_unit(payload):
+    """Tách giá trị và đơn vị từ payload để ghi vào CSV"""
+    try:
+        # Nếu payload là chuỗi JSON
+        if isinstance(payload, str):
+            try:
+                payload_obj = json_codec.loads(payload)
+            except json_codec.JSONDecodeError:
+                return payload, ''
+            if not isinstance(payload_obj, dict):
+                # Plain text payloads are stored as JSON strings
+                return (payload_obj if isinstance(payload_obj, str) else payload), ''
+            payload = payload_obj
+        # Nếu payload đã là dictionary
+        if isinstance(payload, dict):
+            if 'value' in payload:
+                return payload['value'], payload.get('unit', '')
+            return json_codec.dumps(payload), ''
+        return (str(payload) if payload is not None else ''), ''
+    except Exception as e:
+        return f"Error: {str(e)}", ''
+
+def _csv_export_response(filename, header, rows):
+    """
+    Stream CSV to the client as it is generated.
+    
+    Args:
+        filename (str): Download file name
+        header (list): Column names
+        rows (iterable): Lists of cell values, consumed lazily
+        
+    Returns:
+        Response: A streaming text/csv attachment response
+    """
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow(row)
+            if buffer.tell() >= CSV_STREAM_BUFFER_SIZE:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    
+    response = Response(stream_with_context(generate()), mimetype='text/csv')
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
+
+def _telemetry_csv_rows(data, columns):
+    """
+    Turn streamed telemetry rows into CSV rows.
+    
+    Args:
+        data (iterable): Telemetry rows from iter_telemetry
+        columns (tuple): Which of 'device' and 'topic' to include after the timestamp
+    """
+    for item in data:
+        payload = item['payload']
+        if item['value'] is not None and payload.startswith('{') and (item['unit'] is not None or '"unit"' not in payload):
+            # Numeric value (and text unit) of an object payload: read from the typed columns
+            payload_value, payload_unit = item['value'], item['unit'] or ''
+        else:
+            payload_value, payload_unit = _payload_value_unit(payload)
+        row = [item['id'], item['timestamp']]
+        if 'device' in columns:
+            row.append(item['device_name'] or f"Unknown (ID: {item['device_id']})")
+        if 'topic' in columns:
+            row.append(item['topic_name'] or f"Unknown (ID: {item['topic_id']})")
+        row.extend([payload_value, payload_unit])
+        yield row
+
 # Route for exporting topic CSV
 @app.route('/api/export_topic_csv/<int:topic_id>', methods=['GET'])
 @login_required
@@ -430,69 +691,13 @@ def export_topic_csv(topic_id):
         topic = get_topic_by_id(topic_id)
         if not topic:
             return jsonify({"status": "error", "message": "Topic không tồn tại"}), 404
-            
-        # Lấy toàn bộ dữ liệu telemetry cho topic này
-        data = get_all_telemetry_by_topic(topic_id)
-        
-        # Tạo file CSV
-        csv_data = io.StringIO()
-        csv_writer = csv.writer(csv_data)
         
-        # Ghi header
-        csv_writer.writerow(['ID', 'Timestamp', 'Device', 'Topic', 'Payload Value', 'Payload Unit'])
-        
-        # Ghi dữ liệu
-        for item in data:
-            # Parse with timezone awareness if stored with offset, else it's already VN_TZ
-            timestamp = datetime.fromisoformat(item['timestamp'])
-            formatted_time = timestamp.strftime('%Y-%m-%d %H:%M:%S')
-            
-            # Xử lý payload
-            payload_value = ''
-            payload_unit = ''
-            
-            try:
-                # Nếu payload là chuỗi JSON
-                if isinstance(item['payload'], str):
-                    try:
-                        payload_obj = json.loads(item['payload'])
-                        if isinstance(payload_obj, dict):
-                            if 'value' in payload_obj:
-                                payload_value = payload_obj['value']
-                                payload_unit = payload_obj.get('unit', '')
-                            else:
-                                payload_value = json.dumps(payload_obj)
-                        else:
-                            payload_value = item['payload']
-                    except json.JSONDecodeError:
-                        payload_value = item['payload']
-                # Nếu payload đã là dictionary
-                elif isinstance(item['payload'], dict):
-                    if 'value' in item['payload']:
-                        payload_value = item['payload']['value']
-                        payload_unit = item['payload'].get('unit', '')
-                    else:
-                        payload_value = json.dumps(item['payload'])
-                else:
-                    payload_value = str(item['payload']) if item['payload'] is not None else ''
-            except Exception as e:
-                payload_value = f"Error: {str(e)}"
-            
-            csv_writer.writerow([
-                item['id'],
-                formatted_time,
-                item.get('device_name', f"Unknown (ID: {item['device_id']})"),
-                item.get('topic_name', f"Unknown (ID: {item['topic_id']})"),
-                payload_value,
-                payload_unit
-            ])
-        
-        # Tạo response
-        response = make_response(csv_data.getvalue())
-        response.headers["Content-Disposition"] = f"attachment; filename=topic_{topic_id}_{topic['name'].replace(' ', '_')}_data.csv"
-        response.headers["Content-Type"] = "text/csv"
-        
-        return response
+        # Dữ liệu được đọc và ghi dần theo từng phần
+        return _csv_export_response(
+            f"topic_{topic_id}_{topic['name'].replace(' ', '_')}_data.csv",
+            ['ID', 'Timestamp', 'Device', 'Topic', 'Payload Value', 'Payload Unit'],
+            _telemetry_csv_rows(iter_telemetry(topic_id=topic_id), ('device', 'topic'))
+        )
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
@@ -506,66 +711,12 @@ def export_device_csv(device_id):
         device = get_device_by_id(device_id)
         if not device:
             return jsonify({"status": "error", "message": "Thiết bị không tồn tại"}), 404
-            
-        # Lấy toàn bộ dữ liệu telemetry cho thiết bị này
-        data = get_device_telemetry_data_full(device_id)
-        
-        # Tạo file CSV
-        csv_data = io.StringIO()
-        csv_writer = csv.writer(csv_data)
-        
-        # Ghi header
-        csv_writer.writerow(['ID', 'Timestamp', 'Topic', 'Payload Value', 'Payload Unit'])
         
-        # Ghi dữ liệu
-        for item in data:
-            # Parse with timezone awareness if stored with offset, else it's already VN_TZ
-            timestamp = datetime.fromisoformat(item['timestamp'])
-            formatted_time = timestamp.strftime('%Y-%m-%d %H:%M:%S')
-            
-            # Xử lý payload
-            payload_value = ''
-            payload_unit = ''
-            
-            try:
-                if isinstance(item['payload'], str):
-                    try:
-                        payload_obj = json.loads(item['payload'])
-                        if isinstance(payload_obj, dict):
-                            if 'value' in payload_obj:
-                                payload_value = payload_obj['value']
-                                payload_unit = payload_obj.get('unit', '')
-                            else:
-                                payload_value = json.dumps(payload_obj)
-                        else:
-                            payload_value = item['payload']
-                    except json.JSONDecodeError:
-                        payload_value = item['payload']
-                elif isinstance(item['payload'], dict):
-                    if 'value' in item['payload']:
-                        payload_value = item['payload']['value']
-                        payload_unit = item['payload'].get('unit', '')
-                    else:
-                        payload_value = json.dumps(item['payload'])
-                else:
-                    payload_value = str(item['payload']) if item['payload'] is not None else ''
-            except Exception as e:
-                payload_value = f"Error: {str(e)}"
-            
-            csv_writer.writerow([
-                item['id'],
-                formatted_time,
-                item.get('topic_name', f"Unknown (ID: {item['topic_id']})"),
-                payload_value,
-                payload_unit
-            ])
-        
-        # Tạo response
-        response = make_response(csv_data.getvalue())
-        response.headers["Content-Disposition"] = f"attachment; filename=device_{device_id}_{device['name'].replace(' ', '_')}_data.csv"
-        response.headers["Content-Type"] = "text/csv"
-        
-        return response
+        return _csv_export_response(
+            f"device_{device_id}_{device['name'].replace(' ', '_')}_data.csv",
+            ['ID', 'Timestamp', 'Topic', 'Payload Value', 'Payload Unit'],
+            _telemetry_csv_rows(iter_telemetry(device_id=device_id), ('topic',))
+        )
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
@@ -583,68 +734,16 @@ def export_device_topic_csv(device_id, topic_id):
             return jsonify({"status": "error", "message": "Thiết bị không tồn tại"}), 404
         if not topic:
             return jsonify({"status": "error", "message": "Topic không tồn tại"}), 404
-            
-        # Lấy dữ liệu telemetry cho thiết bị và topic này
-        data = get_device_topic_telemetry_data(device_id, topic_id)
         
-        if not data:
+        # device_latest has a row for every device/topic pair that has data
+        if not get_latest_by_device(device_id=device_id, topic_id=topic_id):
             return jsonify({"status": "error", "message": f"Không có dữ liệu cho thiết bị {device['name']} và topic {topic['name']}"}), 404
         
-        # Tạo file CSV
-        csv_data = io.StringIO()
-        csv_writer = csv.writer(csv_data)
-        
-        # Ghi header
-        csv_writer.writerow(['ID', 'Timestamp', 'Payload Value', 'Payload Unit'])
-        
-        # Ghi dữ liệu
-        for item in data:
-            # Parse with timezone awareness if stored with offset, else it's already VN_TZ
-            timestamp = datetime.fromisoformat(item['timestamp'])
-            formatted_time = timestamp.strftime('%Y-%m-%d %H:%M:%S')
-            
-            # Xử lý payload
-            payload_value = ''
-            payload_unit = ''
-            
-            try:
-                if isinstance(item['payload'], str):
-                    try:
-                        payload_obj = json.loads(item['payload'])
-                        if isinstance(payload_obj, dict):
-                            if 'value' in payload_obj:
-                                payload_value = payload_obj['value']
-                                payload_unit = payload_obj.get('unit', '')
-                            else:
-                                payload_value = json.dumps(payload_obj)
-                        else:
-                            payload_value = item['payload']
-                    except json.JSONDecodeError:
-                        payload_value = item['payload']
-                elif isinstance(item['payload'], dict):
-                    if 'value' in item['payload']:
-                        payload_value = item['payload']['value']
-                        payload_unit = item['payload'].get('unit', '')
-                    else:
-                        payload_value = json.dumps(item['payload'])
-                else:
-                    payload_value = str(item['payload']) if item['payload'] is not None else ''
-            except Exception as e:
-                payload_value = f"Error: {str(e)}"
-            
-            csv_writer.writerow([
-                item['id'],
-                formatted_time,
-                payload_value,
-                payload_unit
-            ])
-        
-        # Tạo response
-        response = make_response(csv_data.getvalue())
-        response.headers["Content-Disposition"] = f"attachment; filename=device_{device_id}_{device['name']}_{topic['name']}_data.csv"
-        response.headers["Content-Type"] = "text/csv"
-        
-        return response
+        return _csv_export_response(
+            f"device_{device_id}_{device['name']}_{topic['name']}_data.csv",
+            ['ID', 'Timestamp', 'Payload Value', 'Payload Unit'],
+            _telemetry_csv_rows(iter_telemetry(device_id=device_id, topic_id=topic_id), ())
+        )
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
@@ -654,79 +753,143 @@ def export_device_topic_csv(device_id, topic_id):
 def export_all_csv():
     """Tạo và trả về file CSV cho tất cả dữ liệu"""
     try:
-        # Lấy toàn bộ dữ liệu telemetry
-        data = get_telemetry_data(limit=1000)  # Giới hạn 1000 bản ghi để tránh quá tải
-        
-        # Tạo file CSV
-        csv_data = io.StringIO()
-        csv_writer = csv.writer(csv_data)
-        
-        # Ghi header
-        csv_writer.writerow(['ID', 'Timestamp', 'Device', 'Topic', 'Payload Value', 'Payload Unit'])
-        
-        # Get all devices and topics for reference
-        devices = {d['id']: d['name'] for d in get_all_devices()}
-        topics = {t['id']: t['name'] for t in get_all_topics()}
-        
-        # Ghi dữ liệu
-        for item in data:
-            # Parse with timezone awareness if stored with offset, else it's already VN_TZ
-            timestamp = datetime.fromisoformat(item['timestamp'])
-            formatted_time = timestamp.strftime('%Y-%m-%d %H:%M:%S')
-            
-            device_name = devices.get(item['device_id'], f"Unknown (ID: {item['device_id']})")
-            topic_name = topics.get(item['topic_id'], f"Unknown (ID: {item['topic_id']})")
-            
-            # Xử lý payload
-            payload_value = ''
-            payload_unit = ''
-            
-            try:
-                # Nếu payload là chuỗi JSON
-                if isinstance(item['payload'], str):
-                    try:
-                        payload_obj = json.loads(item['payload'])
-                        if isinstance(payload_obj, dict):
-                            if 'value' in payload_obj:
-                                payload_value = payload_obj['value']
-                                payload_unit = payload_obj.get('unit', '')
-                            else:
-                                payload_value = json.dumps(payload_obj)
-                        else:
-                            payload_value = item['payload']
-                    except json.JSONDecodeError:
-                        payload_value = item['payload']
-                # Nếu payload đã là dictionary
-                elif isinstance(item['payload'], dict):
-                    if 'value' in item['payload']:
-                        payload_value = item['payload']['value']
-                        payload_unit = item['payload'].get('unit', '')
-                    else:
-                        payload_value = json.dumps(item['payload'])
-                else:
-                    payload_value = str(item['payload']) if item['payload'] is not None else ''
-            except Exception as e:
-                payload_value = f"Error: {str(e)}"
-            
-            csv_writer.writerow([
-                item['id'],
-                formatted_time,
-                device_name,
-                topic_name,
-                payload_value,
-                payload_unit
-            ])
-        
-        # Tạo response
         now_str = datetime.now(VN_TZ).strftime('%Y%m%d_%H%M%S')
-        response = make_response(csv_data.getvalue())
-        response.headers["Content-Disposition"] = f"attachment; filename=all_telemetry_data_{now_str}.csv"
-        response.headers["Content-Type"] = "text/csv"
-        
-        return response
+        return _csv_export_response(
+            f"all_telemetry_data_{now_str}.csv",
+            ['ID', 'Timestamp', 'Device', 'Topic', 'Payload Value', 'Payload Unit'],
+            _telemetry_csv_rows(iter_telemetry(), ('device', 'topic'))
+        )
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+def _export_request_params(scope, args):
+    """
+    Validate the scope and filters of an export request.
+    
+    scope is 'all', 'topic' (needs topic_id) or 'device' (needs device_id,
+    optional topic_id); since and until are optional.
+    
+    Returns:
+        tuple: (params, error_response) where params holds name, device_id,
+            topic_id, since and until, and error_response is None on success
+    """
+    device_id = args.get('device_id', type=int)
+    topic_id = args.get('topic_id', type=int)
+    if scope == 'all':
+        device_id = topic_id = None
+        name = 'all_telemetry_data'
+    elif scope == 'topic':
+        topic = get_topic_by_id(topic_id) if topic_id else None
+        if not topic:
+            return None, (jsonify({"status": "error", "message": "Topic không tồn tại"}), 404)
+        device_id = None
+        name = f"topic_{topic_id}_{topic['name'].replace(' ', '_')}_data"
+    elif scope == 'device':
+        device = get_device_by_id(device_id) if device_id else None
+        if not device:
+            return None, (jsonify({"status": "error", "message": "Thiết bị không tồn tại"}), 404)
+        name = f"device_{device_id}_{device['name'].replace(' ', '_')}_data"
+    else:
+        return None, (jsonify({"status": "error", "message": f"Phạm vi xuất không hợp lệ: {scope}"}), 404)
+    
+    try:
+        since = args.get('since')
+        since = parse_timestamp(since) if since else None
+        until = args.get('until')
+        until = parse_timestamp(until) if until else None
+    except ValueError as e:
+        return None, (jsonify({"status": "error", "message": str(e)}), 400)
+    
+    return {'name': name, 'device_id': device_id, 'topic_id': topic_id,
+            'since': since, 'until': until}, None
+
+# Route for exporting flattened telemetry in columnar or line formats
+@app.route('/api/export/<scope>', methods=['GET'])
+@login_required
+def export_scope(scope):
+    """
+    Export telemetry with payload keys flattened into typed columns.
+    
+    Query parameters: format (csv, ndjson, parquet, arrow), fields (comma
+    separated column projection), device_id/topic_id (see
+    _export_request_params), since, until.
+    """
+    fmt = request.args.get('format', 'csv').lower()
+    params, error = _export_request_params(scope, request.args)
+    if error:
+        return error
+    
+    try:
+        check_format(fmt)
+        fields = resolve_fields(request.args.get('fields'), fmt, params['device_id'],
+                                params['topic_id'], params['since'], params['until'])
+        chunks = iter_export(fmt, fields, params['device_id'], params['topic_id'],
+                             params['since'], params['until'])
+    except ExportError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename={params['name']}.{extension}"
+    return response
+
+# Background export jobs: start, poll, download
+@app.route('/api/export_jobs/<scope>', methods=['POST'])
+@login_required
+def create_export_job(scope):
+    """
+    Start building an export file in the background.
+    
+    Takes the same parameters as /api/export/<scope> (query string or form)
+    and returns the job, whose download is ready once its status is 'done'.
+    """
+    args = request.values
+    params, error = _export_request_params(scope, args)
+    if error:
+        return error
+    
+    try:
+        job = export_jobs.submit(
+            args.get('format', 'csv').lower(), params['name'], fields=args.get('fields'),
+            device_id=params['device_id'], topic_id=params['topic_id'],
+            since=params['since'], until=params['until']
+        )
+    except ExportError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    
+    job['status_url'] = url_for('export_job_status', job_id=job['id'])
+    job['download_url'] = url_for('download_export_job', job_id=job['id'])
+    return jsonify({'job': job}), 202
+
+@app.route('/api/export_jobs/<job_id>', methods=['GET'])
+@login_required
+def export_job_status(job_id):
+    """Report the state and progress of an export job"""
+    job = export_jobs.status(job_id)
+    if not job:
+        return jsonify({"status": "error", "message": "Không tìm thấy tác vụ xuất dữ liệu"}), 404
+    job['download_url'] = url_for('download_export_job', job_id=job_id)
+    return jsonify({'job': job})
+
+@app.route('/api/export_jobs/<job_id>/download', methods=['GET'])
+@login_required
+def download_export_job(job_id):
+    """Download a finished export; supports HTTP Range requests for resuming"""
+    job = export_jobs.status(job_id)
+    if not job:
+        return jsonify({"status": "error", "message": "Không tìm thấy tác vụ xuất dữ liệu"}), 404
+    path = export_jobs.file_path(job_id)
+    if not path or not os.path.exists(path):
+        return jsonify({"status": "error", "message": "Tệp xuất dữ liệu chưa sẵn sàng", "job": job}), 409
+    
+    return send_file(
+        os.path.abspath(path),
+        mimetype=EXPORT_FORMATS[job['format']][0],
+        as_attachment=True,
+        download_name=job['filename'],
+        conditional=True
+    )
+
 # Handle 404 errors
 @app.errorhandler(404)
 def page_not_found(e):
@@ -742,4 +905,6 @@ def unauthorized(e):
     return redirect(url_for('login', next=request.url))
 
 if __name__ == '__main__':
+    # Turn SIGTERM (stop_server.sh) into a normal exit so atexit handlers run
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     app.run(debug=app.config['DEBUG'], host=app.config['HOST'], port=app.config['PORT'])
@@ -0,0 +1,599 @@
+"""
+Benchmarks for the IoT Data Server storage layer.
+
+Every benchmark runs against a throwaway database in a temporary directory,
+never against the configured DATABASE_PATH.
+
+Usage:
+    python benchmark_suite.py                # run all benchmarks
+    python benchmark_suite.py connections    # run selected benchmarks
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+# Point the database module at a scratch file before it is imported
+BENCH_DIR = tempfile.mkdtemp(prefix='iot_bench_')
+os.environ['DATABASE_PATH'] = os.path.join(BENCH_DIR, 'bench.db')
+
+import database  # noqa: E402
+from migrations import telemetry_partition_bounds, telemetry_partition_name  # noqa: E402
+
+# Seeded telemetry starts here (2024-01-01 UTC) and spans less than a day
+SEED_START_MS = 1704067200000
+
+
+def _timed(fn, iterations):
+    """Run fn iterations times and return elapsed seconds."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return time.perf_counter() - start
+
+
+def _report(title, results, iterations):
+    """Print a small comparison table; the first result is the baseline."""
+    print(f"\n{title} ({iterations} iterations)")
+    baseline = results[0][1]
+    for label, elapsed in results:
+        per_op_us = elapsed / iterations * 1e6
+        print(f"  {label:<36} {elapsed:8.3f}s  {per_op_us:9.1f} us/op  x{baseline / elapsed:5.2f}")
+
+
+def _legacy_connection(path):
+    """Open-per-call connection, as get_db_connection() used to do."""
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _seed_clients(conn, count=100):
+    conn.executemany(
+        'INSERT INTO clients (name, api_key) VALUES (?, ?)',
+        [(f'client-{i}', f'key-{i}') for i in range(count)]
+    )
+    conn.commit()
+
+
+def bench_connections(iterations=5000):
+    """Pooled WAL connections vs. opening a rollback-journal connection per call."""
+    with open('schema.sql') as f:
+        schema = f.read()
+
+    # Legacy database: default rollback journal, fresh connection per call
+    legacy_path = os.path.join(BENCH_DIR, 'legacy.db')
+    conn = _legacy_connection(legacy_path)
+    conn.executescript(schema)
+    _seed_clients(conn)
+    conn.close()
+
+    database.init_db()
+    conn = database.get_db_connection()
+    _seed_clients(conn)
+    conn.close()
+
+    def legacy_read():
+        conn = _legacy_connection(legacy_path)
+        conn.execute('SELECT * FROM clients WHERE api_key = ?', ('key-50',)).fetchone()
+        conn.close()
+
+    def pooled_read():
+        conn = database.get_db_connection()
+        conn.execute('SELECT * FROM clients WHERE api_key = ?', ('key-50',)).fetchone()
+        conn.close()
+
+    _report('Point read (SELECT client by api_key)', [
+        ('open-per-call, rollback journal', _timed(legacy_read, iterations)),
+        ('pooled, WAL', _timed(pooled_read, iterations)),
+    ], iterations)
+
+    write_iterations = max(iterations // 10, 1)
+
+    def legacy_write():
+        conn = _legacy_connection(legacy_path)
+        conn.execute('UPDATE clients SET name = name WHERE id = 1')
+        conn.commit()
+        conn.close()
+
+    def pooled_write():
+        conn = database.get_db_connection()
+        conn.execute('UPDATE clients SET name = name WHERE id = 1')
+        conn.commit()
+        conn.close()
+
+    _report('Single-row write + commit', [
+        ('open-per-call, rollback journal', _timed(legacy_write, write_iterations)),
+        ('pooled, WAL, synchronous=NORMAL', _timed(pooled_write, write_iterations)),
+    ], write_iterations)
+
+
+def _seed_telemetry(devices=1000, topics=2, rows_per_device=20, start_ms=SEED_START_MS, interval_ms=1000):
+    """Create one client with the given devices/topics and telemetry rows (one per interval_ms)."""
+    database.init_db()
+    conn = database.get_db_connection()
+    conn.execute('INSERT INTO clients (name, api_key) VALUES (?, ?)', ('bench', database.generate_api_key()))
+    client_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+    conn.executemany(
+        'INSERT INTO devices (name, client_id) VALUES (?, ?)',
+        [(f'device-{i}', client_id) for i in range(devices)]
+    )
+    conn.executemany(
+        'INSERT INTO topics (name, client_id) VALUES (?, ?)',
+        [(f'topic-{i}', client_id) for i in range(topics)]
+    )
+    device_ids = [row[0] for row in conn.execute('SELECT id FROM devices WHERE client_id = ?', (client_id,))]
+    topic_ids = [row[0] for row in conn.execute('SELECT id FROM topics WHERE client_id = ?', (client_id,))]
+    conn.commit()
+    conn.close()
+    database.store_telemetry_batch([
+        (device_id, topic_ids[n % len(topic_ids)], f'{{"value": {n}, "unit": "C"}}', start_ms + n * interval_ms)
+        for device_id in device_ids
+        for n in range(rows_per_device)
+    ])
+
+
+def _seed_partition(start_ms=SEED_START_MS):
+    """Name of the partition table holding the rows seeded from start_ms."""
+    return telemetry_partition_name(telemetry_partition_bounds(start_ms, database.TELEMETRY_PARTITION_PERIOD)[0])
+
+
+def _legacy_device_telemetry_data(topic_id=None, limit_per_device=5):
+    """The former N+1 implementation of get_device_telemetry_data, for comparison."""
+    conn = database.get_db_connection()
+    devices = database.get_all_devices()
+    all_topics = database.get_all_topics()
+    all_clients = database.get_all_clients()
+    device_data = {}
+    for device in devices:
+        query = f'''
+            SELECT t.*, tp.name as topic_name
+            FROM {_seed_partition()} t
+            LEFT JOIN topics tp ON t.topic_id = tp.id
+            WHERE t.device_id = ?
+        '''
+        params = [device['id']]
+        if topic_id is not None:
+            query += ' AND t.topic_id = ?'
+            params.append(topic_id)
+        query += ' ORDER BY t.timestamp DESC LIMIT ?'
+        params.append(limit_per_device)
+        telemetry = [dict(row) for row in conn.execute(query, params).fetchall()]
+        if telemetry:
+            client = next((c for c in all_clients if c['id'] == device['client_id']), None)
+            device_topics = []
+            topic_ids = set()
+            for item in telemetry:
+                if item['topic_id'] not in topic_ids:
+                    topic_ids.add(item['topic_id'])
+                    topic = next((t for t in all_topics if t['id'] == item['topic_id']), None)
+                    if topic:
+                        device_topics.append(topic)
+            device_data[device['id']] = {
+                'device': device, 'client': client, 'topics': device_topics, 'telemetry': telemetry
+            }
+    conn.close()
+    return device_data
+
+
+def _window_device_telemetry_rows(limit_per_device=5):
+    """ROW_NUMBER() over the whole table (rows only, no Python post-processing)."""
+    conn = database.get_db_connection()
+    rows = conn.execute(f'''
+        SELECT * FROM (
+            SELECT t.*, tp.name as topic_name,
+                   ROW_NUMBER() OVER (PARTITION BY t.device_id ORDER BY t.timestamp DESC, t.id DESC) AS row_num
+            FROM {_seed_partition()} t
+            LEFT JOIN topics tp ON t.topic_id = tp.id
+        ) WHERE row_num <= ?
+    ''', (limit_per_device,)).fetchall()
+    conn.close()
+    return rows
+
+
+def bench_device_telemetry(iterations=20, devices=1000):
+    """Single correlated top-k query vs. the former per-device query loop."""
+    _seed_telemetry(devices=devices)
+
+    _report(f'get_device_telemetry_data, {devices} devices, 5 rows each', [
+        ('per-device queries (N+1)', _timed(lambda: _legacy_device_telemetry_data(limit_per_device=5), iterations)),
+        ('single query', _timed(lambda: database.get_device_telemetry_data(limit_per_device=5), iterations)),
+        ('full-table ROW_NUMBER(), rows only', _timed(lambda: _window_device_telemetry_rows(5), iterations)),
+    ], iterations)
+
+    _report(f'get_device_telemetry_data, {devices} devices, topic filter', [
+        ('per-device queries (N+1)', _timed(lambda: _legacy_device_telemetry_data(topic_id=1, limit_per_device=5), iterations)),
+        ('single query', _timed(lambda: database.get_device_telemetry_data(topic_id=1, limit_per_device=5), iterations)),
+    ], iterations)
+
+
+def _topk_latest_rows():
+    """Newest row per device through the correlated top-k query (rows only)."""
+    table = _seed_partition()
+    conn = database.get_db_connection()
+    rows = conn.execute(f'''
+        SELECT t.*, tp.name as topic_name
+        FROM devices d
+        JOIN {table} t ON t.id IN (
+            SELECT id FROM {table} WHERE device_id = d.id ORDER BY timestamp DESC, id DESC LIMIT 1
+        )
+        LEFT JOIN topics tp ON t.topic_id = tp.id
+    ''').fetchall()
+    conn.close()
+    return rows
+
+
+def _device_latest_rows():
+    """Newest row per device/topic from the device_latest table (rows only)."""
+    conn = database.get_db_connection()
+    rows = conn.execute('''
+        SELECT l.*, tp.name as topic_name
+        FROM device_latest l
+        LEFT JOIN topics tp ON l.topic_id = tp.id
+    ''').fetchall()
+    conn.close()
+    return rows
+
+
+def bench_device_latest(iterations=50, devices=1000, rows_per_device=200):
+    """device_latest table vs. the top-k query on the telemetry partition for the newest reading per device."""
+    _seed_telemetry(devices=devices, rows_per_device=rows_per_device)
+
+    _report(f'newest reading per device, {devices} devices x {rows_per_device} rows', [
+        ('top-k query on the partition', _timed(_topk_latest_rows, iterations)),
+        ('device_latest table', _timed(_device_latest_rows, iterations)),
+    ], iterations)
+
+
+def bench_json_response(iterations=200, rows=1000):
+    """Splicing stored payload text into responses vs. json.loads + jsonify per row."""
+    import json
+    from flask import Flask, jsonify
+    import json_codec
+
+    _seed_telemetry(devices=rows // 20, rows_per_device=20)
+    stored = database.get_telemetry_data(limit=rows)
+    app = Flask(__name__)
+
+    def decode_and_jsonify():
+        data = [dict(row) for row in stored]
+        for item in data:
+            item['payload'] = json.loads(item['payload'])
+        return jsonify({'data': data}).get_data()
+
+    def splice():
+        data = [dict(row) for row in stored]
+        return json_codec.json_response({'data': data}, rows=data).get_data()
+
+    def splice_stdlib():
+        codec, json_codec.orjson = json_codec.orjson, None
+        try:
+            return splice()
+        finally:
+            json_codec.orjson = codec
+
+    with app.app_context():
+        results = [
+            ('json.loads + jsonify', _timed(decode_and_jsonify, iterations)),
+            ('spliced payloads, json module', _timed(splice_stdlib, iterations)),
+        ]
+        if json_codec.orjson is not None:
+            results.append(('spliced payloads, orjson', _timed(splice, iterations)))
+    _report(f'JSON response with {rows} telemetry rows', results, iterations)
+
+
+def bench_retention(devices=100, rows_per_device=2000):
+    """Dropping an expired partition vs. deleting the same rows from one big table."""
+    start_ms = 1672531200000  # 2023-01-01, older than the other seeded data
+    _seed_telemetry(devices=devices, rows_per_device=rows_per_device, start_ms=start_ms)
+    table = _seed_partition(start_ms)
+    cutoff = next(p['end_ms'] for p in database.get_telemetry_partitions() if p['name'] == table)
+
+    # The same rows in a single unpartitioned table with the same indexes
+    conn = database.get_db_connection()
+    conn.execute(f'CREATE TABLE legacy_telemetry AS SELECT * FROM {table}')
+    for columns in ('device_id, topic_id, timestamp', 'device_id, timestamp', 'topic_id, timestamp', 'timestamp'):
+        name = 'idx_legacy_' + columns.replace(', ', '_')
+        conn.execute(f'CREATE INDEX {name} ON legacy_telemetry ({columns})')
+    conn.commit()
+    conn.close()
+
+    def delete_rows():
+        conn = database.get_db_connection()
+        conn.execute('DELETE FROM legacy_telemetry WHERE timestamp < ?', (cutoff,))
+        conn.commit()
+        conn.close()
+
+    _report(f'retention of {devices * rows_per_device} expired rows', [
+        ('DELETE from one table', _timed(delete_rows, 1)),
+        ('drop the partition', _timed(lambda: database.drop_telemetry_partitions(cutoff), 1)),
+    ], 1)
+
+
+def bench_rollups(iterations=20, devices=2, days=7):
+    """A week-long chart series from raw rows vs. from the hourly rollup, and the ingest cost of rollups."""
+    import json_codec
+
+    start_ms = 1685577600000  # 2023-06-01, apart from the other seeded data
+    rows_per_device = days * 8640  # one row every 10 seconds
+    _seed_telemetry(devices=devices, topics=1, rows_per_device=rows_per_device,
+                    start_ms=start_ms, interval_ms=10000)
+    until = start_ms + days * 86400000
+    row = database.get_telemetry_data(since=start_ms, until=until, limit=1)[0]
+    device_id, topic_id = row['device_id'], row['topic_id']
+
+    def raw_series():
+        rows = database.get_telemetry_data(device_id=device_id, limit=rows_per_device, since=start_ms, until=until)
+        hours = {}
+        for row in rows:
+            hours.setdefault(row['timestamp_ms'] // 3600000, []).append(json_codec.loads(row['payload'])['value'])
+        return [(hour, sum(values) / len(values)) for hour, values in sorted(hours.items())]
+
+    def rollup_series():
+        return database.get_rollups('value', '1h', device_id=device_id, since=start_ms, until=until)
+
+    _report(f'{days}-day hourly series from {rows_per_device} rows ({len(rollup_series())} buckets)', [
+        ('raw rows, averaged in Python', _timed(raw_series, iterations)),
+        ('rollup_1h table', _timed(rollup_series, iterations)),
+    ], iterations)
+
+    batches = 20
+    next_ms = [until]
+
+    def ingest():
+        database.store_telemetry_batch([
+            (device_id, topic_id, f'{{"value": {n}, "unit": "C"}}', next_ms[0] + n * 1000) for n in range(500)
+        ])
+        next_ms[0] += 500 * 1000
+
+    database.ROLLUP_ON_INGEST = False
+    try:
+        without = _timed(ingest, batches)
+    finally:
+        database.ROLLUP_ON_INGEST = True
+    while database.update_rollups():
+        pass
+    _report('500-row ingest batch', [
+        ('without rollups', without),
+        ('with rollups on ingest', _timed(ingest, batches)),
+    ], batches)
+
+
+def bench_aggregate(iterations=20, devices=2, days=7):
+    """Hourly /api/aggregate buckets served from the rollups, from SQL and (if installed) from NumPy."""
+    import aggregates
+
+    start_ms = 1682899200000  # 2023-05-01, apart from the other seeded data
+    _seed_telemetry(devices=devices, topics=1, rows_per_device=days * 8640,
+                    start_ms=start_ms, interval_ms=10000)
+    until = start_ms + days * 86400000
+    device_id = database.get_telemetry_data(since=start_ms, until=until, limit=1)[0]['device_id']
+
+    def from_rollups():
+        return aggregates.aggregate('value', '1h', 'avg,min,max,count', device_id, since=start_ms, until=until)
+
+    def from_sql():
+        return database.aggregate_telemetry('value', 3600000, device_id, since=start_ms, until=until)
+
+    results = [
+        ('SQL GROUP BY over the partitions', _timed(from_sql, iterations)),
+        (f"aggregate() from {from_rollups()['source']}", _timed(from_rollups, iterations)),
+    ]
+    if aggregates.np is not None:
+        def from_numpy():
+            return aggregates.aggregate('value', '1h', 'avg,p95', device_id, since=start_ms, until=until)
+        results.append(('NumPy (avg, p95)', _timed(from_numpy, iterations)))
+    _report(f'{days}-day hourly aggregate over {days * 8640} rows', results, iterations)
+
+
+def bench_chart_series(iterations=5, points=1000000, threshold=500):
+    """LTTB downsampling of a long series, pure Python vs. NumPy (if installed)."""
+    import math
+    import downsample
+
+    series = [(1700000000000 + n * 1000, math.sin(n / 5000) + (n % 7) * 0.01) for n in range(points)]
+    numpy = downsample.np
+    try:
+        downsample.np = None
+        results = [('pure Python', _timed(lambda: downsample.lttb(series, threshold), iterations))]
+    finally:
+        downsample.np = numpy
+    if numpy is not None:
+        results.append(('NumPy', _timed(lambda: downsample.lttb(series, threshold), iterations)))
+    _report(f'LTTB {points} points down to {threshold}', results, iterations)
+
+
+def bench_typed_values(iterations=5, devices=20, rows_per_device=5000):
+    """Export rows and value filters from the typed value/unit columns vs. parsing every payload."""
+    import exporters
+    import json_codec
+
+    start_ms = 1680307200000  # 2023-04-01, apart from the other seeded data
+    _seed_telemetry(devices=devices, topics=1, rows_per_device=rows_per_device, start_ms=start_ms)
+    until = start_ms + rows_per_device * 1000
+    rows = devices * rows_per_device
+    fields = {'id': 'int', 'timestamp': 'timestamp', 'payload.value': 'float', 'payload.unit': 'string'}
+
+    def parsed_export():
+        for row in database.iter_telemetry(since=start_ms, until=until):
+            exporters.flatten_payload(row['payload'])
+
+    def typed_export():
+        for row in database.iter_telemetry(since=start_ms, until=until):
+            exporters._project(row, fields)
+
+    _report(f'Export value/unit of {rows} rows', [
+        ('json parse per row', _timed(parsed_export, iterations)),
+        ('typed columns', _timed(typed_export, iterations)),
+    ], iterations)
+
+    # Seeded values run 0 .. rows_per_device - 1: the top 0.1% match
+    threshold = rows_per_device * 0.999
+
+    def parsed_filter():
+        return [row for row in database.iter_telemetry(since=start_ms, until=until)
+                if json_codec.loads(row['payload'])['value'] >= threshold]
+
+    def typed_filter():
+        return database.get_telemetry_data(limit=rows, since=start_ms, until=until, min_value=threshold)
+
+    _report(f'value >= {threshold:g} over {rows} rows ({len(typed_filter())} match)', [
+        ('scan + json parse', _timed(parsed_filter, iterations)),
+        ('min_value on the typed column', _timed(typed_filter, iterations)),
+    ], iterations)
+
+
+def bench_topic_schema(iterations=5, devices=20, rows_per_device=5000):
+    """Export column discovery from the payload schema registry vs. scanning every payload, and its ingest cost."""
+    import exporters
+
+    start_ms = 1677628800000  # 2023-03-01, apart from the other seeded data
+    _seed_telemetry(devices=devices, topics=1, rows_per_device=rows_per_device, start_ms=start_ms)
+    until = start_ms + rows_per_device * 1000
+    row = database.get_telemetry_data(since=start_ms, until=until, limit=1)[0]
+    device_id, topic_id = row['device_id'], row['topic_id']
+
+    def scanned_fields():
+        # What discover_fields did before the registry
+        fields = {}
+        for row in database.iter_telemetry(topic_id=topic_id, since=start_ms, until=until):
+            for column, value in exporters.flatten_payload(row['payload']).items():
+                fields[column] = exporters._merge_type(fields.get(column), type(value).__name__)
+        return fields
+
+    def registry_fields():
+        return exporters.discover_fields(topic_id=topic_id, since=start_ms, until=until)
+
+    _report(f'Export columns of {devices * rows_per_device} rows', [
+        ('scan + json parse', _timed(scanned_fields, iterations)),
+        ('schema registry', _timed(registry_fields, iterations)),
+    ], iterations)
+
+    batches = 20
+    next_ms = [until]
+
+    def ingest():
+        database.store_telemetry_batch([
+            (device_id, topic_id, f'{{"value": {n}, "unit": "C"}}', next_ms[0] + n * 1000) for n in range(500)
+        ])
+        next_ms[0] += 500 * 1000
+
+    record = database.record_payload_schema
+    database.record_payload_schema = lambda *args: None
+    try:
+        without = _timed(ingest, batches)
+    finally:
+        database.record_payload_schema = record
+    _report('500-row ingest batch', [
+        ('without the schema registry', without),
+        ('with the schema registry', _timed(ingest, batches)),
+    ], batches)
+
+
+def bench_payload_compression(iterations=5, devices=20, rows_per_device=5000):
+    """Telemetry size and read throughput with payloads stored as JSON text, zlib and zstd."""
+    import compression
+
+    # A database of its own: training and re-compression pass over every topic
+    path = database.DATABASE_PATH
+    database.close_all_db_connections()
+    database.DATABASE_PATH = os.path.join(BENCH_DIR, 'compression.db')
+    codec = database.PAYLOAD_COMPRESSION
+    try:
+        database.PAYLOAD_COMPRESSION = 'none'
+        database.init_db()
+        client_id, _ = database.create_client('bench')
+        topic_id = database.create_topic('sensors', '', client_id)
+        device_ids = [database.create_device(f'device-{i}', '', client_id) for i in range(devices)]
+        statuses = ('ok', 'ok', 'ok', 'warn')
+        database.store_telemetry_batch([
+            (device_id, topic_id,
+             f'{{"temperature": {20 + n % 97 / 10}, "humidity": {40 + n % 31}, "pressure": {1000 + n % 251 / 10}, '
+             f'"battery": {100 - n % 100}, "rssi": {-60 - n % 37}, "status": "{statuses[n % 4]}", '
+             f'"firmware": "2.4.1", "location": {{"building": "B2", "floor": {device_id % 5}}}, '
+             f'"value": {n % 1000 / 10}, "unit": "C"}}',
+             SEED_START_MS + n * 1000)
+            for device_id in device_ids
+            for n in range(rows_per_device)
+        ])
+        table = _seed_partition()
+        until = SEED_START_MS + rows_per_device * 1000
+
+        def read_all():
+            for _ in database.iter_telemetry(topic_id=topic_id):
+                pass
+
+        def read_page():
+            database.get_telemetry_data(topic_id=topic_id, limit=1000, since=SEED_START_MS, until=until)
+
+        def aggregate():
+            database.aggregate_telemetry('temperature', 3600 * 1000, topic_id=topic_id, since=SEED_START_MS, until=until)
+
+        sizes = []
+        results = {'iter_telemetry (all rows)': [], 'get_telemetry_data (1000 rows)': [],
+                   'aggregate_telemetry (json field)': []}
+        for encoding in ['none', 'zlib'] + (['zstd'] if compression.zstd is not None else []):
+            database.PAYLOAD_COMPRESSION = encoding
+            database._topic_dictionary_cache.invalidate(topic_id)
+            database.sync_payload_codec()
+            started = time.perf_counter()
+            database.train_payload_dictionaries(min_rows=1)
+            while database.recompress_payloads():
+                pass
+            elapsed = time.perf_counter() - started
+            conn = database.get_db_connection()
+            conn.execute('VACUUM')
+            table_bytes = conn.execute('SELECT SUM(pgsize) FROM dbstat WHERE name = ?', (table,)).fetchone()[0]
+            conn.close()
+            label = 'JSON text' if encoding == 'none' else encoding
+            sizes.append((label, table_bytes, elapsed))
+            results['iter_telemetry (all rows)'].append((label, _timed(read_all, iterations)))
+            results['get_telemetry_data (1000 rows)'].append((label, _timed(read_page, iterations)))
+            results['aggregate_telemetry (json field)'].append((label, _timed(aggregate, iterations)))
+
+        print(f"\nTelemetry table size ({devices * rows_per_device} rows, after VACUUM)")
+        for label, table_bytes, elapsed in sizes:
+            print(f"  {label:<36} {table_bytes / 1024 / 1024:8.2f} MiB  {table_bytes / (devices * rows_per_device):6.1f} B/row"
+                  f"  x{sizes[0][1] / table_bytes:5.2f}  (re-encoded in {elapsed:.2f}s)")
+        for title, timings in results.items():
+            _report(title, timings, iterations)
+    finally:
+        database.PAYLOAD_COMPRESSION = codec
+        database.close_all_db_connections()
+        database.DATABASE_PATH = path
+
+
+BENCHMARKS = {
+    'connections': bench_connections,
+    'device_telemetry': bench_device_telemetry,
+    'device_latest': bench_device_latest,
+    'json_response': bench_json_response,
+    'retention': bench_retention,
+    'rollups': bench_rollups,
+    'aggregate': bench_aggregate,
+    'chart_series': bench_chart_series,
+    'typed_values': bench_typed_values,
+    'topic_schema': bench_topic_schema,
+    'payload_compression': bench_payload_compression,
+}
+
+
+def run_benchmarks(names=None):
+    """Run the named benchmarks (all of them by default)."""
+    for name in names or BENCHMARKS:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name}. Available: {', '.join(BENCHMARKS)}")
+            continue
+        print(f"=== {name} ===")
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    print("=== IoT Data Server Benchmarks ===")
+    try:
+        run_benchmarks(sys.argv[1:])
+    finally:
+        database.close_all_db_connections()
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
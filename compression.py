@@ -0,0 +1,220 @@
+"""
+Compressed encoding of stored telemetry payloads.
+
+With PAYLOAD_COMPRESSION set to 'zstd' or 'zlib', payloads are stored as
+BLOBs compressed with a dictionary trained per topic from its own payloads,
+so the keys every message repeats cost a few bytes instead of being stored
+in full each time. Payloads stay JSON TEXT when compression is off, until
+their topic has a dictionary, or when compressing would not make them
+smaller; both kinds can live side by side in a partition.
+
+A compressed payload starts with a codec byte and the dictionary ID (as a
+varint), followed by the compressed data:
+
+    zstd: a magicless zstd frame made with a trained dictionary
+    zlib: a raw deflate stream with the dictionary as preset (zdict)
+
+zstd needs the optional zstandard package (pip install zstandard); without
+it 'zstd' falls back to zlib. Dictionaries are never changed once written,
+so each one is loaded at most once per process.
+"""
+import os
+import threading
+import zlib
+from dotenv import load_dotenv
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+# Load environment variables
+load_dotenv()
+
+# 'none', 'zstd' or 'zlib' (zlib is also used when zstd is asked for but
+# the zstandard package is missing)
+PAYLOAD_COMPRESSION = os.getenv('PAYLOAD_COMPRESSION', 'none').lower()
+if PAYLOAD_COMPRESSION == 'zstd' and zstd is None:
+    print("PAYLOAD_COMPRESSION=zstd needs the zstandard package (pip install zstandard); using zlib")
+    PAYLOAD_COMPRESSION = 'zlib'
+if PAYLOAD_COMPRESSION not in ('none', 'zstd', 'zlib'):
+    print(f"Unknown PAYLOAD_COMPRESSION {PAYLOAD_COMPRESSION!r}; payloads are stored uncompressed")
+    PAYLOAD_COMPRESSION = 'none'
+
+# Compression level (default 3 for zstd, 6 for zlib)
+PAYLOAD_COMPRESSION_LEVEL = os.getenv('PAYLOAD_COMPRESSION_LEVEL')
+# Dictionary size in bytes (zlib uses at most 32 KiB)
+PAYLOAD_DICT_SIZE = int(os.getenv('PAYLOAD_DICT_SIZE', 16384))
+# Newest payloads of a topic a dictionary is built from; a topic gets its
+# dictionary once it has at least PAYLOAD_DICT_MIN_ROWS rows
+PAYLOAD_DICT_SAMPLES = int(os.getenv('PAYLOAD_DICT_SAMPLES', 2000))
+PAYLOAD_DICT_MIN_ROWS = int(os.getenv('PAYLOAD_DICT_MIN_ROWS', 1000))
+
+# Codec byte at the start of a compressed payload
+CODEC_IDS = {'zlib': 1, 'zstd': 2}
+_CODEC_NAMES = {codec_id: name for name, codec_id in CODEC_IDS.items()}
+
+_ZLIB_MAX_DICT = 32768
+
+class UnknownDictionaryError(KeyError):
+    """Raised when a payload needs a dictionary that has not been loaded."""
+
+# dictionary ID -> (codec, data); written once, read from many threads
+_dictionaries = {}
+# Compressor/decompressor objects are not thread-safe: one set per thread
+_local = threading.local()
+
+def compression_level(codec):
+    """The configured compression level for codec."""
+    if PAYLOAD_COMPRESSION_LEVEL:
+        return int(PAYLOAD_COMPRESSION_LEVEL)
+    return 3 if codec == 'zstd' else 6
+
+def train_dictionary(codec, samples, size=PAYLOAD_DICT_SIZE):
+    """
+    Build a compression dictionary from sample payloads.
+
+    Args:
+        codec (str): 'zstd' or 'zlib'
+        samples (list): Payloads (JSON text), newest first
+        size (int, optional): Dictionary size in bytes
+
+    Returns:
+        bytes: The dictionary
+
+    Raises:
+        ValueError: If the samples are too few or too small to train on
+    """
+    encoded = [sample.encode('utf-8') for sample in samples]
+    if codec == 'zstd':
+        try:
+            return zstd.train_dictionary(size, encoded, level=compression_level(codec)).as_bytes()
+        except zstd.ZstdError as e:
+            raise ValueError(f"Cannot train a zstd dictionary: {e}")
+    # A preset deflate dictionary is plain content that later input can
+    # refer back to; the end of it is the cheapest to refer to, so the
+    # newest distinct payloads go last
+    data = b''
+    for sample in dict.fromkeys(encoded):
+        if len(data) + len(sample) > min(size, _ZLIB_MAX_DICT):
+            break
+        data = sample + data
+    if not data:
+        raise ValueError("Cannot build a zlib dictionary: no samples")
+    return data
+
+def add_dictionary(dict_id, codec, data):
+    """Make a stored dictionary available for compressing and decompressing."""
+    _dictionaries[dict_id] = (codec, data)
+
+def has_dictionary(dict_id):
+    """Return True if the dictionary has been loaded."""
+    return dict_id in _dictionaries
+
+def _codec_objects(dict_id):
+    """This thread's compressor and decompressor for a dictionary."""
+    cache = getattr(_local, 'codecs', None)
+    if cache is None:
+        cache = _local.codecs = {}
+    objects = cache.get(dict_id)
+    if objects is not None:
+        return objects
+    if dict_id not in _dictionaries:
+        raise UnknownDictionaryError(dict_id)
+    codec, data = _dictionaries[dict_id]
+    level = compression_level(codec)
+    if codec == 'zstd':
+        if zstd is None:
+            raise RuntimeError("Payloads compressed with zstd need the zstandard package (pip install zstandard)")
+        dictionary = zstd.ZstdCompressionDict(data)
+        params = zstd.ZstdCompressionParameters.from_level(
+            level, format=zstd.FORMAT_ZSTD1_MAGICLESS,
+            write_checksum=0, write_content_size=1, write_dict_id=0
+        )
+        objects = (
+            zstd.ZstdCompressor(dict_data=dictionary, compression_params=params).compress,
+            zstd.ZstdDecompressor(dict_data=dictionary, format=zstd.FORMAT_ZSTD1_MAGICLESS).decompress,
+        )
+    else:
+        # Priming a deflate stream with the dictionary is the costly part:
+        # do it once and copy the primed stream for every payload
+        primed = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=data)
+
+        def compress(raw):
+            stream = primed.copy()
+            return stream.compress(raw) + stream.flush()
+
+        def decompress(compressed):
+            stream = zlib.decompressobj(-15, zdict=data)
+            return stream.decompress(compressed) + stream.flush()
+
+        objects = (compress, decompress)
+    cache[dict_id] = objects
+    return objects
+
+def compress_payload(payload, dict_id):
+    """
+    Compress a payload with a loaded dictionary.
+
+    Args:
+        payload (str): The payload's JSON text
+        dict_id (int): Dictionary to compress with
+
+    Returns:
+        bytes or str: The compressed payload, or the payload itself if
+            compressing does not make it smaller
+    """
+    compress, _ = _codec_objects(dict_id)
+    codec_id = CODEC_IDS[_dictionaries[dict_id][0]]
+    raw = payload.encode('utf-8')
+    compressed = _header(codec_id, dict_id) + compress(raw)
+    return compressed if len(compressed) < len(raw) else payload
+
+def decompress_payload(stored):
+    """
+    Turn a stored payload back into its JSON text.
+
+    Args:
+        stored (str or bytes): The payload as stored
+
+    Returns:
+        str: The JSON text
+
+    Raises:
+        UnknownDictionaryError: If its dictionary has not been loaded
+    """
+    if not isinstance(stored, bytes):
+        return stored
+    if stored[0] not in _CODEC_NAMES:
+        raise ValueError(f"Unknown payload codec: {stored[0]}")
+    dict_id, start = _read_varint(stored, 1)
+    _, decompress = _codec_objects(dict_id)
+    return decompress(stored[start:]).decode('utf-8')
+
+def payload_dictionary_id(stored):
+    """The dictionary a stored payload was compressed with (None for JSON text)."""
+    if not isinstance(stored, bytes):
+        return None
+    return _read_varint(stored, 1)[0]
+
+def _header(codec_id, dict_id):
+    """Codec byte followed by the dictionary ID as an unsigned LEB128 varint."""
+    header = bytearray([codec_id])
+    while True:
+        byte = dict_id & 0x7f
+        dict_id >>= 7
+        if not dict_id:
+            header.append(byte)
+            return bytes(header)
+        header.append(byte | 0x80)
+
+def _read_varint(data, position):
+    """Decode the varint at data[position:]; return (value, position after it)."""
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
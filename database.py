@@ -1,10 +1,25 @@
+import base64
 import sqlite3
+import threading
+import time
 import uuid
 import json
 import os
 from datetime import datetime
 from dotenv import load_dotenv
 import pytz
+from cache import TTLCache, MISSING
+from json_codec import encode_payload
+from migrations import (
+    SCHEMA_VERSION, run_migrations, set_schema_version,
+    telemetry_partition_bounds, create_telemetry_partition, ROLLUP_RESOLUTIONS,
+    PAYLOAD_VALUE_SQL, PAYLOAD_UNIT_SQL, PAYLOAD_TEXT_SQL, record_payload_schema
+)
+import compression
+from compression import (
+    PAYLOAD_COMPRESSION, CODEC_IDS, UnknownDictionaryError,
+    add_dictionary, compress_payload, decompress_payload, train_dictionary
+)
 
 # Load environment variables
 load_dotenv()
@@ -15,21 +30,236 @@ VN_TZ = pytz.timezone('Asia/Ho_Chi_Minh')
 # Get database path from environment variable or use default
 DATABASE_PATH = os.getenv('DATABASE_PATH', 'data.db')
 
+# API key -> client cache. Unknown keys are cached as None for a shorter
+# time so floods of invalid keys do not reach the database.
+API_KEY_NEGATIVE_TTL = float(os.getenv('API_KEY_NEGATIVE_TTL', 10))
+_api_key_cache = TTLCache(
+    max_size=int(os.getenv('API_KEY_CACHE_SIZE', 1024)),
+    ttl=float(os.getenv('API_KEY_CACHE_TTL', 300))
+)
+
+# (client_id, name) -> id caches used by the ingest get-or-create resolvers
+_device_id_cache = TTLCache(
+    max_size=int(os.getenv('RESOLVER_CACHE_SIZE', 10000)),
+    ttl=float(os.getenv('RESOLVER_CACHE_TTL', 3600))
+)
+_topic_id_cache = TTLCache(
+    max_size=int(os.getenv('RESOLVER_CACHE_SIZE', 10000)),
+    ttl=float(os.getenv('RESOLVER_CACHE_TTL', 3600))
+)
+
+# topic_id -> dictionary new payloads of the topic are compressed with (None
+# while it has none). Short-lived, so dictionaries trained by another process
+# are picked up within a minute.
+_topic_dictionary_cache = TTLCache(
+    max_size=int(os.getenv('RESOLVER_CACHE_SIZE', 10000)),
+    ttl=60
+)
+
+# SQLite connection tuning (see https://www.sqlite.org/pragma.html)
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 268435456))
+SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', -20000))  # negative = KiB
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 8))
+
+# Rows fetched per round trip when streaming exports
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 1000))
+
+# Telemetry partitions: new partition tables cover one UTC 'day' or 'month'.
+# With TELEMETRY_RETENTION_DAYS > 0, partitions whose rows are all older than
+# that are dropped whole (0 keeps everything).
+TELEMETRY_PARTITION_PERIOD = os.getenv('TELEMETRY_PARTITION_PERIOD', 'month')
+TELEMETRY_RETENTION_DAYS = float(os.getenv('TELEMETRY_RETENTION_DAYS', 0))
+
+# Roll each ingested batch up in its own transaction while the rollups are
+# current; when off, the catch-up job (rollups.py) does all the work
+ROLLUP_ON_INGEST = os.getenv('ROLLUP_ON_INGEST', 'True').lower() in ('true', '1', 't')
+
+class PooledConnection(sqlite3.Connection):
+    """
+    A long-lived SQLite connection owned by the connection pool.
+
+    Callers keep using the open/close pattern: close() only ends the
+    caller's checkout and hands the connection back to the pool.
+    """
+
+    def close(self):
+        _pool.release(self)
+
+class ConnectionPool:
+    """
+    Pool of persistent SQLite connections with per-thread checkout.
+
+    A thread keeps the same connection for nested get_db_connection() calls
+    until the outermost caller closes it. Released connections have any open
+    transaction rolled back and are kept idle for reuse (up to max_idle).
+    """
+
+    def __init__(self, max_idle=DB_POOL_SIZE):
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.opened = 0
+        self.reused = 0
+
+    def acquire(self):
+        """Return this thread's connection, checking one out if needed."""
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is not None:
+            local.depth += 1
+            return conn
+
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+            if conn is not None:
+                self.reused += 1
+        if conn is None:
+            conn = self._open()
+
+        local.conn = conn
+        local.depth = 1
+        return conn
+
+    def release(self, conn):
+        """End one checkout of conn; the outermost release returns it to the pool."""
+        local = self._local
+        if getattr(local, 'conn', None) is not conn:
+            # Already released (e.g. closed twice on an error path)
+            return
+        local.depth -= 1
+        if local.depth <= 0:
+            self._checkin(conn)
+
+    def release_thread(self):
+        """Return the calling thread's connection regardless of nesting depth."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._checkin(conn)
+
+    def close_all(self):
+        """Close every idle connection (checked-out ones are closed on release)."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self.max_idle = 0
+        for conn in idle:
+            sqlite3.Connection.close(conn)
+
+    def stats(self):
+        """Return pool counters."""
+        with self._lock:
+            return {'opened': self.opened, 'reused': self.reused, 'idle': len(self._idle)}
+
+    def _checkin(self, conn):
+        self._local.conn = None
+        self._local.depth = 0
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error as e:
+            print(f"Discarding broken database connection: {e}")
+            sqlite3.Connection.close(conn)
+            return
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        sqlite3.Connection.close(conn)
+
+    def _open(self):
+        conn = sqlite3.connect(
+            DATABASE_PATH,
+            timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,  # idle connections move between threads
+            factory=PooledConnection
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute(f'PRAGMA journal_mode={SQLITE_JOURNAL_MODE}')
+        conn.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+        conn.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS:d}')
+        conn.execute('PRAGMA foreign_keys=ON')
+        conn.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE:d}')
+        conn.execute(f'PRAGMA cache_size={SQLITE_CACHE_SIZE:d}')
+        # Decodes compressed payloads inside queries (see PAYLOAD_TEXT_SQL)
+        conn.create_function('payload_text', 1, _payload_text, deterministic=True)
+        with self._lock:
+            self.opened += 1
+        return conn
+
+_pool = ConnectionPool()
+
+# Last payload decoded by payload_text(): queries that read several fields
+# of a row (e.g. json_type then json_extract) decode it only once
+_last_decoded = (None, None)
+
+def _payload_text(stored):
+    """SQL function payload_text(): the JSON text of a compressed payload."""
+    global _last_decoded
+    last = _last_decoded
+    if last[0] == stored:
+        return last[1]
+    try:
+        text = decompress_payload(stored)
+    except UnknownDictionaryError as e:
+        _load_payload_dictionary(e.args[0])
+        text = decompress_payload(stored)
+    _last_decoded = (stored, text)
+    return text
+
+def _load_payload_dictionary(dict_id):
+    """
+    Load a payload dictionary written by another connection or process.
+
+    Called from inside payload_text() while a statement is running, so it
+    reads through a connection of its own.
+    """
+    conn = sqlite3.connect(DATABASE_PATH, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+    try:
+        row = conn.execute('SELECT codec, data FROM payload_dictionaries WHERE id = ?', (dict_id,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        raise ValueError(f"Payload dictionary {dict_id} does not exist")
+    add_dictionary(dict_id, row[0], row[1])
+
 def get_db_connection():
-    """Create a connection to the SQLite database."""
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Get a pooled connection to the SQLite database (release it with conn.close())."""
+    return _pool.acquire()
+
+def release_db_connection(exception=None):
+    """Return the calling thread's connection to the pool (request/thread teardown)."""
+    _pool.release_thread()
+
+def close_all_db_connections():
+    """Close all pooled connections at shutdown."""
+    _pool.release_thread()
+    _pool.close_all()
 
 def init_db():
-    """Initialize the database with the schema."""
-    if not os.path.exists(DATABASE_PATH):
-        conn = get_db_connection()
-        with open('schema.sql') as f:
-            conn.executescript(f.read())
-        conn.commit()
+    """Initialize the database with the schema, or upgrade an existing one."""
+    conn = get_db_connection()
+    try:
+        has_schema = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'clients'"
+        ).fetchone()
+        if not has_schema:
+            # schema.sql always describes the latest schema version
+            with open('schema.sql') as f:
+                conn.executescript(f.read())
+            set_schema_version(conn, SCHEMA_VERSION)
+            conn.commit()
+            print(f"Database initialized at {DATABASE_PATH}")
+        else:
+            applied = run_migrations(conn)
+            if applied:
+                print(f"Database at {DATABASE_PATH} upgraded to schema version {SCHEMA_VERSION}")
+    finally:
         conn.close()
-        print(f"Database initialized at {DATABASE_PATH}")
+    sync_payload_codec()
+    drop_expired_telemetry_partitions()
 
 def generate_api_key():
     """Generate a unique API key."""
@@ -46,16 +276,32 @@ def create_client(name, api_key=None):
     conn.commit()
     client_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
     conn.close()
+    # The key may have been negatively cached before the client existed
+    _api_key_cache.invalidate(api_key)
     return client_id, api_key
 
 def get_client_by_api_key(api_key):
-    """Get a client by their API key."""
-    conn = get_db_connection()
-    client = conn.execute('SELECT * FROM clients WHERE api_key = ?',
-                        (api_key,)).fetchone()
-    conn.close()
+    """Get a client by their API key (served from the API key cache when possible)."""
+    client = _api_key_cache.get(api_key)
+    if client is MISSING:
+        conn = get_db_connection()
+        row = conn.execute('SELECT * FROM clients WHERE api_key = ?',
+                           (api_key,)).fetchone()
+        conn.close()
+        client = dict(row) if row else None
+        _api_key_cache.set(api_key, client, ttl=None if client else API_KEY_NEGATIVE_TTL)
     return dict(client) if client else None
 
+def get_cache_stats():
+    """Get hit/miss counters for the in-memory lookup caches."""
+    return {
+        'db_pool': _pool.stats(),
+        'api_key': _api_key_cache.stats(),
+        'device_id': _device_id_cache.stats(),
+        'topic_id': _topic_id_cache.stats(),
+        'payload_dictionary': _topic_dictionary_cache.stats()
+    }
+
 def get_all_clients():
     """Get all clients."""
     conn = get_db_connection()
@@ -97,6 +343,9 @@ def delete_client(client_id):
         
         # Commit the transaction
         conn.commit()
+        _api_key_cache.invalidate(client['api_key'])
+        _device_id_cache.invalidate_where(lambda key, _: key[0] == client_id)
+        _topic_id_cache.invalidate_where(lambda key, _: key[0] == client_id)
         print(f"Successfully deleted client ID {client_id} and all associated data")
         return True
     except sqlite3.Error as e:
@@ -139,6 +388,9 @@ def update_client_api_key(client_id, new_api_key):
         
         # Commit the transaction
         conn.commit()
+        # Drop both the old key and any negative entry for the new one
+        _api_key_cache.invalidate(client['api_key'])
+        _api_key_cache.invalidate(new_api_key)
         print(f"Successfully updated API key for client ID {client_id}")
         return True
     except sqlite3.Error as e:
@@ -246,6 +498,7 @@ def delete_topic(topic_id, client_id=None):
         
         # Commit the transaction
         conn.commit()
+        _topic_id_cache.invalidate((topic['client_id'], topic['name']))
         print(f"Successfully deleted topic ID {topic_id}")
         return True
     except sqlite3.Error as e:
@@ -301,7 +554,7 @@ def update_device_last_seen(device_id):
     try:
         conn.execute(
             'UPDATE devices SET last_seen = ? WHERE id = ?',
-            (datetime.now(VN_TZ).isoformat(), device_id)
+            (format_timestamp(now_ms()), device_id)
         )
         conn.commit()
         return True
@@ -357,6 +610,7 @@ def delete_device(device_id, client_id=None):
         
         # Commit the transaction
         conn.commit()
+        _device_id_cache.invalidate((device['client_id'], device['name']))
         print(f"Successfully deleted device ID {device_id}")
         return True
     except sqlite3.Error as e:
@@ -366,242 +620,1871 @@ def delete_device(device_id, client_id=None):
     finally:
         conn.close()
 
-# Telemetry data operations
-def store_telemetry_data(device_id, topic_id, payload):
+# Ingest name -> ID resolution
+def resolve_device_id(client_id, device_name):
     """
-    Store telemetry data from a device with improved error handling and validation.
-    
+    Resolve a device name to its ID, auto-creating the device if needed.
+
     Args:
-        device_id (int): ID of the device sending data
-        topic_id (int): ID of the topic the data belongs to
-        payload (dict or str): The data payload to store
-        
+        client_id (int): ID of the client that owns the device
+        device_name (str): Name of the device
+
     Returns:
-        bool: True if data was stored successfully, False otherwise
+        int or None: The device ID, or None if it could not be resolved
     """
-    if not device_id or not topic_id:
-        print("Error: device_id and topic_id must be provided for telemetry data")
-        return False
-        
-    # Store as JSON string if payload is dictionary
-    if isinstance(payload, dict):
-        try:
-            payload = json.dumps(payload)
-        except (TypeError, ValueError) as e:
-            print(f"Error converting payload to JSON: {e}")
-            return False
-    
-    # Validate payload is a string at this point
-    if not isinstance(payload, str):
-        print(f"Error: payload must be a string or dictionary, got {type(payload)}")
-        return False
-    
+    return _resolve_id(_device_id_cache, 'devices', 'device', client_id, device_name)
+
+def resolve_topic_id(client_id, topic_name):
+    """
+    Resolve a topic name to its ID, auto-creating the topic if needed.
+
+    Args:
+        client_id (int): ID of the client that owns the topic
+        topic_name (str): Name of the topic
+
+    Returns:
+        int or None: The topic ID, or None if it could not be resolved
+    """
+    return _resolve_id(_topic_id_cache, 'topics', 'topic', client_id, topic_name)
+
+def _resolve_id(cache, table, kind, client_id, name):
+    """Get-or-create a (client_id, name) row in devices or topics, cached in memory."""
+    key = (client_id, name)
+    entity_id = cache.get(key)
+    if entity_id is not MISSING:
+        return entity_id
+
     conn = get_db_connection()
     try:
-        # Begin transaction
-        conn.execute('BEGIN TRANSACTION')
-        
-        # Verify device exists
-        device = conn.execute('SELECT * FROM devices WHERE id = ?', (device_id,)).fetchone()
-        if not device:
-            print(f"Error: device with ID {device_id} does not exist")
-            conn.rollback()
-            return False
-            
-        # Verify topic exists
-        topic = conn.execute('SELECT * FROM topics WHERE id = ?', (topic_id,)).fetchone()
-        if not topic:
-            print(f"Error: topic with ID {topic_id} does not exist")
-            conn.rollback()
-            return False
-        
-        # Store the telemetry data
-        conn.execute(
-            'INSERT INTO telemetry_data (device_id, topic_id, payload) VALUES (?, ?, ?)',
-            (device_id, topic_id, payload)
-        )
-        
-        # Update device's last_seen timestamp
-        conn.execute(
-            'UPDATE devices SET last_seen = ? WHERE id = ?',
-            (datetime.now(VN_TZ).isoformat(), device_id)
-        )
-        
-        # Commit the transaction
-        conn.commit()
-        return True
+        row = conn.execute(
+            f'SELECT id FROM {table} WHERE name = ? AND client_id = ?',
+            (name, client_id)
+        ).fetchone()
+        if not row:
+            # The UNIQUE(name, client_id) constraint makes concurrent creates safe:
+            # the loser of a race inserts nothing and reads the winner's row.
+            cursor = conn.execute(
+                f'INSERT INTO {table} (name, description, client_id) VALUES (?, ?, ?) '
+                'ON CONFLICT(name, client_id) DO NOTHING',
+                (name, f"Auto-created {kind} for {name}", client_id)
+            )
+            created = cursor.rowcount == 1
+            row = conn.execute(
+                f'SELECT id FROM {table} WHERE name = ? AND client_id = ?',
+                (name, client_id)
+            ).fetchone()
+            conn.commit()
+            if created:
+                print(f"Auto-created {kind}: {name} with ID: {row['id']}")
     except sqlite3.Error as e:
-        print(f"Database error when storing telemetry data: {e}")
+        print(f"Error resolving {kind} '{name}': {e}")
         conn.rollback()
-        return False
+        return None
     finally:
         conn.close()
 
-def get_telemetry_data(device_id=None, topic_id=None, limit=100):
-    """Get telemetry data, optionally filtered by device_id and/or topic_id."""
+    if not row:
+        return None
+    cache.set(key, row['id'])
+    return row['id']
+
+# Telemetry data operations
+# Telemetry partition router. Rows live in one table per time period (see
+# TELEMETRY_PARTITION_DDL in migrations.py); the catalog is cached per process
+# and reloaded whenever PRAGMA schema_version shows that a partition was
+# created or dropped by any connection (or DATABASE_PATH was changed).
+_partition_cache = (None, [])
+
+def _telemetry_partitions(conn):
+    """Return the partition catalog as (name, start_ms, end_ms) tuples, oldest first."""
+    global _partition_cache
+    version = (DATABASE_PATH, conn.execute('PRAGMA schema_version').fetchone()[0])
+    cached_version, partitions = _partition_cache
+    if cached_version != version:
+        partitions = [tuple(row) for row in conn.execute(
+            'SELECT name, start_ms, end_ms FROM telemetry_partitions ORDER BY start_ms'
+        )]
+        # Partitions created by an uncommitted transaction may still be rolled back
+        if not conn.in_transaction:
+            _partition_cache = (version, partitions)
+    return partitions
+
+def _partitions_in_range(conn, since=None, until=None):
+    """Names of the partitions that can hold rows in [since, until), newest first."""
+    return [name for name, start_ms, end_ms in reversed(_telemetry_partitions(conn))
+            if (since is None or end_ms > since) and (until is None or start_ms < until)]
+
+def _partitions_after_id(conn, since_id):
+    """
+    Names of the partitions holding rows with an ID above since_id, newest first.
+
+    Every partition is checked (one MAX(id) rowid lookup each): IDs are
+    allocated when a row is written but timestamps are taken when it is
+    received, so a queued row received just before a partition boundary
+    can get a higher ID than rows already written to the newer partition.
+    """
+    names = []
+    for name in _partitions_in_range(conn):
+        rows = _query_partition(conn, f'SELECT MAX(id) FROM {name}')
+        max_id = rows[0][0] if rows else None
+        if max_id is not None and max_id > since_id:
+            names.append(name)
+    return names
+
+def _query_partition(conn, query, params=()):
+    """Run a query on one partition; a partition dropped since the catalog was read reads as empty."""
+    try:
+        return conn.execute(query, params).fetchall()
+    except sqlite3.OperationalError as e:
+        if 'no such table' not in str(e):
+            raise
+        return []
+
+def _partition_for(conn, timestamp):
+    """
+    Return the partition that stores a timestamp, creating it if needed.
+
+    Must be called inside a write transaction. A new partition covers the
+    TELEMETRY_PARTITION_PERIOD around the timestamp, narrowed so it does not
+    overlap existing partitions (e.g. after the period setting was changed).
+
+    Returns:
+        tuple: (name, start_ms, end_ms, created)
+    """
+    start_ms, end_ms = telemetry_partition_bounds(timestamp, TELEMETRY_PARTITION_PERIOD)
+    for name, partition_start, partition_end in _telemetry_partitions(conn):
+        if partition_start <= timestamp < partition_end:
+            return name, partition_start, partition_end, False
+        if partition_end <= timestamp:
+            start_ms = max(start_ms, partition_end)
+        else:
+            end_ms = min(end_ms, partition_start)
+    name = create_telemetry_partition(conn, start_ms, end_ms)
+    print(f"Created telemetry partition {name}")
+    return name, start_ms, end_ms, True
+
+def _insert_telemetry(conn, rows):
+    """
+    Write telemetry rows to their partitions inside the caller's write transaction.
+
+    Row IDs are taken from the ('telemetry_id', 0) stats counter in row
+    order, so they keep growing across partitions. Rows referencing a device
+    or topic that no longer exists are skipped.
+
+    Args:
+        rows (list): Tuples of (device_id, topic_id, payload, timestamp)
+
+    Returns:
+        tuple: (rows written, whether a partition was created)
+    """
+    last_id = conn.execute('''
+        UPDATE stats SET row_count = row_count + ?
+        WHERE scope = 'telemetry_id' AND scope_id = 0
+        RETURNING row_count
+    ''', (len(rows),)).fetchall()[0][0]
+
+    inserts = {}
+    created = False
+    partition = None
+    for row_id, (device_id, topic_id, payload, timestamp) in enumerate(rows, last_id - len(rows) + 1):
+        if partition is None or not partition[1] <= timestamp < partition[2]:
+            partition = _partition_for(conn, timestamp)
+            created = created or partition[3]
+        dict_id = _topic_dictionary(conn, topic_id) if PAYLOAD_COMPRESSION != 'none' else None
+        stored = compress_payload(payload, dict_id) if dict_id else payload
+        inserts.setdefault(partition[0], []).append((row_id, device_id, topic_id, stored, timestamp, payload))
+
+    written = 0
+    for table, values in inserts.items():
+        # The EXISTS checks replace the per-message device/topic SELECTs;
+        # value/unit are extracted in SQL from the payload text (?6), which
+        # is stored (?4) compressed when its topic has a dictionary
+        written += conn.executemany(f'''
+            INSERT INTO {table} (id, device_id, topic_id, payload, timestamp, value, unit)
+            SELECT ?1, ?2, ?3, ?4, ?5, {PAYLOAD_VALUE_SQL.format('?6')}, {PAYLOAD_UNIT_SQL.format('?6')}
+            WHERE EXISTS (SELECT 1 FROM devices WHERE id = ?2)
+              AND EXISTS (SELECT 1 FROM topics WHERE id = ?3)
+        ''', values).rowcount
+        # One pass over the batch's rows keeps the payload schema registry current
+        record_payload_schema(conn, table, 'td.id BETWEEN ? AND ?', (values[0][0], values[-1][0]))
+
+    if ROLLUP_ON_INGEST and _advance_watermark(conn, 'rollup_watermark', last_id - len(rows), last_id):
+        _rollup_telemetry(conn, last_id - len(rows) + 1, last_id, list(inserts))
+    # The rows are already in the current encoding
+    _advance_watermark(conn, 'compression_watermark', last_id - len(rows), last_id)
+    return written, created
+
+def get_telemetry_partitions():
+    """
+    Get the telemetry partitions, oldest first.
+
+    Returns:
+        list: Dicts with name, start_ms and end_ms ([start_ms, end_ms) is
+            the range of timestamps the partition holds)
+    """
     conn = get_db_connection()
-    
-    # Modified query to join with devices and topics tables
-    query = '''
-        SELECT 
-            td.id, td.device_id, td.topic_id, td.payload, td.timestamp,
-            d.name as device_name, t.name as topic_name
-        FROM telemetry_data td
-        LEFT JOIN devices d ON td.device_id = d.id
-        LEFT JOIN topics t ON td.topic_id = t.id
-    '''
-    
-    params = []
-    
-    if device_id and topic_id:
-        query += ' WHERE td.device_id = ? AND td.topic_id = ?'
-        params.extend([device_id, topic_id])
-    elif device_id:
-        query += ' WHERE td.device_id = ?'
-        params.append(device_id)
-    elif topic_id:
-        query += ' WHERE td.topic_id = ?'
-        params.append(topic_id)
-    
-    query += ' ORDER BY td.timestamp DESC LIMIT ?'
-    params.append(limit)
-    
-    data = conn.execute(query, params).fetchall()
+    partitions = _telemetry_partitions(conn)
     conn.close()
-    
-    return [dict(item) for item in data]
+    return [{'name': name, 'start_ms': start_ms, 'end_ms': end_ms}
+            for name, start_ms, end_ms in partitions]
 
-def get_telemetry_data_count():
-    """Get the total count of all telemetry data records in the database."""
+def drop_telemetry_partitions(before):
+    """
+    Drop every telemetry partition whose rows are all older than a cutoff.
+
+    Dropping a table takes the same short time however many rows it holds,
+    and nothing is deleted row by row. Triggers do not fire on DROP TABLE,
+    so the stats are reduced by the partition's per device/topic row counts,
+    which are read from its covering index before the write lock is taken
+    (counts are floored at 0 in case rows were deleted in between).
+    device_latest entries pointing into a dropped partition are removed:
+    all newer rows live in kept partitions, so those pairs have no rows left.
+
+    Args:
+        before (int): Cutoff in epoch milliseconds
+
+    Returns:
+        dict: partitions (names of the dropped partitions) and rows (rows removed)
+    """
+    dropped = []
+    removed = 0
+    conn = get_db_connection()
+    try:
+        for name, start_ms, end_ms in _telemetry_partitions(conn):
+            if end_ms > before:
+                break
+            counts = _query_partition(
+                conn, f'SELECT device_id, topic_id, COUNT(*) FROM {name} GROUP BY device_id, topic_id'
+            )
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if not conn.execute('SELECT 1 FROM telemetry_partitions WHERE name = ?', (name,)).fetchone():
+                    # Dropped by another connection meanwhile
+                    conn.rollback()
+                    continue
+                _subtract_partition_counts(conn, counts, end_ms)
+                conn.execute(f'DROP TABLE IF EXISTS {name}')
+                conn.execute('DELETE FROM telemetry_partitions WHERE name = ?', (name,))
+                conn.execute('DELETE FROM device_latest WHERE timestamp < ?', (end_ms,))
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+            rows = sum(count for _, _, count in counts)
+            dropped.append(name)
+            removed += rows
+            print(f"Dropped telemetry partition {name} ({rows} rows)")
+    finally:
+        conn.close()
+    return {'partitions': dropped, 'rows': removed}
+
+def _subtract_partition_counts(conn, counts, end_ms):
+    """Take a dropped partition's (device_id, topic_id, count) rows off the stats."""
+    client_ids = {row['id']: row['client_id'] for row in conn.execute('SELECT id, client_id FROM devices')}
+    totals = {}
+    for device_id, topic_id, count in counts:
+        scopes = [('telemetry', 0), ('device', device_id), ('topic', topic_id)]
+        if device_id in client_ids:
+            scopes.append(('client', client_ids[device_id]))
+        for scope in scopes:
+            totals[scope] = totals.get(scope, 0) + count
+
+    conn.executemany('''
+        UPDATE stats SET row_count = MAX(row_count - ?, 0)
+        WHERE scope = ? AND scope_id = ?
+    ''', [(count, scope, scope_id) for (scope, scope_id), count in totals.items()])
+    # Every remaining row is at or after end_ms, so that stays an outer bound
+    conn.execute('''
+        UPDATE stats SET first_timestamp = ?
+        WHERE first_timestamp < ? AND scope IN ('telemetry', 'client', 'device', 'topic')
+    ''', (end_ms, end_ms))
+    conn.execute('''
+        UPDATE stats SET first_timestamp = NULL, last_timestamp = NULL
+        WHERE row_count = 0 AND scope IN ('telemetry', 'client', 'device', 'topic')
+    ''')
+
+def drop_expired_telemetry_partitions():
+    """
+    Apply TELEMETRY_RETENTION_DAYS by dropping expired partitions.
+
+    Runs at startup and whenever ingest creates a new partition.
+
+    Returns:
+        dict: See drop_telemetry_partitions (None if retention is off or it failed)
+    """
+    if TELEMETRY_RETENTION_DAYS <= 0:
+        return None
+    try:
+        return drop_telemetry_partitions(now_ms() - int(TELEMETRY_RETENTION_DAYS * 86400000))
+    except sqlite3.Error as e:
+        print(f"Error dropping expired telemetry partitions: {e}")
+        return None
+
+# Retention policy operations
+RETENTION_SCOPES = ('topic', 'client')
+
+def get_retention_policies():
+    """
+    Get every stored retention policy.
+
+    Returns:
+        dict: {(scope, scope_id): {'max_age_days': ..., 'max_rows': ...}}
+    """
     conn = get_db_connection()
-    count = conn.execute('SELECT COUNT(*) FROM telemetry_data').fetchone()[0]
+    rows = conn.execute('SELECT scope, scope_id, max_age_days, max_rows FROM retention_policies').fetchall()
     conn.close()
-    return count
+    return {(row['scope'], row['scope_id']): {'max_age_days': row['max_age_days'], 'max_rows': row['max_rows']}
+            for row in rows}
 
-def cleanup_orphaned_data():
+def set_retention_policy(scope, scope_id, max_age_days=None, max_rows=None):
     """
-    Clean up orphaned telemetry data that might remain after devices or topics are deleted.
-    
-    This function removes any telemetry data records that reference non-existent devices or topics.
-    
+    Set or clear the retention policy of a topic or client.
+
+    Args:
+        scope (str): 'topic' or 'client'
+        scope_id (int): ID of the topic or client
+        max_age_days (float, optional): Delete rows older than this many days
+        max_rows (int, optional): Keep at most this many of the newest rows
+            (per topic); with neither limit the policy is removed
+
     Returns:
-        dict: A dictionary containing the number of records deleted and success status
+        bool: True if the policy was saved, False otherwise
+
+    Raises:
+        ValueError: If the scope or a limit is invalid
     """
+    if scope not in RETENTION_SCOPES:
+        raise ValueError(f"Unknown retention scope: {scope}")
+    if max_age_days is not None and not 0 < max_age_days < float('inf'):
+        raise ValueError("max_age_days must be a positive number")
+    if max_rows is not None and max_rows < 0:
+        raise ValueError("max_rows must not be negative")
+
+    table = 'topics' if scope == 'topic' else 'clients'
     conn = get_db_connection()
     try:
-        # Begin transaction
-        conn.execute('BEGIN TRANSACTION')
-        
-        # Delete telemetry data with non-existent device_id
-        result1 = conn.execute('''
-            DELETE FROM telemetry_data 
-            WHERE device_id NOT IN (SELECT id FROM devices)
-        ''')
-        deleted_device_data = result1.rowcount
-        
-        # Delete telemetry data with non-existent topic_id
-        result2 = conn.execute('''
-            DELETE FROM telemetry_data 
-            WHERE topic_id NOT IN (SELECT id FROM topics)
-        ''')
-        deleted_topic_data = result2.rowcount
-        
-        # Commit the transaction
+        if not conn.execute(f'SELECT 1 FROM {table} WHERE id = ?', (scope_id,)).fetchone():
+            print(f"Warning: Attempted to set retention for non-existent {scope} ID {scope_id}")
+            return False
+        if max_age_days is None and max_rows is None:
+            conn.execute('DELETE FROM retention_policies WHERE scope = ? AND scope_id = ?', (scope, scope_id))
+        else:
+            conn.execute('''
+                INSERT INTO retention_policies (scope, scope_id, max_age_days, max_rows)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (scope, scope_id) DO UPDATE SET
+                    max_age_days = excluded.max_age_days,
+                    max_rows = excluded.max_rows,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', (scope, scope_id, max_age_days, max_rows))
         conn.commit()
-        
-        total_deleted = deleted_device_data + deleted_topic_data
-        print(f"Successfully cleaned up {total_deleted} orphaned telemetry data records")
-        
-        return {
-            'success': True,
-            'deleted_count': total_deleted,
-            'device_data_deleted': deleted_device_data,
-            'topic_data_deleted': deleted_topic_data
-        }
+        return True
     except sqlite3.Error as e:
-        print(f"Error cleaning up orphaned data: {e}")
+        print(f"Error saving retention policy: {e}")
         conn.rollback()
-        return {
-            'success': False,
-            'error': str(e)
-        }
+        return False
     finally:
         conn.close()
 
-def get_device_telemetry_data(topic_id=None, limit_per_device=5):
+def get_effective_retention_policies():
     """
-    Get telemetry data organized by device with improved limit handling.
-    
+    Get the limits that apply to each topic with any retention policy.
+
+    A topic's own value wins; a value it leaves unset falls back to its
+    client's policy.
+
+    Returns:
+        list: Dicts with topic_id, max_age_days, max_rows and row_count
+            (the topic's current row count)
+    """
+    conn = get_db_connection()
+    rows = conn.execute('''
+        SELECT t.id AS topic_id,
+               COALESCE(tp.max_age_days, cp.max_age_days) AS max_age_days,
+               COALESCE(tp.max_rows, cp.max_rows) AS max_rows,
+               COALESCE(s.row_count, 0) AS row_count
+        FROM topics t
+        LEFT JOIN retention_policies tp ON tp.scope = 'topic' AND tp.scope_id = t.id
+        LEFT JOIN retention_policies cp ON cp.scope = 'client' AND cp.scope_id = t.client_id
+        LEFT JOIN stats s ON s.scope = 'topic' AND s.scope_id = t.id
+        WHERE tp.scope IS NOT NULL OR cp.scope IS NOT NULL
+        ORDER BY t.id
+    ''').fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+def purge_telemetry_chunk(topic_id, limit, before=None):
+    """
+    Delete a topic's oldest telemetry rows, at most limit of them.
+
+    Only one partition is touched (the oldest holding matching rows), in a
+    single short write transaction, so callers can pause between chunks and
+    let ingest take the write lock. The stats and device_latest triggers
+    account for the deleted rows.
+
     Args:
-        topic_id (int, optional): Filter by topic ID
-        limit_per_device (int, optional): Maximum number of telemetry records per device
-        
+        topic_id (int): ID of the topic
+        limit (int): Maximum number of rows to delete
+        before (int, optional): Only delete rows older than this (epoch ms)
+
     Returns:
-        dict: A dictionary with device_id as keys and device info + telemetry as values
+        int: Number of rows deleted (0 once nothing matches)
     """
+    condition = 'topic_id = ?'
+    params = [topic_id]
+    if before is not None:
+        condition += ' AND timestamp < ?'
+        params.append(before)
+    params.append(limit)
+
     conn = get_db_connection()
+    try:
+        for table in reversed(_partitions_in_range(conn, until=before)):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # The subquery walks the (topic_id, timestamp) index oldest first
+                deleted = conn.execute(f'''
+                    DELETE FROM {table} WHERE id IN (
+                        SELECT id FROM {table} WHERE {condition}
+                        ORDER BY timestamp, id LIMIT ?
+                    )
+                ''', params).rowcount
+                conn.commit()
+            except sqlite3.OperationalError as e:
+                conn.rollback()
+                if 'no such table' not in str(e):
+                    raise
+                continue
+            if deleted:
+                return deleted
+        return 0
+    finally:
+        conn.close()
+
+# Rollup operations
+def _advance_watermark(conn, scope, expected, last_id):
+    """Move a watermark stats row to last_id if it is still at expected; return True if it moved."""
+    return conn.execute('''
+        UPDATE stats SET row_count = ?
+        WHERE scope = ? AND scope_id = 0 AND row_count = ?
+    ''', (last_id, scope, expected)).rowcount == 1
+
+def _rollup_telemetry(conn, first_id, last_id, tables=None):
+    """
+    Add telemetry rows first_id..last_id to every rollup table.
+
+    Runs inside the caller's write transaction, which must also move the
+    watermark past last_id. The rows are aggregated once per partition at
+    the finest resolution into a temp table: json_each yields the numeric
+    fields (object keys, or NULL for a bare number, which becomes 'value';
+    array elements are skipped). Each rollup table is then merged from
+    those few rows.
+
+    Args:
+        first_id (int): First telemetry ID to add
+        last_id (int): Last telemetry ID to add
+        tables (list, optional): Partitions holding the rows, if known
+    """
+    if tables is None:
+        tables = [table for table in _partitions_in_range(conn) if _query_partition(
+            conn, f'SELECT 1 FROM {table} WHERE id BETWEEN ? AND ? LIMIT 1', (first_id, last_id)
+        )]
+    finest = min(ROLLUP_RESOLUTIONS.values())
+
+    conn.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS rollup_batch (
+            device_id INTEGER, topic_id INTEGER, field TEXT, bucket_ms INTEGER,
+            count INTEGER, min REAL, max REAL, sum REAL, last REAL, last_ms INTEGER
+        )
+    ''')
+    conn.execute('DELETE FROM temp.rollup_batch')
+    for table in tables:
+        # The rows are materialized first so they are read by rowid range (the
+        # window would otherwise pick an index and scan the partition); the
+        # window gives each row its bucket's newest value as 'last'
+        conn.execute(f'''
+            WITH batch AS MATERIALIZED (
+                SELECT td.id, td.device_id, td.topic_id, COALESCE(j.key, 'value') AS field,
+                       td.timestamp, j.value
+                FROM {table} td, json_each({PAYLOAD_TEXT_SQL.format('td.payload')}) j
+                WHERE td.id BETWEEN ? AND ?
+                  AND j.type IN ('integer', 'real')
+                  AND (j.key IS NULL OR typeof(j.key) = 'text')
+            )
+            INSERT INTO temp.rollup_batch
+            SELECT device_id, topic_id, field, bucket_ms, COUNT(*), MIN(value), MAX(value), SUM(value),
+                   MAX(last), MAX(timestamp)
+            FROM (
+                SELECT device_id, topic_id, field, timestamp / {finest} * {finest} AS bucket_ms,
+                       timestamp, value,
+                       FIRST_VALUE(value) OVER (
+                           PARTITION BY device_id, topic_id, field, timestamp / {finest}
+                           ORDER BY timestamp DESC, id DESC
+                       ) AS last
+                FROM batch
+            )
+            GROUP BY device_id, topic_id, field, bucket_ms
+        ''', (first_id, last_id))
+
+    for name, resolution in ROLLUP_RESOLUTIONS.items():
+        # WHERE true keeps the upsert's ON CONFLICT unambiguous
+        conn.execute(f'''
+            INSERT INTO rollup_{name} (device_id, topic_id, field, bucket_ms, count, min, max, sum, last, last_ms)
+            SELECT device_id, topic_id, field, bucket_ms, SUM(count), MIN(min), MAX(max), SUM(sum),
+                   MAX(bucket_last), MAX(last_ms)
+            FROM (
+                SELECT device_id, topic_id, field, bucket_ms / {resolution} * {resolution} AS bucket_ms,
+                       count, min, max, sum, last_ms,
+                       FIRST_VALUE(last) OVER (
+                           PARTITION BY device_id, topic_id, field, bucket_ms / {resolution}
+                           ORDER BY last_ms DESC
+                       ) AS bucket_last
+                FROM temp.rollup_batch
+            )
+            WHERE true
+            GROUP BY device_id, topic_id, field, bucket_ms
+            ON CONFLICT (device_id, topic_id, field, bucket_ms) DO UPDATE SET
+                count = count + excluded.count,
+                min = MIN(min, excluded.min),
+                max = MAX(max, excluded.max),
+                sum = sum + excluded.sum,
+                last = CASE WHEN excluded.last_ms >= last_ms THEN excluded.last ELSE last END,
+                last_ms = MAX(last_ms, excluded.last_ms)
+        ''')
+
+def update_rollups(max_ids=5000):
+    """
+    Catch the rollups up with the telemetry written since the watermark.
+
+    Adds at most max_ids telemetry IDs in one short write transaction; call
+    it repeatedly until it returns 0. Rows deleted before they were rolled
+    up are simply never counted, and rollups are not reduced when telemetry
+    is deleted later (they keep the history of what was received).
+
+    Args:
+        max_ids (int, optional): Maximum number of telemetry IDs to add
+
+    Returns:
+        int: Number of telemetry IDs the watermark moved past
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute('''
+            SELECT
+                (SELECT row_count FROM stats WHERE scope = 'rollup_watermark' AND scope_id = 0) AS watermark,
+                (SELECT row_count FROM stats WHERE scope = 'telemetry_id' AND scope_id = 0) AS last_id
+        ''').fetchone()
+        watermark, last_id = row['watermark'] or 0, row['last_id'] or 0
+        if watermark >= last_id:
+            conn.rollback()
+            return 0
+        end = min(watermark + max_ids, last_id)
+        _rollup_telemetry(conn, watermark + 1, end)
+        _advance_watermark(conn, 'rollup_watermark', watermark, end)
+        conn.commit()
+        return end - watermark
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def get_rollup_lag():
+    """Number of telemetry IDs not yet added to the rollups."""
+    conn = get_db_connection()
+    row = conn.execute('''
+        SELECT
+            (SELECT row_count FROM stats WHERE scope = 'telemetry_id' AND scope_id = 0) -
+            (SELECT row_count FROM stats WHERE scope = 'rollup_watermark' AND scope_id = 0)
+    ''').fetchone()
+    conn.close()
+    return max(row[0] or 0, 0)
+
+def get_rollups(field, resolution='1h', device_id=None, topic_id=None, since=None, until=None, limit=10000,
+                bucket_ms=None):
+    """
+    Get rolled-up values of a numeric payload field, oldest bucket first.
+
+    Rows of several devices or topics falling in the same bucket are merged
+    (counts and sums added, 'last' taken from the newest value).
+
+    Args:
+        field (str): Payload field ('value' for bare numeric payloads)
+        resolution (str, optional): One of ROLLUP_RESOLUTIONS ('1m', '1h', '1d')
+        device_id (int, optional): Filter by device ID
+        topic_id (int, optional): Filter by topic ID
+        since (int, optional): Only buckets ending after this time (epoch ms)
+        until (int, optional): Only buckets starting before this time (epoch ms)
+        limit (int, optional): Maximum number of buckets
+        bucket_ms (int, optional): Width of the returned buckets, a multiple
+            of the resolution (default: the resolution itself)
+
+    Returns:
+        list: Dicts with timestamp / timestamp_ms (bucket start), count,
+            min, max, sum, avg and last
+
+    Raises:
+        ValueError: If the resolution is unknown or bucket_ms is not a multiple of it
+    """
+    if resolution not in ROLLUP_RESOLUTIONS:
+        raise ValueError(f"Unknown rollup resolution: {resolution} (use {', '.join(ROLLUP_RESOLUTIONS)})")
+    width = bucket_ms or ROLLUP_RESOLUTIONS[resolution]
+    if width % ROLLUP_RESOLUTIONS[resolution]:
+        raise ValueError(f"Bucket width {width} ms is not a multiple of the {resolution} rollups")
+
+    conditions = ['field = ?']
+    params = [field]
+    if device_id:
+        conditions.append('device_id = ?')
+        params.append(device_id)
+    if topic_id:
+        conditions.append('topic_id = ?')
+        params.append(topic_id)
+    if since is not None:
+        conditions.append('bucket_ms > ?')
+        params.append(since - ROLLUP_RESOLUTIONS[resolution])
+    if until is not None:
+        conditions.append('bucket_ms < ?')
+        params.append(until)
+    params.append(limit)
+
+    conn = get_db_connection()
+    rows = conn.execute(f'''
+        SELECT {timestamp_columns('bucket_start')}, SUM(count) AS count, MIN(min) AS min, MAX(max) AS max,
+               SUM(sum) AS sum, SUM(sum) / SUM(count) AS avg, MAX(bucket_last) AS last
+        FROM (
+            SELECT bucket_ms / {width} * {width} AS bucket_start, count, min, max, sum,
+                   FIRST_VALUE(last) OVER (PARTITION BY bucket_ms / {width} ORDER BY last_ms DESC) AS bucket_last
+            FROM rollup_{resolution}
+            WHERE {' AND '.join(conditions)}
+        )
+        GROUP BY bucket_start
+        ORDER BY bucket_start
+        LIMIT ?
+    ''', params).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+def get_rollup_horizon():
+    """
+    Get the earliest timestamp the rollups may still be missing rows for.
+
+    Returns:
+        int or None: Epoch ms of the oldest telemetry row behind the
+            watermark, or None if the rollups are complete
+    """
+    conn = get_db_connection()
+    watermark = conn.execute(
+        "SELECT row_count FROM stats WHERE scope = 'rollup_watermark' AND scope_id = 0"
+    ).fetchone()[0]
+    horizon = None
+    for table in _partitions_after_id(conn, watermark):
+        rows = _query_partition(conn, f'SELECT MIN(timestamp) FROM {table} WHERE id > ?', (watermark,))
+        if rows and rows[0][0] is not None:
+            horizon = rows[0][0] if horizon is None else min(horizon, rows[0][0])
+    conn.close()
+    return horizon
+
+def _field_value_sql(field):
+    """
+    SQL expression (over a partition aliased td) for a numeric payload field.
+
+    Matches the rollups: the top-level key field if it holds a number, or
+    the payload itself for field 'value' when the payload is a bare number.
+    Anything else (strings, booleans, objects) is NULL.
+
+    Returns:
+        tuple: (expression, parameters)
+
+    Raises:
+        ValueError: If the field name cannot be used as a JSON path
+    """
+    if not field or '"' in field:
+        raise ValueError(f"Invalid payload field: {field!r}")
+    path = f'$."{field}"'
+    payload = PAYLOAD_TEXT_SQL.format('td.payload')
+    expression = f"""CASE WHEN json_type({payload}, ?) IN ('integer', 'real') THEN json_extract({payload}, ?)"""
+    if field == 'value':
+        expression += f"""
+                  WHEN json_type({payload}) IN ('integer', 'real') THEN json_extract({payload}, '$')"""
+    return expression + ' END', [path, path]
+
+def _field_conditions(device_id, topic_id, since, until):
+    """WHERE conditions and parameters shared by the field value queries."""
+    conditions = []
+    params = []
+    if device_id:
+        conditions.append('td.device_id = ?')
+        params.append(device_id)
+    if topic_id:
+        conditions.append('td.topic_id = ?')
+        params.append(topic_id)
+    if since is not None:
+        conditions.append('td.timestamp >= ?')
+        params.append(since)
+    if until is not None:
+        conditions.append('td.timestamp < ?')
+        params.append(until)
+    return (' WHERE ' + ' AND '.join(conditions) if conditions else ''), params
+
+def aggregate_telemetry(field, bucket_ms, device_id=None, topic_id=None, since=None, until=None, last=False):
+    """
+    Aggregate a numeric payload field into time buckets straight from telemetry.
+
+    The field is extracted with JSON1 and grouped by bucket in SQL, one
+    statement per partition in the window; buckets spanning a partition
+    boundary are merged here. LIMIT -1 keeps SQLite from flattening the
+    extraction into the outer queries, which would repeat it (and the
+    payload decoding) for every reference to v.
+
+    Args:
+        field (str): Payload field ('value' also matches bare numeric payloads)
+        bucket_ms (int): Bucket width in milliseconds (buckets start at
+            multiples of it since the epoch)
+        device_id (int, optional): Filter by device ID
+        topic_id (int, optional): Filter by topic ID
+        since (int, optional): Only rows at or after this time (epoch ms)
+        until (int, optional): Only rows before this time (epoch ms)
+        last (bool, optional): Also find each bucket's newest value (costs a sort)
+
+    Returns:
+        list: Dicts with timestamp / timestamp_ms (bucket start), count,
+            min, max, sum, avg and last (None unless requested), oldest first
+    """
+    value_sql, value_params = _field_value_sql(field)
+    where, params = _field_conditions(device_id, topic_id, since, until)
+    params = value_params + params
+    last_column = 'NULL'
+    if last:
+        last_column = 'FIRST_VALUE(v) OVER (PARTITION BY bucket_ms ORDER BY timestamp DESC, id DESC)'
+
+    conn = get_db_connection()
+    buckets = {}
+    for table in reversed(_partitions_in_range(conn, since, until)):
+        rows = _query_partition(conn, f'''
+            SELECT bucket_ms, COUNT(*) AS count, MIN(v) AS min, MAX(v) AS max, SUM(v) AS sum,
+                   MAX(last) AS last, MAX(timestamp) AS last_ms
+            FROM (
+                SELECT bucket_ms, timestamp, v, {last_column} AS last
+                FROM (
+                    SELECT td.id, td.timestamp, td.timestamp / {bucket_ms} * {bucket_ms} AS bucket_ms,
+                           {value_sql} AS v
+                    FROM {table} td{where}
+                    LIMIT -1
+                )
+                WHERE v IS NOT NULL
+            )
+            GROUP BY bucket_ms
+        ''', params)
+        for row in rows:
+            bucket = buckets.get(row['bucket_ms'])
+            if bucket is None:
+                buckets[row['bucket_ms']] = dict(row)
+                continue
+            bucket['count'] += row['count']
+            bucket['min'] = min(bucket['min'], row['min'])
+            bucket['max'] = max(bucket['max'], row['max'])
+            bucket['sum'] += row['sum']
+            # Partitions are read oldest first
+            bucket['last'], bucket['last_ms'] = row['last'], row['last_ms']
+    conn.close()
+
+    result = []
+    for bucket_start in sorted(buckets):
+        bucket = buckets[bucket_start]
+        result.append({
+            'timestamp': format_timestamp(bucket_start),
+            'timestamp_ms': bucket_start,
+            'count': bucket['count'],
+            'min': bucket['min'],
+            'max': bucket['max'],
+            'sum': bucket['sum'],
+            'avg': bucket['sum'] / bucket['count'],
+            'last': bucket['last'],
+        })
+    return result
+
+def get_field_values(field, device_id=None, topic_id=None, since=None, until=None):
+    """
+    Get every (timestamp_ms, value) of a numeric payload field, oldest first.
+
+    Takes the same filters as aggregate_telemetry; used where the
+    aggregation needs the values themselves (e.g. percentiles).
+
+    Returns:
+        list: (timestamp_ms, value) tuples
+    """
+    return list(iter_field_values(field, device_id, topic_id, since, until))
+
+def iter_field_values(field, device_id=None, topic_id=None, since=None, until=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Stream every (timestamp_ms, value) of a numeric payload field, oldest first.
+
+    Each partition in the window is read, oldest first, from one cursor
+    chunk_size rows at a time, so memory use stays constant however many
+    values match. The connection is held until the generator is exhausted
+    or closed.
+
+    Yields:
+        tuple: (timestamp_ms, value)
+
+    Raises:
+        ValueError: If the field name is invalid (on the first next())
+    """
+    value_sql, value_params = _field_value_sql(field)
+    where, params = _field_conditions(device_id, topic_id, since, until)
+    params = value_params + params
+    conn = get_db_connection()
+    try:
+        for table in reversed(_partitions_in_range(conn, since, until)):
+            try:
+                cursor = conn.execute(f'''
+                    SELECT timestamp, v FROM (
+                        SELECT td.id, td.timestamp, {value_sql} AS v
+                        FROM {table} td{where}
+                        LIMIT -1
+                    )
+                    WHERE v IS NOT NULL
+                    ORDER BY timestamp, id
+                ''', params)
+            except sqlite3.OperationalError as e:
+                # Dropped since the catalog was read
+                if 'no such table' not in str(e):
+                    raise
+                continue
+            try:
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield tuple(row)
+            finally:
+                cursor.close()
+    finally:
+        conn.close()
+
+def count_field_values(field, device_id=None, topic_id=None, since=None, until=None):
+    """
+    Count the values iter_field_values would yield, without reading them out.
+
+    Returns:
+        int: Number of rows in the window holding a numeric value for field
+
+    Raises:
+        ValueError: If the field name is invalid
+    """
+    value_sql, value_params = _field_value_sql(field)
+    where, params = _field_conditions(device_id, topic_id, since, until)
+    params = value_params + params
+    conn = get_db_connection()
+    total = 0
+    for table in _partitions_in_range(conn, since, until):
+        rows = _query_partition(conn, f'''
+            SELECT COUNT(*) FROM (
+                SELECT {value_sql} AS v
+                FROM {table} td{where}
+                LIMIT -1
+            )
+            WHERE v IS NOT NULL
+        ''', params)
+        total += rows[0][0] if rows else 0
+    conn.close()
+    return total
+
+# Payload compression
+def _topic_dictionary(conn, topic_id):
+    """The ID of the newest dictionary of the configured codec for a topic, loaded, or None."""
+    dict_id = _topic_dictionary_cache.get(topic_id)
+    if dict_id is not MISSING:
+        return dict_id
+    row = conn.execute('''
+        SELECT id, codec, data FROM payload_dictionaries
+        WHERE topic_id = ? AND codec = ?
+        ORDER BY id DESC LIMIT 1
+    ''', (topic_id, PAYLOAD_COMPRESSION)).fetchone()
+    dict_id = None
+    if row is not None:
+        dict_id = row['id']
+        add_dictionary(dict_id, row['codec'], row['data'])
+    _topic_dictionary_cache.set(topic_id, dict_id)
+    return dict_id
+
+def sync_payload_codec():
+    """
+    Record the configured payload codec, restarting re-compression if it changed.
+
+    When PAYLOAD_COMPRESSION differs from the codec recorded in the database,
+    every stored payload may be in the wrong encoding, so the compression
+    watermark goes back to 0 and recompress_payloads() passes over all rows.
+
+    Returns:
+        bool: True if the codec changed
+    """
+    codec_id = CODEC_IDS.get(PAYLOAD_COMPRESSION, 0)
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        changed = conn.execute('''
+            UPDATE stats SET row_count = ? WHERE scope = 'payload_codec' AND scope_id = 0 AND row_count != ?
+        ''', (codec_id, codec_id)).rowcount == 1
+        if changed:
+            conn.execute("UPDATE stats SET row_count = 0 WHERE scope = 'compression_watermark' AND scope_id = 0")
+        conn.commit()
+    finally:
+        conn.close()
+    if changed:
+        print(f"Payload compression set to {PAYLOAD_COMPRESSION}; stored payloads will be re-encoded in the background")
+    return changed
+
+def train_payload_dictionaries(min_rows=compression.PAYLOAD_DICT_MIN_ROWS,
+                               samples=compression.PAYLOAD_DICT_SAMPLES):
+    """
+    Build a dictionary of the configured codec for each topic that needs one.
+
+    A topic gets one once it holds at least min_rows rows, from its newest
+    samples payloads. The samples are read and the dictionary built outside
+    any write transaction; storing it moves the compression watermark back
+    to before the topic's oldest row so recompress_payloads() compresses the
+    rows it already has.
+
+    Args:
+        min_rows (int, optional): Rows a topic needs before it gets a dictionary
+        samples (int, optional): Newest payloads to build each dictionary from
+
+    Returns:
+        int: Number of dictionaries added
+    """
+    if PAYLOAD_COMPRESSION == 'none':
+        return 0
+    conn = get_db_connection()
+    try:
+        topic_ids = [row[0] for row in conn.execute('''
+            SELECT s.scope_id FROM stats s
+            JOIN topics tp ON tp.id = s.scope_id
+            WHERE s.scope = 'topic' AND s.row_count >= ?
+              AND NOT EXISTS (SELECT 1 FROM payload_dictionaries pd WHERE pd.topic_id = s.scope_id AND pd.codec = ?)
+        ''', (min_rows, PAYLOAD_COMPRESSION)).fetchall()]
+        added = 0
+        for topic_id in topic_ids:
+            payloads = []
+            first_id = None
+            for table in _partitions_in_range(conn):
+                if len(payloads) < samples:
+                    payloads.extend(row[0] for row in _query_partition(conn, f'''
+                        SELECT {PAYLOAD_TEXT_SQL.format('payload')} FROM {table}
+                        WHERE topic_id = ? ORDER BY timestamp DESC LIMIT ?
+                    ''', (topic_id, samples - len(payloads))))
+                rows = _query_partition(conn, f'SELECT MIN(id) FROM {table} WHERE topic_id = ?', (topic_id,))
+                if rows and rows[0][0] is not None:
+                    first_id = rows[0][0] if first_id is None else min(first_id, rows[0][0])
+            try:
+                data = train_dictionary(PAYLOAD_COMPRESSION, payloads)
+            except ValueError as e:
+                print(f"Skipping payload dictionary for topic {topic_id}: {e}")
+                continue
+
+            conn.execute('BEGIN IMMEDIATE')
+            dict_id = conn.execute('''
+                INSERT INTO payload_dictionaries (topic_id, codec, data, samples) VALUES (?, ?, ?, ?)
+                RETURNING id
+            ''', (topic_id, PAYLOAD_COMPRESSION, data, len(payloads))).fetchone()[0]
+            if first_id is not None:
+                conn.execute('''
+                    UPDATE stats SET row_count = MIN(row_count, ?)
+                    WHERE scope = 'compression_watermark' AND scope_id = 0
+                ''', (first_id - 1,))
+            conn.commit()
+            add_dictionary(dict_id, PAYLOAD_COMPRESSION, data)
+            _topic_dictionary_cache.invalidate(topic_id)
+            print(f"Trained {PAYLOAD_COMPRESSION} payload dictionary {dict_id} for topic {topic_id} "
+                  f"({len(data)} bytes from {len(payloads)} payloads)")
+            added += 1
+        return added
+    except sqlite3.Error:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def recompress_payloads(max_ids=5000):
+    """
+    Re-encode the payloads written since the compression watermark.
+
+    Rows of topics with a dictionary of the configured codec are compressed
+    with the newest one (or recompressed, if they used another); with
+    compression off every compressed payload is turned back into JSON text.
+    Rows of topics without a dictionary are left as they are, and the
+    device_latest copies follow the rows they mirror. Works through
+    at most max_ids telemetry IDs in one short write transaction; call it
+    repeatedly until it returns 0. Freed pages are reused by new rows; run
+    VACUUM to shrink the database file.
+
+    Args:
+        max_ids (int, optional): Maximum number of telemetry IDs to pass
+
+    Returns:
+        int: Number of telemetry IDs the watermark moved past
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute('''
+            SELECT
+                (SELECT row_count FROM stats WHERE scope = 'compression_watermark' AND scope_id = 0) AS watermark,
+                (SELECT row_count FROM stats WHERE scope = 'telemetry_id' AND scope_id = 0) AS last_id,
+                (SELECT COUNT(*) FROM payload_dictionaries) AS dictionaries
+        ''').fetchone()
+        watermark, last_id = row['watermark'] or 0, row['last_id'] or 0
+        if watermark >= last_id:
+            conn.rollback()
+            return 0
+        # Without any dictionary nothing is (or needs to be) compressed
+        end = min(watermark + max_ids, last_id) if row['dictionaries'] else last_id
+
+        for table in (_partitions_after_id(conn, watermark) if row['dictionaries'] else []):
+            updates = []
+            for row_id, topic_id, stored in _query_partition(conn, f'''
+                SELECT id, topic_id, payload FROM {table} WHERE id > ? AND id <= ?
+            ''', (watermark, end)):
+                dict_id = _topic_dictionary(conn, topic_id) if PAYLOAD_COMPRESSION != 'none' else None
+                if isinstance(stored, bytes):
+                    if dict_id is None and PAYLOAD_COMPRESSION != 'none':
+                        continue
+                    if dict_id is not None and compression.payload_dictionary_id(stored) == dict_id:
+                        continue
+                    text = _payload_text(stored)
+                elif dict_id is None:
+                    continue
+                else:
+                    text = stored
+                encoded = compress_payload(text, dict_id) if dict_id else text
+                if encoded is not stored:
+                    updates.append((encoded, row_id))
+            if updates:
+                conn.executemany(f'UPDATE {table} SET payload = ? WHERE id = ?', updates)
+                # device_latest holds its own copy of each pair's newest payload
+                conn.execute(f'''
+                    UPDATE device_latest SET payload = t.payload
+                    FROM {table} t
+                    WHERE t.id = device_latest.telemetry_id AND t.id > ? AND t.id <= ?
+                      AND device_latest.payload IS NOT t.payload
+                ''', (watermark, end))
+        _advance_watermark(conn, 'compression_watermark', watermark, end)
+        conn.commit()
+        return end - watermark
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def get_compression_lag():
+    """Number of telemetry IDs not yet checked for the current payload encoding."""
+    conn = get_db_connection()
+    row = conn.execute('''
+        SELECT
+            (SELECT row_count FROM stats WHERE scope = 'telemetry_id' AND scope_id = 0) -
+            (SELECT row_count FROM stats WHERE scope = 'compression_watermark' AND scope_id = 0)
+    ''').fetchone()
+    conn.close()
+    return max(row[0] or 0, 0)
+
+# Payload schema registry
+def get_topic_schema(topic_id=None, device_id=None, since=None, until=None):
+    """
+    Get the payload columns recorded in the schema registry.
+
+    Served from the topic_schema table, which the ingest path keeps current,
+    so no telemetry is read. Columns are listed once per type they were seen
+    with; counts include rows that have since been deleted.
+
+    Args:
+        topic_id (int, optional): Filter by topic ID
+        device_id (int, optional): Only topics the device has published to
+        since (int, optional): Only columns last seen at or after this epoch ms
+        until (int, optional): Only columns first seen before this epoch ms
+
+    Returns:
+        list: Dicts with topic_id, field, type, count, first_seen and
+            last_seen (epoch ms), ordered by topic, field and type
+    """
+    conditions = []
+    params = []
+    if topic_id:
+        conditions.append('topic_id = ?')
+        params.append(topic_id)
+    if device_id:
+        conditions.append('topic_id IN (SELECT topic_id FROM device_latest WHERE device_id = ?)')
+        params.append(device_id)
+    if since is not None:
+        conditions.append('last_seen >= ?')
+        params.append(since)
+    if until is not None:
+        conditions.append('first_seen < ?')
+        params.append(until)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+    conn = get_db_connection()
+    rows = conn.execute(f'''
+        SELECT topic_id, field, type, count, first_seen, last_seen
+        FROM topic_schema{where}
+        ORDER BY topic_id, field, type
+    ''', params).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+def get_chart_fields(topic_id=None):
+    """
+    Get the numeric payload fields each device can chart.
+
+    Uses the schema registry of the topics each device has published to.
+    Field names are those of get_field_values: numeric top-level keys, and
+    'value' for topics with bare numeric payloads.
+
+    Args:
+        topic_id (int, optional): Only fields of this topic
+
+    Returns:
+        dict: Device ID -> sorted list of field names
+    """
+    query = '''
+        SELECT DISTINCT l.device_id, s.field
+        FROM device_latest l
+        JOIN topic_schema s ON s.topic_id = l.topic_id
+        WHERE s.type IN ('int', 'float')
+    '''
+    params = []
+    if topic_id:
+        query += ' AND l.topic_id = ?'
+        params.append(topic_id)
+    conn = get_db_connection()
+    rows = conn.execute(query, params).fetchall()
+    conn.close()
+
+    fields = {}
+    for device_id, field in rows:
+        if field == 'payload':
+            name = 'value'
+        elif field.count('.') == 1 and '"' not in field:
+            name = field[len('payload.'):]
+        else:
+            # Nested keys (and keys _field_value_sql rejects) cannot be charted
+            continue
+        fields.setdefault(device_id, set()).add(name)
+    return {device_id: sorted(names) for device_id, names in fields.items()}
+
+def store_telemetry_data(device_id, topic_id, payload):
+    """
+    Store telemetry data from a device with improved error handling and validation.
     
-    # Get all devices
-    devices = get_all_devices()
-    
-    # Get all topics for reference
-    all_topics = get_all_topics()
-    
-    # Get all clients for reference
-    all_clients = get_all_clients()
-    
-    # Dictionary to store results
-    device_data = {}
-    
-    # Get data for each device
-    for device in devices:
-        if device:
-            # Build the query for telemetry data
-            query = '''
-                SELECT t.*, tp.name as topic_name 
-                FROM telemetry_data t
-                LEFT JOIN topics tp ON t.topic_id = tp.id
-                WHERE t.device_id = ?
-            '''
-            params = [device['id']]
+    Args:
+        device_id (int): ID of the device sending data
+        topic_id (int): ID of the topic the data belongs to
+        payload: The data payload to store (a JSON value, or JSON text)
+        
+    Returns:
+        bool: True if data was stored successfully, False otherwise
+    """
+    if not device_id or not topic_id:
+        print("Error: device_id and topic_id must be provided for telemetry data")
+        return False
+        
+    # Payloads are always stored as valid JSON text (see encode_payload)
+    try:
+        payload = encode_payload(payload)
+    except (TypeError, ValueError) as e:
+        print(f"Error converting payload to JSON: {e}")
+        return False
+    
+    conn = get_db_connection()
+    try:
+        # Take the write lock up front: the partition catalog is read before writing
+        conn.execute('BEGIN IMMEDIATE')
+        
+        # Verify device exists
+        device = conn.execute('SELECT * FROM devices WHERE id = ?', (device_id,)).fetchone()
+        if not device:
+            print(f"Error: device with ID {device_id} does not exist")
+            conn.rollback()
+            return False
             
-            # Add topic filter if specified
+        # Verify topic exists
+        topic = conn.execute('SELECT * FROM topics WHERE id = ?', (topic_id,)).fetchone()
+        if not topic:
+            print(f"Error: topic with ID {topic_id} does not exist")
+            conn.rollback()
+            return False
+        
+        # Store the telemetry data in its time partition
+        timestamp = now_ms()
+        _, created = _insert_telemetry(conn, [(device_id, topic_id, payload, timestamp)])
+        
+        # Update device's last_seen timestamp
+        conn.execute(
+            'UPDATE devices SET last_seen = ? WHERE id = ?',
+            (format_timestamp(timestamp), device_id)
+        )
+        
+        # Commit the transaction
+        conn.commit()
+    except sqlite3.Error as e:
+        print(f"Database error when storing telemetry data: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+    
+    if created:
+        drop_expired_telemetry_partitions()
+    return True
+
+def store_telemetry_batch(rows):
+    """
+    Store a batch of telemetry rows in a single transaction (group commit).
+
+    Rows referencing a device or topic that no longer exists are skipped
+    instead of failing the whole batch.
+
+    Args:
+        rows (list): Tuples of (device_id, topic_id, payload, received_at) where
+            payload is a JSON string and received_at epoch milliseconds (see now_ms)
+
+    Returns:
+        int: Number of telemetry rows written
+    """
+    if not rows:
+        return 0
+
+    last_seen = {}
+    for device_id, topic_id, payload, received_at in rows:
+        last_seen[device_id] = format_timestamp(received_at)
+
+    conn = get_db_connection()
+    try:
+        # Take the write lock up front: the partition catalog is read before writing
+        conn.execute('BEGIN IMMEDIATE')
+
+        written, created = _insert_telemetry(conn, rows)
+
+        # Update last_seen once per device in the batch
+        conn.executemany(
+            'UPDATE devices SET last_seen = ? WHERE id = ?',
+            [(seen, device_id) for device_id, seen in last_seen.items()]
+        )
+
+        # Commit the transaction
+        conn.commit()
+
+        if written < len(rows):
+            print(f"Warning: skipped {len(rows) - written} telemetry rows for deleted devices or topics")
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    if created:
+        drop_expired_telemetry_partitions()
+    return written
+
+# Telemetry timestamps are stored as UTC epoch milliseconds. Reads format
+# them in SQL, returning both 'timestamp' (display format, UTC) and
+# 'timestamp_ms' (the stored integer), so no Python loop reformats rows.
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def timestamp_columns(column):
+    """SELECT list entries exposing an epoch-ms column as 'timestamp' and 'timestamp_ms'."""
+    return f"strftime('{TIMESTAMP_FORMAT}', {column} / 1000, 'unixepoch') AS timestamp, {column} AS timestamp_ms"
+
+def payload_column(column):
+    """SELECT list entry exposing a stored payload column as its JSON text 'payload' (compressed or not)."""
+    return f"{PAYLOAD_TEXT_SQL.format(column)} AS payload"
+
+# Telemetry partition columns (aliased t) as returned by the read functions
+TELEMETRY_COLUMNS = f"t.id, t.device_id, t.topic_id, {payload_column('t.payload')}, {timestamp_columns('t.timestamp')}"
+
+def now_ms():
+    """Return the current time as UTC epoch milliseconds."""
+    return int(time.time() * 1000)
+
+def format_timestamp(ms):
+    """Format UTC epoch milliseconds in the display format ('YYYY-MM-DD HH:MM:SS')."""
+    return time.strftime(TIMESTAMP_FORMAT, time.gmtime(ms // 1000))
+
+def parse_timestamp(value):
+    """
+    Convert a since/until query value to a stored timestamp (epoch ms).
+    
+    Accepts ISO 8601 strings (naive values are taken as UTC, like the
+    displayed timestamps) or Unix epoch seconds.
+    
+    Args:
+        value (str): The timestamp to convert
+        
+    Returns:
+        int: UTC epoch milliseconds
+        
+    Raises:
+        ValueError: If the value is not a recognised timestamp
+    """
+    value = str(value).strip()
+    try:
+        return int(round(float(value) * 1000))
+    except (ValueError, OverflowError):
+        dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=pytz.utc)
+        return int(round(dt.timestamp() * 1000))
+
+def encode_cursor(row):
+    """Build an opaque pagination cursor pointing just past a telemetry row."""
+    raw = json.dumps([row['timestamp_ms'], row['id']], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor produced by encode_cursor.
+    
+    Returns:
+        tuple: (timestamp_ms, id) of the last row of the previous page
+        
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        timestamp, row_id = json.loads(raw)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if not isinstance(timestamp, int) or not isinstance(row_id, int):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return timestamp, row_id
+
+def get_telemetry_data(device_id=None, topic_id=None, limit=100, since=None, until=None, cursor=None,
+                       min_value=None, max_value=None):
+    """
+    Get telemetry data, newest first, optionally filtered by device_id and/or topic_id.
+    
+    Rows are ordered by (timestamp, id) so every filter combination is an
+    index range scan and pages can be resumed with a cursor. Partitions are
+    read newest first and only those overlapping the time window (and
+    before the cursor) are touched, stopping once limit rows are found.
+    
+    Args:
+        device_id (int, optional): Filter by device ID
+        topic_id (int, optional): Filter by topic ID
+        limit (int, optional): Maximum number of rows
+        since (int, optional): Only rows at or after this time (epoch ms, see parse_timestamp)
+        until (int, optional): Only rows before this time (epoch ms)
+        cursor (tuple, optional): (timestamp_ms, id) to continue after, from decode_cursor
+        min_value (float, optional): Only rows whose numeric value is at least this
+        max_value (float, optional): Only rows whose numeric value is at most this
+        
+    Returns:
+        list: Telemetry rows as dicts
+    """
+    conditions = []
+    params = []
+    
+    if device_id:
+        conditions.append('td.device_id = ?')
+        params.append(device_id)
+    if topic_id:
+        conditions.append('td.topic_id = ?')
+        params.append(topic_id)
+    if since is not None:
+        conditions.append('td.timestamp >= ?')
+        params.append(since)
+    if until is not None:
+        conditions.append('td.timestamp < ?')
+        params.append(until)
+    if cursor:
+        conditions.append('(td.timestamp, td.id) < (?, ?)')
+        params.extend(cursor)
+    # The typed value column (see PAYLOAD_VALUE_SQL); rows without one never match
+    if min_value is not None:
+        conditions.append('td.value >= ?')
+        params.append(min_value)
+    if max_value is not None:
+        conditions.append('td.value <= ?')
+        params.append(max_value)
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    
+    upper = until
+    if cursor:
+        upper = cursor[0] + 1 if upper is None else min(upper, cursor[0] + 1)
+    
+    conn = get_db_connection()
+    data = []
+    for table in _partitions_in_range(conn, since, upper):
+        # Modified query to join with devices and topics tables
+        query = f'''
+            SELECT 
+                td.id, td.device_id, td.topic_id, {payload_column('td.payload')}, {timestamp_columns('td.timestamp')},
+                d.name as device_name, t.name as topic_name
+            FROM {table} td
+            LEFT JOIN devices d ON td.device_id = d.id
+            LEFT JOIN topics t ON td.topic_id = t.id
+        ''' + where + ' ORDER BY td.timestamp DESC, td.id DESC LIMIT ?'
+        data.extend(_query_partition(conn, query, params + [limit - len(data)]))
+        if len(data) >= limit:
+            break
+    conn.close()
+    
+    return [dict(item) for item in data]
+
+def get_telemetry_page(device_id=None, topic_id=None, limit=100, since=None, until=None, cursor=None,
+                       min_value=None, max_value=None):
+    """
+    Get one page of telemetry data plus the cursor for the next page.
+    
+    Takes the same arguments as get_telemetry_data.
+    
+    Returns:
+        tuple: (rows, next_cursor) where next_cursor is None on the last page
+    """
+    rows = get_telemetry_data(device_id, topic_id, limit + 1, since, until, cursor, min_value, max_value)
+    if len(rows) <= limit:
+        return rows, None
+    del rows[limit:]
+    return rows, encode_cursor(rows[-1])
+
+def get_telemetry_since(since_id, device_id=None, topic_id=None, limit=100, min_value=None, max_value=None):
+    """
+    Get telemetry rows added after a known row ID, for delta polling.
+
+    The rows are read in ID order straight off the rowid of the partitions
+    that have newer rows (normally just the newest one), so a poll only
+    touches the rows added since since_id. The device/topic filters are
+    written as +column so the planner keeps that rowid range scan instead
+    of switching to a time index and sorting.
+
+    Args:
+        since_id (int): Highest row ID the caller already has
+        device_id (int, optional): Filter by device ID
+        topic_id (int, optional): Filter by topic ID
+        limit (int, optional): Maximum number of rows
+        min_value (float, optional): Only rows whose numeric value is at least this
+        max_value (float, optional): Only rows whose numeric value is at most this
+
+    Returns:
+        tuple: (rows, last_id) with rows oldest first and last_id the new
+            high-water mark to send as since_id next time (since_id if
+            nothing was added). More rows may follow if limit rows came back.
+    """
+    filters = ''
+    params = [since_id]
+    if device_id:
+        filters += ' AND +td.device_id = ?'
+        params.append(device_id)
+    if topic_id:
+        filters += ' AND +td.topic_id = ?'
+        params.append(topic_id)
+    if min_value is not None:
+        filters += ' AND +td.value >= ?'
+        params.append(min_value)
+    if max_value is not None:
+        filters += ' AND +td.value <= ?'
+        params.append(max_value)
+    params.append(limit)
+
+    conn = get_db_connection()
+    data = []
+    for table in _partitions_after_id(conn, since_id):
+        query = f'''
+            SELECT
+                td.id, td.device_id, td.topic_id, {payload_column('td.payload')}, {timestamp_columns('td.timestamp')},
+                d.name as device_name, t.name as topic_name
+            FROM {table} td
+            LEFT JOIN devices d ON td.device_id = d.id
+            LEFT JOIN topics t ON td.topic_id = t.id
+            WHERE td.id > ?
+        ''' + filters + ' ORDER BY td.id LIMIT ?'
+        data.extend(_query_partition(conn, query, params))
+    conn.close()
+
+    data.sort(key=lambda item: item['id'])
+    rows = [dict(item) for item in data[:limit]]
+    return rows, rows[-1]['id'] if rows else since_id
+
+def get_telemetry_data_count():
+    """Get the total count of all telemetry data records (from the maintained stats table)."""
+    conn = get_db_connection()
+    row = conn.execute(
+        "SELECT row_count FROM stats WHERE scope = 'telemetry' AND scope_id = 0"
+    ).fetchone()
+    conn.close()
+    return row['row_count'] if row else 0
+
+def get_max_telemetry_id():
+    """Get the last telemetry row ID handed out (0 before any data); changes whenever data is added."""
+    conn = get_db_connection()
+    row = conn.execute(
+        "SELECT row_count FROM stats WHERE scope = 'telemetry_id' AND scope_id = 0"
+    ).fetchone()
+    conn.close()
+    return row['row_count'] if row else 0
+
+def get_data_version():
+    """
+    Get a cheap token that changes whenever the served data may have changed.
+
+    Combines the last telemetry ID handed out (inserts), the telemetry row
+    count (deletes), the metadata generation counter (clients, topics and
+    devices) and the rollup watermark (rollups caught up); all four are
+    primary key lookups in the stats table.
+
+    Returns:
+        str: The version token
+    """
+    conn = get_db_connection()
+    row = conn.execute('''
+        SELECT
+            (SELECT row_count FROM stats WHERE scope = 'telemetry_id' AND scope_id = 0) AS max_id,
+            (SELECT row_count FROM stats WHERE scope = 'telemetry' AND scope_id = 0) AS row_count,
+            (SELECT row_count FROM stats WHERE scope = 'generation' AND scope_id = 0) AS generation,
+            (SELECT row_count FROM stats WHERE scope = 'rollup_watermark' AND scope_id = 0) AS watermark
+    ''').fetchone()
+    conn.close()
+    return f"{row['max_id'] or 0}-{row['row_count'] or 0}-{row['generation'] or 0}-{row['watermark'] or 0}"
+
+def get_dashboard_stats():
+    """
+    Get client, topic, device and telemetry counts for the dashboard.
+    
+    Returns:
+        dict: client_count, topic_count, device_count and data_count
+    """
+    conn = get_db_connection()
+    rows = conn.execute('''
+        SELECT scope, row_count FROM stats
+        WHERE scope IN ('clients', 'topics', 'devices', 'telemetry') AND scope_id = 0
+    ''').fetchall()
+    conn.close()
+    counts = {row['scope']: row['row_count'] for row in rows}
+    return {
+        'client_count': counts.get('clients', 0),
+        'topic_count': counts.get('topics', 0),
+        'device_count': counts.get('devices', 0),
+        'data_count': counts.get('telemetry', 0)
+    }
+
+def get_telemetry_stats(scope, scope_id):
+    """
+    Get the telemetry row count and time range of a client, device or topic.
+    
+    Args:
+        scope (str): 'client', 'device' or 'topic'
+        scope_id (int): ID of the client, device or topic
+        
+    Returns:
+        dict: row_count, first_timestamp and last_timestamp (UTC display
+            format; zero/None if no data)
+    """
+    conn = get_db_connection()
+    row = conn.execute(f'''
+        SELECT row_count,
+               strftime('{TIMESTAMP_FORMAT}', first_timestamp / 1000, 'unixepoch') AS first_timestamp,
+               strftime('{TIMESTAMP_FORMAT}', last_timestamp / 1000, 'unixepoch') AS last_timestamp
+        FROM stats WHERE scope = ? AND scope_id = ?
+    ''', (scope, scope_id)).fetchone()
+    conn.close()
+    if not row:
+        return {'row_count': 0, 'first_timestamp': None, 'last_timestamp': None}
+    return dict(row)
+
+def cleanup_orphaned_data():
+    """
+    Clean up orphaned telemetry data that might remain after devices or topics are deleted.
+    
+    This function removes any telemetry data records that reference non-existent devices or topics.
+    
+    Returns:
+        dict: A dictionary containing the number of records deleted and success status
+    """
+    conn = get_db_connection()
+    try:
+        # Begin transaction
+        conn.execute('BEGIN IMMEDIATE')
+        
+        deleted_device_data = 0
+        deleted_topic_data = 0
+        for table in _partitions_in_range(conn):
+            # Delete telemetry data with non-existent device_id
+            deleted_device_data += conn.execute(f'''
+                DELETE FROM {table} 
+                WHERE device_id NOT IN (SELECT id FROM devices)
+            ''').rowcount
+            
+            # Delete telemetry data with non-existent topic_id
+            deleted_topic_data += conn.execute(f'''
+                DELETE FROM {table} 
+                WHERE topic_id NOT IN (SELECT id FROM topics)
+            ''').rowcount
+        
+        # Commit the transaction
+        conn.commit()
+        
+        total_deleted = deleted_device_data + deleted_topic_data
+        print(f"Successfully cleaned up {total_deleted} orphaned telemetry data records")
+        
+        return {
+            'success': True,
+            'deleted_count': total_deleted,
+            'device_data_deleted': deleted_device_data,
+            'topic_data_deleted': deleted_topic_data
+        }
+    except sqlite3.Error as e:
+        print(f"Error cleaning up orphaned data: {e}")
+        conn.rollback()
+        return {
+            'success': False,
+            'error': str(e)
+        }
+    finally:
+        conn.close()
+
+def get_device_telemetry_data(topic_id=None, limit_per_device=5, since_id=None, max_rows=1000):
+    """
+    Get telemetry data organized by device with improved limit handling.
+    
+    Each partition, newest first, is read with a single query: a correlated
+    LIMIT subquery picks each device's newest rows straight from the
+    (device_id, timestamp) index, so the cost grows with devices x limit
+    rather than table size. Older partitions are only read for devices that
+    still need rows. Devices, clients and topics are joined in Python through
+    ID-keyed dictionaries. limit_per_device=1 is served from the
+    device_latest table without touching telemetry at all.
+    
+    With since_id only rows added after that ID are considered (a rowid
+    range scan of at most max_rows rows, see get_telemetry_since), and only
+    devices with new rows are returned.
+    
+    Args:
+        topic_id (int, optional): Filter by topic ID
+        limit_per_device (int, optional): Maximum number of telemetry records per device
+        since_id (int, optional): Only rows with a higher ID
+        max_rows (int, optional): Maximum rows read in total when since_id is given
+        
+    Returns:
+        dict: A dictionary with device_id as keys and device info + telemetry as values
+    """
+    conn = get_db_connection()
+    try:
+        devices = {row['id']: dict(row) for row in conn.execute('SELECT * FROM devices ORDER BY id')}
+        clients = {row['id']: dict(row) for row in conn.execute('SELECT * FROM clients')}
+        topics = {row['id']: dict(row) for row in conn.execute('SELECT * FROM topics')}
+        
+        if since_id is not None:
+            filters = ''
+            params = [since_id]
             if topic_id is not None:
-                query += ' AND t.topic_id = ?'
+                filters = ' AND +t.topic_id = ?'
+                params.append(topic_id)
+            params.append(max_rows)
+            rows = []
+            for table in _partitions_after_id(conn, since_id):
+                rows.extend(_query_partition(conn, f'''
+                    SELECT {TELEMETRY_COLUMNS}, tp.name as topic_name
+                    FROM {table} t
+                    LEFT JOIN topics tp ON t.topic_id = tp.id
+                    WHERE t.id > ?{filters}
+                    ORDER BY t.id LIMIT ?
+                ''', params))
+            rows.sort(key=lambda row: row['id'])
+            del rows[max_rows:]
+        elif limit_per_device == 1:
+            # One row per (device, topic); the newest per device is picked below
+            query = f'''
+                SELECT l.telemetry_id as id, l.device_id, l.topic_id, {payload_column('l.payload')}, {timestamp_columns('l.timestamp')},
+                       tp.name as topic_name
+                FROM device_latest l
+                LEFT JOIN topics tp ON l.topic_id = tp.id
+            '''
+            params = []
+            if topic_id is not None:
+                query += ' WHERE l.topic_id = ?'
+                params.append(topic_id)
+            rows = conn.execute(query, params).fetchall()
+        else:
+            # Newest rows per device, optionally restricted to one topic
+            params = []
+            topic_filter = ''
+            if topic_id is not None:
+                topic_filter = ' AND topic_id = ?'
                 params.append(topic_id)
-            
-            # Add ordering and limit
-            query += ' ORDER BY t.timestamp DESC LIMIT ?'
             params.append(limit_per_device)
             
-            # Execute query
-            telemetry = conn.execute(query, params).fetchall()
-            telemetry = [dict(row) for row in telemetry]
-            
-            if telemetry:
-                # Find client info for this device
-                client = next((c for c in all_clients if c['id'] == device['client_id']), None)
-                
-                # Find all topics this device has sent data to
-                device_topics = []
-                topic_ids = set()
-                for item in telemetry:
-                    if item['topic_id'] not in topic_ids:
-                        topic_ids.add(item['topic_id'])
-                        topic = next((t for t in all_topics if t['id'] == item['topic_id']), None)
-                        if topic:
-                            device_topics.append(topic)
-                
-                device_data[device['id']] = {
-                    'device': device,
-                    'client': client,
-                    'topics': device_topics,
-                    'telemetry': telemetry
-                }
+            # Devices that have telemetry and still need rows from older partitions
+            wanted = {row['scope_id'] for row in conn.execute(
+                "SELECT scope_id FROM stats WHERE scope = 'device' AND row_count > 0"
+            )}
+            found = {}
+            rows = []
+            for table in _partitions_in_range(conn):
+                if not wanted:
+                    break
+                partition_rows = _query_partition(conn, f'''
+                    SELECT {TELEMETRY_COLUMNS}, tp.name as topic_name
+                    FROM devices d
+                    JOIN {table} t ON t.id IN (
+                        SELECT id FROM {table} WHERE device_id = d.id{topic_filter}
+                        ORDER BY timestamp DESC, id DESC LIMIT ?
+                    )
+                    LEFT JOIN topics tp ON t.topic_id = tp.id
+                    WHERE d.id IN (SELECT value FROM json_each(?))
+                ''', params + [json.dumps(sorted(wanted))])
+                for row in partition_rows:
+                    found[row['device_id']] = found.get(row['device_id'], 0) + 1
+                rows.extend(partition_rows)
+                wanted = {device_id for device_id in wanted if found.get(device_id, 0) < limit_per_device}
+    finally:
+        conn.close()
+    
+    telemetry_by_device = {}
+    for row in rows:
+        telemetry_by_device.setdefault(row['device_id'], []).append(dict(row))
+    
+    # Dictionary to store results, in device ID order
+    device_data = {}
+    for device_id, device in devices.items():
+        telemetry = telemetry_by_device.get(device_id)
+        if not telemetry:
+            continue
+        
+        # Newest first (the subqueries limit rows but do not order the join output)
+        telemetry.sort(key=lambda item: (item['timestamp_ms'], item['id']), reverse=True)
+        del telemetry[limit_per_device:]
+        
+        # Find all topics this device has sent data to, in first-seen order
+        device_topics = []
+        topic_ids = set()
+        for item in telemetry:
+            if item['topic_id'] not in topic_ids:
+                topic_ids.add(item['topic_id'])
+                topic = topics.get(item['topic_id'])
+                if topic:
+                    device_topics.append(topic)
+        
+        device_data[device_id] = {
+            'device': device,
+            'client': clients.get(device['client_id']),
+            'topics': device_topics,
+            'telemetry': telemetry
+        }
     
-    conn.close()
     return device_data
 
+def get_latest_by_device(client_id=None, device_id=None, topic_id=None):
+    """
+    Get the newest reading of every device for each topic it publishes to.
+    
+    Served from the device_latest table, which is kept current on ingest,
+    so the cost does not depend on the amount of telemetry.
+    
+    Args:
+        client_id (int, optional): Filter by client ID
+        device_id (int, optional): Filter by device ID
+        topic_id (int, optional): Filter by topic ID
+        
+    Returns:
+        list: One dict per device/topic pair, newest first
+    """
+    query = f'''
+        SELECT
+            l.telemetry_id as id, l.device_id, l.topic_id, {payload_column('l.payload')}, {timestamp_columns('l.timestamp')},
+            d.name as device_name, d.client_id, d.last_seen, tp.name as topic_name
+        FROM device_latest l
+        JOIN devices d ON l.device_id = d.id
+        LEFT JOIN topics tp ON l.topic_id = tp.id
+    '''
+    conditions = []
+    params = []
+    if client_id is not None:
+        conditions.append('d.client_id = ?')
+        params.append(client_id)
+    if device_id is not None:
+        conditions.append('l.device_id = ?')
+        params.append(device_id)
+    if topic_id is not None:
+        conditions.append('l.topic_id = ?')
+        params.append(topic_id)
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY l.timestamp DESC, l.telemetry_id DESC'
+    
+    conn = get_db_connection()
+    rows = conn.execute(query, params).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+def iter_telemetry(device_id=None, topic_id=None, since=None, until=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Stream telemetry rows, newest first, without loading them all into memory.
+    
+    Each partition overlapping the time window is read, newest first, from
+    one cursor chunk_size rows at a time, so memory use stays constant
+    however many rows match. The connection is held until the generator is
+    exhausted or closed.
+    
+    Args:
+        device_id (int, optional): Filter by device ID
+        topic_id (int, optional): Filter by topic ID
+        since (int, optional): Only rows at or after this time (epoch ms, see parse_timestamp)
+        until (int, optional): Only rows before this time (epoch ms)
+        chunk_size (int, optional): Rows fetched per round trip
+        
+    Yields:
+        dict: Telemetry row with device_name, topic_name and the typed
+            value and unit columns
+    """
+    conditions = []
+    params = []
+    if device_id is not None:
+        conditions.append('t.device_id = ?')
+        params.append(device_id)
+    if topic_id is not None:
+        conditions.append('t.topic_id = ?')
+        params.append(topic_id)
+    if since is not None:
+        conditions.append('t.timestamp >= ?')
+        params.append(since)
+    if until is not None:
+        conditions.append('t.timestamp < ?')
+        params.append(until)
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    
+    conn = get_db_connection()
+    try:
+        for table in _partitions_in_range(conn, since, until):
+            query = f'''
+                SELECT {TELEMETRY_COLUMNS}, t.value, t.unit, d.name as device_name, tp.name as topic_name
+                FROM {table} t
+                LEFT JOIN devices d ON t.device_id = d.id
+                LEFT JOIN topics tp ON t.topic_id = tp.id
+            ''' + where + ' ORDER BY t.timestamp DESC, t.id DESC'
+            try:
+                cursor = conn.execute(query, params)
+            except sqlite3.OperationalError as e:
+                # Dropped since the catalog was read
+                if 'no such table' not in str(e):
+                    raise
+                continue
+            try:
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield dict(row)
+            finally:
+                cursor.close()
+    finally:
+        conn.close()
+
+
 def get_topic_by_id(topic_id):
     """Lấy thông tin của một topic cụ thể theo ID"""
     conn = get_db_connection()
@@ -620,21 +2503,7 @@ def get_topic_by_id(topic_id):
 
 def get_all_telemetry_by_topic(topic_id):
     """Lấy toàn bộ dữ liệu telemetry cho một topic không giới hạn số lượng"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT t.*, d.name as device_name, tp.name as topic_name 
-        FROM telemetry t
-        JOIN devices d ON t.device_id = d.id
-        JOIN topics tp ON t.topic_id = tp.id
-        WHERE t.topic_id = ?
-        ORDER BY t.timestamp DESC
-    ''', (topic_id,))
-    
-    data = [dict(zip([column[0] for column in cursor.description], row)) for row in cursor.fetchall()]
-    conn.close()
-    return data
+    return list(iter_telemetry(topic_id=topic_id))
 
 def get_device_by_id(device_id):
     """Lấy thông tin của một thiết bị cụ thể theo ID"""
@@ -654,34 +2523,8 @@ def get_device_by_id(device_id):
 
 def get_device_telemetry_data_full(device_id):
     """Lấy toàn bộ dữ liệu telemetry cho một thiết bị"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT t.*, tp.name as topic_name 
-        FROM telemetry t
-        JOIN topics tp ON t.topic_id = tp.id
-        WHERE t.device_id = ?
-        ORDER BY t.timestamp DESC
-    ''', (device_id,))
-    
-    data = [dict(zip([column[0] for column in cursor.description], row)) for row in cursor.fetchall()]
-    conn.close()
-    return data
+    return list(iter_telemetry(device_id=device_id))
 
 def get_device_topic_telemetry_data(device_id, topic_id):
     """Lấy toàn bộ dữ liệu telemetry cho một thiết bị và một topic cụ thể"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT t.*, tp.name as topic_name 
-        FROM telemetry t
-        JOIN topics tp ON t.topic_id = tp.id
-        WHERE t.device_id = ? AND t.topic_id = ?
-        ORDER BY t.timestamp DESC
-    ''', (device_id, topic_id))
-    
-    data = [dict(zip([column[0] for column in cursor.description], row)) for row in cursor.fetchall()]
-    conn.close()
-    return data
+    return list(iter_telemetry(device_id=device_id, topic_id=topic_id))
@@ -0,0 +1,149 @@
+"""
+Largest-Triangle-Three-Buckets (LTTB) downsampling for chart series.
+
+LTTB keeps the first and last points and, for every bucket in between,
+the point forming the largest triangle with the point kept in the previous
+bucket and the average of the next one. Peaks and troughs survive, so a
+few hundred points keep the visual shape of a much longer series.
+
+The values are streamed from the database and downsampled a bucket at a
+time, so memory use depends on the bucket size rather than on the number
+of rows in the window. The triangle areas of a bucket are computed with
+NumPy when it is installed; otherwise a pure-Python loop gives the same
+points.
+"""
+import itertools
+import os
+from dotenv import load_dotenv
+from database import now_ms, format_timestamp, count_field_values, iter_field_values
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Load environment variables
+load_dotenv()
+
+# Largest series /api/chart_series returns
+CHART_MAX_POINTS = int(os.getenv('CHART_MAX_POINTS', 5000))
+
+# Window used when the request gives no 'since'
+DEFAULT_WINDOW_MS = 7 * 86400000
+
+def lttb(points, threshold, count=None):
+    """
+    Downsample (x, y) points, sorted by x, to at most threshold points.
+
+    The points are read once, a bucket at a time, so they can be streamed
+    straight from a database cursor with only two buckets held in memory.
+    If count turns out to be wrong (rows written or removed since they were
+    counted), extra points join the last bucket, and a short series ends at
+    the last point read.
+
+    Args:
+        points (iterable): (x, y) pairs sorted by x
+        threshold (int): Number of points to keep (at least 3 to downsample)
+        count (int, optional): Number of points (default: len(points))
+
+    Returns:
+        list: The kept (x, y) pairs, in order; all of them if there are
+            few enough
+    """
+    if threshold < 3:
+        return list(points)
+    if count is None:
+        count = len(points)
+    if count <= threshold:
+        points = list(points)
+        if len(points) <= threshold:
+            return points
+        count = len(points)
+
+    select = _select_numpy if np is not None else _select_python
+    points = iter(points)
+    kept = list(itertools.islice(points, 1))
+    bounds = _bucket_bounds(count, threshold)
+    bucket = list(itertools.islice(points, bounds[0][1] - bounds[0][0]))
+    for i in range(len(bounds)):
+        if i + 1 < len(bounds):
+            start, end = bounds[i + 1]
+            following = list(itertools.islice(points, end - start))
+        else:
+            # The last point, after any points added since counting
+            following = list(points)
+            bucket.extend(following[:-1])
+            del following[:-1]
+        if not following:
+            # Fewer points than counted: the last one read ends the series
+            if bucket:
+                last = bucket.pop()
+                if bucket:
+                    kept.append(select(kept[-1], bucket, last))
+                kept.append(last)
+            return kept
+        # The next bucket's average (the last point itself after the last bucket)
+        average = (sum(p[0] for p in following) / len(following), sum(p[1] for p in following) / len(following))
+        kept.append(select(kept[-1], bucket, average))
+        bucket = following
+    kept.append(bucket[0])
+    return kept
+
+def _bucket_bounds(n, threshold):
+    """Start/end indexes of the threshold - 2 middle buckets over points 1 .. n - 2."""
+    # Integer arithmetic, so the last bucket always ends at n - 1
+    buckets = threshold - 2
+    return [(i * (n - 2) // buckets + 1, (i + 1) * (n - 2) // buckets + 1) for i in range(buckets)]
+
+def _select_numpy(a, bucket, c):
+    """The point of bucket forming the largest triangle with points a and c."""
+    # fromiter over the flattened pairs is ~2x faster than np.asarray(bucket)
+    data = np.fromiter(itertools.chain.from_iterable(bucket), dtype=np.float64, count=2 * len(bucket))
+    x, y = data[0::2], data[1::2]
+    # Twice the triangle areas; only their order matters
+    areas = np.abs((a[0] - c[0]) * (y - a[1]) - (a[0] - x) * (c[1] - a[1]))
+    return bucket[int(np.argmax(areas))]
+
+def _select_python(a, bucket, c):
+    """The point of bucket forming the largest triangle with points a and c."""
+    ax, ay = a
+    best, best_area = bucket[0], -1.0
+    for point in bucket:
+        area = abs((ax - c[0]) * (point[1] - ay) - (ax - point[0]) * (c[1] - ay))
+        if area > best_area:
+            best, best_area = point, area
+    return best
+
+def chart_series(field, points=500, device_id=None, topic_id=None, since=None, until=None):
+    """
+    A numeric payload field as a chart series of at most points points.
+
+    Args:
+        field (str): Payload field ('value' also matches bare numeric payloads)
+        points (int, optional): Points to return (3 .. CHART_MAX_POINTS)
+        device_id (int, optional): Filter by device ID
+        topic_id (int, optional): Filter by topic ID
+        since (int, optional): Window start in epoch ms (default: 7 days before until)
+        until (int, optional): Window end in epoch ms (default: now)
+
+    Returns:
+        dict: field, since, until, total (values in the window) and series:
+            dicts with timestamp, timestamp_ms and value, oldest first
+
+    Raises:
+        ValueError: If the field name is invalid
+    """
+    points = min(max(points, 3), CHART_MAX_POINTS)
+    until = now_ms() if until is None else until
+    since = until - DEFAULT_WINDOW_MS if since is None else since
+    # Counted first so the values can be downsampled as they are read
+    total = count_field_values(field, device_id, topic_id, since, until)
+    series = lttb(iter_field_values(field, device_id, topic_id, since, until), points, total)
+    return {
+        'field': field,
+        'since': since,
+        'until': until,
+        'total': total,
+        'series': [{'timestamp': format_timestamp(ms), 'timestamp_ms': ms, 'value': value}
+                   for ms, value in series],
+    }
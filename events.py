@@ -0,0 +1,130 @@
+"""
+In-process publish/subscribe for live telemetry (feeds /api/stream).
+
+The ingest paths publish one event per accepted message; each open stream
+holds a Subscription with its own bounded queue and optional filters.
+"""
+import itertools
+import os
+import queue
+import threading
+from dotenv import load_dotenv
+from database import now_ms, format_timestamp
+
+# Load environment variables
+load_dotenv()
+
+# Events buffered per subscriber before it is told to resync
+STREAM_QUEUE_SIZE = int(os.getenv('STREAM_QUEUE_SIZE', 1000))
+
+class Subscription:
+    """
+    One subscriber's queue of events.
+
+    If the subscriber falls behind and its queue fills up, further events are
+    dropped and a single 'resync' event is delivered once there is room, so
+    the client knows to re-fetch instead of silently missing data.
+    """
+
+    def __init__(self, filters=None, max_size=STREAM_QUEUE_SIZE):
+        # Only events whose data matches every filter value are delivered
+        self.filters = {key: value for key, value in (filters or {}).items() if value is not None}
+        self.queue = queue.Queue(maxsize=max(max_size, 1))
+        self.dropped = 0
+        self._overflowed = False
+        self._lock = threading.Lock()
+
+    def matches(self, data):
+        return all(data.get(key) == value for key, value in self.filters.items())
+
+    def put(self, event):
+        with self._lock:
+            if self._overflowed:
+                try:
+                    self.queue.put_nowait(('resync', {'dropped': self.dropped}, None))
+                    self._overflowed = False
+                except queue.Full:
+                    self.dropped += 1
+                    return
+            try:
+                self.queue.put_nowait(event)
+            except queue.Full:
+                self.dropped += 1
+                self._overflowed = True
+
+    def get(self, timeout=None):
+        """Return the next (event_type, data, event_id), or None on timeout."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+class EventBroker:
+    """Fan-out of published events to every matching subscription."""
+
+    def __init__(self):
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.published = 0
+
+    def subscribe(self, **filters):
+        """
+        Register a new subscriber.
+
+        Args:
+            **filters: Event data values to match (e.g. topic_id=3); None is ignored
+
+        Returns:
+            Subscription: Call unsubscribe() with it when done
+        """
+        subscription = Subscription(filters)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, event_type, data):
+        """Deliver an event to every subscriber whose filters match its data."""
+        with self._lock:
+            event_id = next(self._ids)
+            self.published += 1
+            subscriptions = list(self._subscriptions)
+        event = (event_type, data, event_id)
+        for subscription in subscriptions:
+            if subscription.matches(data):
+                subscription.put(event)
+
+    def stats(self):
+        """Return subscriber and event counters."""
+        with self._lock:
+            return {
+                'subscribers': len(self._subscriptions),
+                'published': self.published,
+                'dropped': sum(s.dropped for s in self._subscriptions)
+            }
+
+# Global broker shared by the ingest paths and /api/stream
+event_broker = EventBroker()
+
+def publish_telemetry(client_id, device_id, device_name, topic_id, topic_name, payload):
+    """
+    Publish a newly received telemetry message.
+
+    The event mirrors a /api/latest_data row (without the row ID, which is
+    only assigned when the message is written).
+    """
+    timestamp = now_ms()
+    event_broker.publish('telemetry', {
+        'client_id': client_id,
+        'device_id': device_id,
+        'device_name': device_name,
+        'topic_id': topic_id,
+        'topic_name': topic_name,
+        'payload': payload,
+        'timestamp': format_timestamp(timestamp),
+        'timestamp_ms': timestamp
+    })
@@ -0,0 +1,244 @@
+"""
+Background export jobs with an on-disk result cache.
+
+A job builds an export file (see exporters.py) on a worker thread and
+reports its progress. Finished files are kept in EXPORT_CACHE_DIR under a
+key made from the export parameters, the newest telemetry ID and the row
+count of the scope, so asking again for unchanged data reuses the file.
+"""
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime
+from dotenv import load_dotenv
+from database import VN_TZ, get_max_telemetry_id, get_telemetry_stats, release_db_connection
+from exporters import EXPORT_FORMATS, check_format, parse_fields, resolve_fields, iter_export
+
+# Load environment variables
+load_dotenv()
+
+EXPORT_CACHE_DIR = os.getenv('EXPORT_CACHE_DIR', 'exports')
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', 2))
+# Seconds a finished file (and its job record) is kept
+EXPORT_CACHE_TTL = float(os.getenv('EXPORT_CACHE_TTL', 86400))
+
+class ExportCancelled(Exception):
+    """Raised inside a running job when the manager is shutting down."""
+
+# Marker placed on the queue to tell a worker thread to exit
+_STOP = object()
+
+class ExportJobManager:
+    """
+    Runs export jobs on a few daemon worker threads and tracks their state.
+
+    Job states: 'queued', 'running', 'done', 'failed'. Workers are started
+    on the first submit.
+    """
+
+    def __init__(self, cache_dir=EXPORT_CACHE_DIR, workers=EXPORT_WORKERS, ttl=EXPORT_CACHE_TTL):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.workers = max(workers, 1)
+        self.queue = queue.Queue()
+        self._threads = []
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def submit(self, fmt, name, fields=None, device_id=None, topic_id=None, since=None, until=None):
+        """
+        Start an export job, or finish it at once if the file is already cached.
+
+        Args:
+            fmt (str): One of EXPORT_FORMATS
+            name (str): Download file name without extension
+            fields (str, optional): Comma separated column projection
+            device_id (int, optional): Filter by device ID
+            topic_id (int, optional): Filter by topic ID
+            since (int, optional): Only rows at or after this time (epoch ms)
+            until (int, optional): Only rows before this time (epoch ms)
+
+        Returns:
+            dict: The job status (see status())
+
+        Raises:
+            ExportError: If the format or fields are invalid
+        """
+        check_format(fmt)
+        parse_fields(fields)
+        self._purge_expired()
+
+        total_rows = self._scope_row_count(device_id, topic_id)
+        key = self._cache_key(fmt, fields, device_id, topic_id, since, until, total_rows)
+        path = os.path.join(self.cache_dir, f'{key}.{EXPORT_FORMATS[fmt][1]}')
+
+        job = {
+            'id': uuid.uuid4().hex,
+            'status': 'queued',
+            'format': fmt,
+            'filename': f'{name}.{EXPORT_FORMATS[fmt][1]}',
+            'params': {'fields': fields, 'device_id': device_id, 'topic_id': topic_id,
+                       'since': since, 'until': until},
+            'rows_written': 0,
+            'total_rows': total_rows,
+            'cached': False,
+            'size': None,
+            'error': None,
+            'created_at': datetime.now(VN_TZ).isoformat(),
+            'finished_at': None,
+            'path': path,
+            'created': time.monotonic(),
+        }
+
+        if os.path.exists(path):
+            os.utime(path)
+            job.update(status='done', cached=True, rows_written=total_rows,
+                       size=os.path.getsize(path), finished_at=job['created_at'])
+            with self._lock:
+                self._jobs[job['id']] = job
+            return self.status(job['id'])
+
+        with self._lock:
+            # The same file is already being built: report that job instead
+            building = next((other['id'] for other in self._jobs.values()
+                             if other['path'] == path and other['status'] in ('queued', 'running')), None)
+            if building is None:
+                self._jobs[job['id']] = job
+        if building is not None:
+            return self.status(building)
+        self._start_workers()
+        self.queue.put(job)
+        return self.status(job['id'])
+
+    def status(self, job_id):
+        """Return a copy of a job's public state, or None if the job is unknown."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            info = {k: v for k, v in job.items() if k not in ('path', 'created')}
+        total = info['total_rows']
+        if info['status'] == 'done':
+            info['progress'] = 1.0
+        else:
+            info['progress'] = round(min(info['rows_written'] / total, 1.0), 4) if total else 0.0
+        return info
+
+    def file_path(self, job_id):
+        """Return the result file of a finished job, or None."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['status'] != 'done':
+                return None
+            return job['path']
+
+    def shutdown(self):
+        """Stop the workers; running jobs are abandoned at their next progress report."""
+        self._stopping.set()
+        for _ in self._threads:
+            self.queue.put(_STOP)
+
+    def _start_workers(self):
+        with self._lock:
+            if self._threads or self._stopping.is_set():
+                return
+            for n in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'export-{n}')
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        """Worker thread entry point."""
+        while True:
+            job = self.queue.get()
+            if job is _STOP:
+                return
+            if self._stopping.is_set():
+                self._update(job, status='failed', error='Server is shutting down')
+                continue
+            self._run(job)
+
+    def _run(self, job):
+        """Build the file for a job, then move it into the cache."""
+        params = job['params']
+        tmp_path = f"{job['path']}.{job['id']}.tmp"
+        self._update(job, status='running')
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fields = resolve_fields(params['fields'], job['format'], params['device_id'],
+                                    params['topic_id'], params['since'], params['until'])
+            chunks = iter_export(job['format'], fields, params['device_id'], params['topic_id'],
+                                 params['since'], params['until'],
+                                 on_progress=lambda rows: self._progress(job, rows))
+            with open(tmp_path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(tmp_path, job['path'])
+            self._update(job, status='done', size=os.path.getsize(job['path']),
+                         finished_at=datetime.now(VN_TZ).isoformat())
+            print(f"Export job {job['id']} finished: {job['rows_written']} rows")
+        except Exception as e:
+            print(f"Export job {job['id']} failed: {e}")
+            self._update(job, status='failed', error=str(e), finished_at=datetime.now(VN_TZ).isoformat())
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        finally:
+            release_db_connection()
+
+    def _progress(self, job, rows):
+        if self._stopping.is_set():
+            raise ExportCancelled("Server is shutting down")
+        self._update(job, rows_written=rows)
+
+    def _update(self, job, **changes):
+        with self._lock:
+            job.update(changes)
+
+    def _scope_row_count(self, device_id, topic_id):
+        """Row count of the scope from the maintained stats (an upper bound with extra filters)."""
+        if device_id is not None:
+            return get_telemetry_stats('device', device_id)['row_count']
+        if topic_id is not None:
+            return get_telemetry_stats('topic', topic_id)['row_count']
+        return get_telemetry_stats('telemetry', 0)['row_count']
+
+    def _cache_key(self, fmt, fields, device_id, topic_id, since, until, row_count):
+        """Key the result on the export parameters and the state of the data."""
+        raw = json.dumps({
+            'format': fmt, 'fields': fields, 'device_id': device_id, 'topic_id': topic_id,
+            'since': since, 'until': until,
+            # New rows raise the max ID; deletions change the row count
+            'max_id': get_max_telemetry_id(), 'rows': row_count,
+        }, sort_keys=True)
+        return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+    def _purge_expired(self):
+        """Drop finished jobs and cached files older than the TTL."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job['status'] in ('done', 'failed') and now - job['created'] > self.ttl]
+            for job_id in expired:
+                del self._jobs[job_id]
+            in_use = {job['path'] for job in self._jobs.values()}
+
+        if not os.path.isdir(self.cache_dir):
+            return
+        cutoff = time.time() - self.ttl
+        for entry in os.scandir(self.cache_dir):
+            if entry.path in in_use or not entry.is_file():
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+# Global instance used by the web app
+export_jobs = ExportJobManager()
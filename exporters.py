@@ -0,0 +1,348 @@
+"""
+Telemetry export writers (CSV, NDJSON, Parquet, Arrow).
+
+Payload JSON objects are flattened into one column per leaf key
+('payload.<key>', nested keys joined with '.'); payloads that are not
+objects go to a single 'payload' column. Output is produced in row-group
+sized chunks so memory stays bounded regardless of the export size.
+
+Parquet and Arrow need the optional pyarrow package.
+"""
+import csv
+import io
+import os
+from dotenv import load_dotenv
+import json_codec
+from database import iter_telemetry, get_topic_schema
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Load environment variables
+load_dotenv()
+
+# Rows per Parquet row group / Arrow record batch (and per CSV/NDJSON flush)
+EXPORT_ROW_GROUP_SIZE = int(os.getenv('EXPORT_ROW_GROUP_SIZE', 16384))
+
+# format -> (mimetype, file extension)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.file', 'arrow'),
+}
+
+# Columns taken from the telemetry row itself, with their types
+BASE_FIELDS = {
+    'id': 'int',
+    'timestamp': 'timestamp',
+    'device_id': 'int',
+    'device_name': 'string',
+    'topic_id': 'int',
+    'topic_name': 'string',
+}
+
+# Payload columns also stored as typed telemetry columns (see PAYLOAD_VALUE_SQL)
+TYPED_FIELDS = {'payload.value': 'value', 'payload.unit': 'unit'}
+
+class ExportError(ValueError):
+    """Raised for export requests that cannot be served (bad format or fields)."""
+
+def flatten_payload(payload):
+    """
+    Flatten a stored payload into {column: value}.
+
+    Args:
+        payload (str): The payload as stored (normally a JSON string)
+
+    Returns:
+        dict: 'payload.<key>' columns for JSON objects, else {'payload': value}.
+            Arrays are kept as JSON strings.
+    """
+    try:
+        value = json_codec.loads(payload) if isinstance(payload, str) else payload
+    except json_codec.JSONDecodeError:
+        return {'payload': payload}
+    if not isinstance(value, dict):
+        return {'payload': json_codec.dumps(value) if isinstance(value, list) else value}
+
+    flat = {}
+    stack = [('payload', value)]
+    while stack:
+        prefix, obj = stack.pop()
+        for key, item in obj.items():
+            column = f'{prefix}.{key}'
+            if isinstance(item, dict):
+                stack.append((column, item))
+            elif isinstance(item, list):
+                flat[column] = json_codec.dumps(item)
+            else:
+                flat[column] = item
+    return flat
+
+def _merge_type(current, new):
+    """Widen a column type so it can hold both kinds of value."""
+    if current is None or current == new:
+        return new
+    if {current, new} == {'int', 'float'}:
+        return 'float'
+    return 'string'
+
+def merge_schema(rows):
+    """
+    Merge schema registry rows into one entry per payload column.
+
+    Args:
+        rows (list): Rows from get_topic_schema (any number of topics)
+
+    Returns:
+        dict: Column name -> dict with type (the widened column type, 'string'
+            if only nulls were seen), types ({observed type: count}), count,
+            first_seen and last_seen (epoch ms), sorted by column name
+    """
+    columns = {}
+    for row in rows:
+        column = columns.setdefault(row['field'], {
+            'type': None, 'types': {}, 'count': 0,
+            'first_seen': row['first_seen'], 'last_seen': row['last_seen'],
+        })
+        if row['type'] != 'null':
+            column['type'] = _merge_type(column['type'], row['type'])
+        column['types'][row['type']] = column['types'].get(row['type'], 0) + row['count']
+        column['count'] += row['count']
+        column['first_seen'] = min(column['first_seen'], row['first_seen'])
+        column['last_seen'] = max(column['last_seen'], row['last_seen'])
+    for column in columns.values():
+        column['type'] = column['type'] or 'string'
+    return dict(sorted(columns.items()))
+
+def discover_fields(device_id=None, topic_id=None, since=None, until=None):
+    """
+    Find every flattened column and its type from the payload schema registry.
+
+    No telemetry is read. The columns are those of every topic in scope that
+    were seen during the window, so a column may come out empty when the
+    matching rows (e.g. of another device on the same topic) lack it.
+
+    Returns:
+        dict: Column name -> 'int', 'float', 'bool' or 'string', base columns first
+    """
+    fields = dict(BASE_FIELDS)
+    for column, info in merge_schema(get_topic_schema(topic_id, device_id, since, until)).items():
+        fields[column] = info['type']
+    return fields
+
+def parse_fields(fields_param):
+    """
+    Split and validate a comma separated fields= value.
+
+    Returns:
+        list: Requested column names (empty if no projection was given)
+
+    Raises:
+        ExportError: If a requested base column does not exist
+    """
+    requested = [name.strip() for name in (fields_param or '').split(',') if name.strip()]
+    unknown = [name for name in requested
+               if name not in BASE_FIELDS and name != 'payload' and not name.startswith('payload.')]
+    if unknown:
+        raise ExportError(f"Unknown export fields: {', '.join(unknown)}")
+    return requested
+
+def resolve_fields(fields_param, fmt, device_id=None, topic_id=None, since=None, until=None):
+    """
+    Work out the output columns from a comma separated fields= value.
+
+    Without a projection every base column and every payload column in the
+    schema registry is exported, except for NDJSON where each line simply
+    carries its own keys (None is returned). Projected payload columns take
+    their types from the registry.
+
+    Raises:
+        ExportError: If a requested base column does not exist
+    """
+    requested = parse_fields(fields_param)
+    if not requested:
+        if fmt == 'ndjson':
+            return None
+        return discover_fields(device_id, topic_id, since, until)
+
+    discovered = {}
+    if any(name not in BASE_FIELDS for name in requested):
+        discovered = discover_fields(device_id, topic_id, since, until)
+    return {name: BASE_FIELDS.get(name) or discovered.get(name, 'string') for name in requested}
+
+def _coerce(value, field_type):
+    """Convert a flattened value to the column's declared type (None if it cannot be)."""
+    if value is None:
+        return None
+    try:
+        if field_type == 'float':
+            return float(value)
+        if field_type == 'int':
+            return int(value) if not isinstance(value, float) else None
+        if field_type == 'bool':
+            return value if isinstance(value, bool) else None
+    except (TypeError, ValueError):
+        return None
+    if field_type == 'string' and not isinstance(value, str):
+        return json_codec.dumps(value)
+    return value
+
+def _project(row, fields):
+    """Build the flattened record for one telemetry row, projected to fields if given."""
+    record = {name: row[name] for name in BASE_FIELDS}
+    payload = row['payload']
+    if (fields is not None and row['value'] is not None and payload.startswith('{')
+            and (row['unit'] is not None or '"unit"' not in payload)
+            and all(name in BASE_FIELDS or name in TYPED_FIELDS for name in fields)):
+        # Only the numeric value and text unit of an object payload are needed: skip parsing it
+        record.update({name: row[column] for name, column in TYPED_FIELDS.items()})
+    else:
+        record.update(flatten_payload(payload))
+    if fields is None:
+        return record
+    return {name: record.get(name) for name in fields}
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object that buffers output until it is drained."""
+
+    def __init__(self):
+        self._buffer = io.BytesIO()
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer.write(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = self._buffer.getvalue()
+        self._buffer = io.BytesIO()
+        return data
+
+def _arrow_schema(fields):
+    types = {
+        'int': pa.int64(),
+        'float': pa.float64(),
+        'bool': pa.bool_(),
+        'string': pa.string(),
+        'timestamp': pa.timestamp('ms', tz='UTC'),
+    }
+    return pa.schema([(name, types[field_type]) for name, field_type in fields.items()])
+
+def _write_csv(rows, fields, size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(list(fields))
+    for count, row in enumerate(rows, 1):
+        writer.writerow(['' if value is None else value for value in _project(row, fields).values()])
+        if count % size == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+def _write_ndjson(rows, fields, size):
+    buffer = io.StringIO()
+    for count, row in enumerate(rows, 1):
+        buffer.write(json_codec.dumps(_project(row, fields)))
+        buffer.write('\n')
+        if count % size == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+def _write_arrow(rows, fields, size, fmt):
+    """Build one record batch (Parquet row group) per size rows, column by column."""
+    schema = _arrow_schema(fields)
+    sink = _ChunkSink()
+    if fmt == 'parquet':
+        writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    else:
+        writer = pa.ipc.new_file(sink, schema)
+    columns = {name: [] for name in fields}
+    try:
+        for count, row in enumerate(rows, 1):
+            record = _project(row, fields)
+            for name, field_type in fields.items():
+                if field_type == 'timestamp':
+                    # The stored epoch milliseconds, not the display string
+                    columns[name].append(row['timestamp_ms'])
+                else:
+                    columns[name].append(_coerce(record[name], field_type))
+            if count % size == 0:
+                writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=schema))
+                columns = {name: [] for name in fields}
+                yield sink.drain()
+        if any(columns.values()):
+            writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=schema))
+    finally:
+        writer.close()
+    yield sink.drain()
+
+def check_format(fmt):
+    """
+    Validate an export format name.
+
+    Raises:
+        ExportError: If the format is unknown or needs pyarrow and it is missing
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ExportError(f"Unsupported export format: {fmt}. Use one of: {', '.join(EXPORT_FORMATS)}")
+    if fmt in ('parquet', 'arrow') and pa is None:
+        raise ExportError(f"The {fmt} format requires the pyarrow package (pip install pyarrow)")
+
+def _counted(rows, on_progress, every):
+    """Pass rows through, reporting the running count every `every` rows and at the end."""
+    count = 0
+    for count, row in enumerate(rows, 1):
+        yield row
+        if count % every == 0:
+            on_progress(count)
+    on_progress(count)
+
+def iter_export(fmt, fields, device_id=None, topic_id=None, since=None, until=None,
+                row_group_size=EXPORT_ROW_GROUP_SIZE, on_progress=None):
+    """
+    Produce an export file as a stream of byte chunks.
+
+    Args:
+        fmt (str): One of EXPORT_FORMATS
+        fields (dict): Output columns and types, from resolve_fields (None for
+            every column, NDJSON only)
+        device_id (int, optional): Filter by device ID
+        topic_id (int, optional): Filter by topic ID
+        since (int, optional): Only rows at or after this time (epoch ms)
+        until (int, optional): Only rows before this time (epoch ms)
+        row_group_size (int, optional): Rows per row group / flushed chunk
+        on_progress (callable, optional): Called with the number of rows read
+            so far, once per row group and when the rows run out
+
+    Yields:
+        bytes: Consecutive pieces of the file
+
+    Raises:
+        ExportError: If the format is unknown or needs pyarrow and it is missing
+    """
+    check_format(fmt)
+    rows = iter_telemetry(device_id=device_id, topic_id=topic_id, since=since, until=until)
+    size = max(row_group_size, 1)
+    if on_progress is not None:
+        rows = _counted(rows, on_progress, size)
+    if fmt == 'csv':
+        return _write_csv(rows, fields, size)
+    if fmt == 'ndjson':
+        return _write_ndjson(rows, fields, size)
+    return _write_arrow(rows, fields, size, fmt)
@@ -0,0 +1,64 @@
+"""
+Conditional GET support (ETag / If-None-Match) for read-only API endpoints.
+
+The ETag is the database's data version (see get_data_version) and is
+checked before the view runs, so an unchanged poll costs four index
+lookups and an empty 304 response. Views whose time window ends "now" by
+default also fold the current ETAG_WINDOW_INTERVAL into it: their response
+changes as the window slides, even when no data is added.
+"""
+import hashlib
+import os
+import time
+from functools import wraps
+from dotenv import load_dotenv
+from flask import request, make_response
+from database import get_data_version
+
+# Load environment variables
+load_dotenv()
+
+# Seconds a window ending "now" is treated as unchanged
+ETAG_WINDOW_INTERVAL = float(os.getenv('ETAG_WINDOW_INTERVAL', 60))
+
+def conditional_get(vary=(), until_arg=None):
+    """
+    Decorate a view so it answers 304 Not Modified while the data is unchanged.
+
+    Args:
+        vary (tuple, optional): Request headers the response depends on (e.g.
+            'X-API-Key'); their values are folded into the ETag
+        until_arg (str, optional): Query parameter ending the view's time
+            window; when it is omitted the window ends now, and the ETag
+            changes every ETAG_WINDOW_INTERVAL seconds
+
+    Returns:
+        callable: The decorator
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            # Taken before the view runs: a change in between only makes the
+            # next request miss, it never serves stale data
+            etag = get_data_version()
+            if vary:
+                values = '\n'.join(request.headers.get(header, '') for header in vary)
+                etag += '-' + hashlib.sha256(values.encode()).hexdigest()[:12]
+            if until_arg and not request.args.get(until_arg):
+                etag += f'-w{int(time.time() // ETAG_WINDOW_INTERVAL)}'
+
+            if request.if_none_match.contains(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            # Let browsers keep the body but revalidate on every request
+            response.headers['Cache-Control'] = 'no-cache'
+            if vary:
+                response.vary.update(vary)
+            return response
+        return decorated_function
+    return decorator
@@ -0,0 +1,213 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from dotenv import load_dotenv
+from database import now_ms, store_telemetry_batch, release_db_connection
+from json_codec import encode_payload
+
+# Load environment variables
+load_dotenv()
+
+# Marker placed on the queue to tell the writer thread to drain and exit
+_STOP = object()
+
+class IngestQueue:
+    """
+    Bounded write-behind queue for telemetry.
+
+    Producers (the MQTT callback thread) only enqueue rows. A dedicated writer
+    thread drains the queue and group-commits rows with store_telemetry_batch,
+    flushing whenever batch_size rows are pending or flush_interval seconds
+    have passed since the first pending row. Rows that cannot be written
+    are handed to dead_letter(topic, payload, reason) instead of dropped.
+    """
+
+    def __init__(self,
+                 batch_size=int(os.getenv('INGEST_BATCH_SIZE', 500)),
+                 flush_interval=float(os.getenv('INGEST_FLUSH_INTERVAL', 0.5)),
+                 max_queue_size=int(os.getenv('INGEST_QUEUE_SIZE', 10000)),
+                 put_timeout=float(os.getenv('INGEST_PUT_TIMEOUT', 5)),
+                 max_retries=3, dead_letter=None):
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.max_retries = max_retries
+        self.dead_letter = dead_letter
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._counters = {'written': 0, 'batches': 0, 'failed': 0, 'rejected': 0}
+
+    def start(self):
+        """Start the writer thread if it is not already running."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='ingest-writer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop the writer thread after flushing every row queued so far.
+
+        The stop marker is queued behind all pending rows, so the writer only
+        exits once everything ahead of it has been committed. If the writer
+        is no longer alive, or the queue stays full for put_timeout seconds,
+        the remaining rows are written (or dead-lettered) from this thread.
+        """
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is None:
+            return
+        if thread.is_alive():
+            try:
+                self.queue.put(_STOP, timeout=self.put_timeout)
+                thread.join()
+                return
+            except queue.Full:
+                print("Error: ingest writer is not keeping up; flushing the queue at shutdown")
+        else:
+            print("Error: ingest writer is not running; flushing the queue at shutdown")
+        self._flush_remaining()
+
+    def is_running(self):
+        """Return True if the writer thread is alive."""
+        thread = self._thread
+        return thread is not None and thread.is_alive()
+
+    def submit(self, device_id, topic_id, payload):
+        """
+        Queue a telemetry row for writing.
+
+        Args:
+            device_id (int): ID of the device sending data
+            topic_id (int): ID of the topic the data belongs to
+            payload: The data payload to store (a JSON value, or JSON text)
+
+        Returns:
+            bool: True if the row was accepted, False otherwise
+        """
+        if not device_id or not topic_id:
+            print("Error: device_id and topic_id must be provided for telemetry data")
+            return False
+
+        # Payloads are always stored as valid JSON text (see encode_payload)
+        try:
+            payload = encode_payload(payload)
+        except (TypeError, ValueError) as e:
+            print(f"Error converting payload to JSON: {e}")
+            return False
+
+        # Record the receive time now so batching does not shift timestamps
+        row = (device_id, topic_id, payload, now_ms())
+
+        if not self.is_running():
+            # No writer (not started or already stopped): write through
+            return self._write([row]) == 1
+
+        try:
+            self.queue.put(row, timeout=self.put_timeout)
+            return True
+        except queue.Full:
+            self._counters['rejected'] += 1
+            print("Error: ingest queue is full, dropping telemetry row")
+            return False
+
+    def stats(self):
+        """Return queue depth and writer counters."""
+        return dict(self._counters, queued=self.queue.qsize(), running=self.is_running())
+
+    def _flush_remaining(self):
+        """Write every row still queued, batch by batch, from the calling thread."""
+        batch = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                batch.append(item)
+            if len(batch) >= self.batch_size:
+                self._write(batch)
+                batch = []
+        if batch:
+            self._write(batch)
+
+    def _run(self):
+        """Writer thread entry point."""
+        try:
+            self._drain()
+        finally:
+            release_db_connection()
+
+    def _drain(self):
+        """Collect queued rows into batches and commit them until stopped."""
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+
+            batch = [item]
+            stopping = False
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            # Keep the writer alive whatever happens to one batch
+            try:
+                self._write(batch)
+            except Exception as e:
+                print(f"Unexpected error in ingest writer: {e}")
+                self._dead_letter(batch, f"Ingest writer error: {e}")
+            if stopping:
+                return
+
+    def _write(self, batch):
+        """Commit a batch, retrying transient database errors; dead-letter it if that fails."""
+        reason = None
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                written = store_telemetry_batch(batch)
+                self._counters['written'] += written
+                self._counters['batches'] += 1
+                return written
+            except sqlite3.Error as e:
+                print(f"Database error writing telemetry batch (attempt {attempt}/{self.max_retries}): {e}")
+                reason = f"Database error: {e}"
+                if attempt < self.max_retries:
+                    time.sleep(0.1 * attempt)
+            except Exception as e:
+                # Not transient: retrying would fail the same way
+                print(f"Error writing telemetry batch: {e}")
+                reason = f"Write error: {e}"
+                break
+
+        print(f"Error: failed to write {len(batch)} telemetry rows")
+        self._dead_letter(batch, reason)
+        return 0
+
+    def _dead_letter(self, batch, reason):
+        """Count rows that could not be written and hand them to dead_letter."""
+        self._counters['failed'] += len(batch)
+        if self.dead_letter is None:
+            return
+        for device_id, topic_id, payload, received_at in batch:
+            try:
+                self.dead_letter(f"device_id={device_id} topic_id={topic_id} received_at={received_at}",
+                                 payload, reason)
+            except Exception as e:
+                print(f"Error dead-lettering telemetry row: {e}")
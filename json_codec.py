@@ -0,0 +1,113 @@
+"""
+JSON encoding/decoding shared by the API, the web app and the MQTT server.
+
+Uses orjson when it is installed and the standard json module otherwise;
+both produce compact output. Telemetry payloads are stored as JSON text
+that was validated on ingest (encode_payload), so responses splice that
+text in verbatim (dumps_with_payloads) instead of decoding every payload
+only to encode it again.
+"""
+import json
+import uuid
+from flask import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Raised by loads() for invalid input (orjson's error is a subclass)
+JSONDecodeError = json.JSONDecodeError
+
+# Stands in for each payload while the rest of a response is encoded. It is
+# random per process, so no stored value can collide with it.
+_PAYLOAD_TOKEN = f'payload:{uuid.uuid4().hex}'
+_ENCODED_PAYLOAD_TOKEN = f'"{_PAYLOAD_TOKEN}"'
+
+def loads(data):
+    """Decode JSON text (str or bytes)."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps(obj):
+    """
+    Encode obj as compact JSON text.
+
+    Non-string dict keys are converted to strings and values the codec does
+    not know are encoded with str().
+
+    Returns:
+        str: The JSON text
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(obj, default=str, separators=(',', ':'), ensure_ascii=False)
+
+def encode_payload(payload):
+    """
+    Turn an incoming payload into the JSON text that is stored.
+
+    Strings that are valid JSON are stored as they are (they are read back
+    as the value they encode); any other string is stored as a JSON string.
+
+    Args:
+        payload: A decoded JSON value or a string
+
+    Returns:
+        str: Valid JSON text
+
+    Raises:
+        TypeError: If the payload cannot be encoded as JSON
+    """
+    if isinstance(payload, str):
+        try:
+            loads(payload)
+            return payload
+        except (JSONDecodeError, ValueError):
+            pass
+    return dumps(payload)
+
+def dumps_with_payloads(obj, rows):
+    """
+    Encode obj, splicing each row's stored payload text in as raw JSON.
+
+    Args:
+        obj: The response object, which contains the row dicts
+        rows (iterable): The telemetry row dicts inside obj whose 'payload'
+            is still the stored JSON text; their payloads are replaced while
+            encoding and put back afterwards
+
+    Returns:
+        str: The JSON text
+    """
+    rows = list(rows)
+    payloads = []
+    for row in rows:
+        payloads.append(row['payload'])
+        row['payload'] = _PAYLOAD_TOKEN
+    try:
+        parts = dumps(obj).split(_ENCODED_PAYLOAD_TOKEN)
+    finally:
+        for row, payload in zip(rows, payloads):
+            row['payload'] = payload
+
+    out = [parts[0]]
+    for payload, part in zip(payloads, parts[1:]):
+        out.append(payload)
+        out.append(part)
+    return ''.join(out)
+
+def json_response(obj, rows=(), status=200):
+    """
+    Build an application/json response, splicing in stored payloads.
+
+    Args:
+        obj: The response object
+        rows (iterable, optional): Telemetry row dicts inside obj, see dumps_with_payloads
+        status (int, optional): HTTP status code
+
+    Returns:
+        Response: The Flask response
+    """
+    return Response(dumps_with_payloads(obj, rows), status=status, mimetype='application/json')
@@ -0,0 +1,882 @@
+"""
+Versioned schema migrations for the SQLite database.
+
+The schema version is stored in SQLite's PRAGMA user_version. schema.sql
+always describes the latest schema, so a fresh database is created from it
+and stamped with SCHEMA_VERSION. Existing databases are upgraded in place by
+applying every migration newer than their recorded version, each in its own
+transaction.
+
+To change the schema: append a migration to MIGRATIONS and make the same
+change to schema.sql.
+"""
+import json
+import re
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from json_codec import encode_payload
+
+def _unique_device_names(conn):
+    """
+    Enforce UNIQUE(name, client_id) on devices.
+
+    Duplicate devices are merged into the oldest row: their telemetry is moved
+    over and the extra rows are deleted before the unique index is created.
+    """
+    duplicates = conn.execute('''
+        SELECT name, client_id, MIN(id) AS keep_id
+        FROM devices
+        GROUP BY name, client_id
+        HAVING COUNT(*) > 1
+    ''').fetchall()
+
+    for name, client_id, keep_id in duplicates:
+        conn.execute('''
+            UPDATE telemetry_data SET device_id = ?
+            WHERE device_id IN (
+                SELECT id FROM devices WHERE name = ? AND client_id = ? AND id != ?
+            )
+        ''', (keep_id, name, client_id, keep_id))
+        conn.execute(
+            'DELETE FROM devices WHERE name = ? AND client_id = ? AND id != ?',
+            (name, client_id, keep_id)
+        )
+        print(f"Merged duplicate devices named '{name}' for client {client_id}")
+
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_devices_name_client ON devices (name, client_id)')
+
+def _telemetry_time_indexes(conn):
+    """Add time-ordered indexes so filtered 'latest N' queries avoid full scans and sorts."""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_telemetry_device_topic_time ON telemetry_data (device_id, topic_id, timestamp)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_telemetry_topic_time ON telemetry_data (topic_id, timestamp)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_telemetry_time ON telemetry_data (timestamp)')
+
+def _telemetry_device_time_index(conn):
+    """Index each device's rows by time for per-device 'latest N' lookups across topics."""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_telemetry_device_time ON telemetry_data (device_id, timestamp)')
+
+# Maintained telemetry counters, kept current by triggers (also in schema.sql).
+# Scopes: 'telemetry' (scope_id 0), 'client', 'device', 'topic' hold telemetry
+# row counts and first/last timestamps; 'clients', 'devices', 'topics'
+# (scope_id 0) hold entity counts.
+STATS_DDL = [
+    '''
+    CREATE TABLE IF NOT EXISTS stats (
+        scope TEXT NOT NULL,
+        scope_id INTEGER NOT NULL,
+        row_count INTEGER NOT NULL DEFAULT 0,
+        first_timestamp TIMESTAMP,
+        last_timestamp TIMESTAMP,
+        PRIMARY KEY (scope, scope_id)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_stats_telemetry_insert AFTER INSERT ON telemetry_data
+    BEGIN
+        INSERT INTO stats (scope, scope_id, row_count, first_timestamp, last_timestamp)
+        VALUES ('telemetry', 0, 1, NEW.timestamp, NEW.timestamp),
+               ('device', NEW.device_id, 1, NEW.timestamp, NEW.timestamp),
+               ('topic', NEW.topic_id, 1, NEW.timestamp, NEW.timestamp)
+        ON CONFLICT (scope, scope_id) DO UPDATE SET
+            row_count = row_count + 1,
+            first_timestamp = COALESCE(MIN(first_timestamp, excluded.first_timestamp), excluded.first_timestamp),
+            last_timestamp = COALESCE(MAX(last_timestamp, excluded.last_timestamp), excluded.last_timestamp);
+        INSERT INTO stats (scope, scope_id, row_count, first_timestamp, last_timestamp)
+        SELECT 'client', client_id, 1, NEW.timestamp, NEW.timestamp FROM devices WHERE id = NEW.device_id
+        ON CONFLICT (scope, scope_id) DO UPDATE SET
+            row_count = row_count + 1,
+            first_timestamp = COALESCE(MIN(first_timestamp, excluded.first_timestamp), excluded.first_timestamp),
+            last_timestamp = COALESCE(MAX(last_timestamp, excluded.last_timestamp), excluded.last_timestamp);
+    END
+    ''',
+    # first/last timestamps are not narrowed on delete; they stay outer bounds
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_stats_telemetry_delete AFTER DELETE ON telemetry_data
+    BEGIN
+        UPDATE stats SET row_count = row_count - 1 WHERE scope = 'telemetry' AND scope_id = 0;
+        UPDATE stats SET row_count = row_count - 1 WHERE scope = 'device' AND scope_id = OLD.device_id;
+        UPDATE stats SET row_count = row_count - 1 WHERE scope = 'topic' AND scope_id = OLD.topic_id;
+        UPDATE stats SET row_count = row_count - 1
+        WHERE scope = 'client' AND scope_id = (SELECT client_id FROM devices WHERE id = OLD.device_id);
+    END
+    ''',
+    # Cascaded telemetry deletes run after the device row is gone and cannot
+    # find its client, so the device's whole count is moved off the client first
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_stats_device_before_delete BEFORE DELETE ON devices
+    BEGIN
+        UPDATE stats SET row_count = row_count - COALESCE(
+            (SELECT row_count FROM stats WHERE scope = 'device' AND scope_id = OLD.id), 0)
+        WHERE scope = 'client' AND scope_id = OLD.client_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_stats_device_delete AFTER DELETE ON devices
+    BEGIN
+        DELETE FROM stats WHERE scope = 'device' AND scope_id = OLD.id;
+        UPDATE stats SET row_count = row_count - 1 WHERE scope = 'devices' AND scope_id = 0;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_stats_device_insert AFTER INSERT ON devices
+    BEGIN
+        UPDATE stats SET row_count = row_count + 1 WHERE scope = 'devices' AND scope_id = 0;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_stats_topic_delete AFTER DELETE ON topics
+    BEGIN
+        DELETE FROM stats WHERE scope = 'topic' AND scope_id = OLD.id;
+        UPDATE stats SET row_count = row_count - 1 WHERE scope = 'topics' AND scope_id = 0;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_stats_topic_insert AFTER INSERT ON topics
+    BEGIN
+        UPDATE stats SET row_count = row_count + 1 WHERE scope = 'topics' AND scope_id = 0;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_stats_client_delete AFTER DELETE ON clients
+    BEGIN
+        DELETE FROM stats WHERE scope = 'client' AND scope_id = OLD.id;
+        UPDATE stats SET row_count = row_count - 1 WHERE scope = 'clients' AND scope_id = 0;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_stats_client_insert AFTER INSERT ON clients
+    BEGIN
+        UPDATE stats SET row_count = row_count + 1 WHERE scope = 'clients' AND scope_id = 0;
+    END
+    ''',
+]
+
+def _stats_table(conn):
+    """Create the maintained stats table and its triggers, backfilled from existing rows."""
+    for statement in STATS_DDL:
+        conn.execute(statement)
+
+    conn.execute('DELETE FROM stats')
+    conn.execute('''
+        INSERT INTO stats (scope, scope_id, row_count, first_timestamp, last_timestamp)
+        SELECT 'telemetry', 0, COUNT(*), MIN(timestamp), MAX(timestamp) FROM telemetry_data
+    ''')
+    conn.execute('''
+        INSERT INTO stats (scope, scope_id, row_count, first_timestamp, last_timestamp)
+        SELECT 'device', device_id, COUNT(*), MIN(timestamp), MAX(timestamp)
+        FROM telemetry_data WHERE device_id IN (SELECT id FROM devices)
+        GROUP BY device_id
+    ''')
+    conn.execute('''
+        INSERT INTO stats (scope, scope_id, row_count, first_timestamp, last_timestamp)
+        SELECT 'topic', topic_id, COUNT(*), MIN(timestamp), MAX(timestamp)
+        FROM telemetry_data WHERE topic_id IN (SELECT id FROM topics)
+        GROUP BY topic_id
+    ''')
+    conn.execute('''
+        INSERT INTO stats (scope, scope_id, row_count, first_timestamp, last_timestamp)
+        SELECT 'client', d.client_id, COUNT(*), MIN(t.timestamp), MAX(t.timestamp)
+        FROM telemetry_data t JOIN devices d ON d.id = t.device_id
+        GROUP BY d.client_id
+    ''')
+    for scope, table in (('clients', 'clients'), ('devices', 'devices'), ('topics', 'topics')):
+        conn.execute(
+            f'INSERT INTO stats (scope, scope_id, row_count) SELECT ?, 0, COUNT(*) FROM {table}',
+            (scope,)
+        )
+
+# Newest reading per (device, topic), kept current by triggers (also in schema.sql).
+# Ordering is (timestamp, telemetry_id), matching the "latest N" queries.
+DEVICE_LATEST_DDL = [
+    '''
+    CREATE TABLE IF NOT EXISTS device_latest (
+        device_id INTEGER NOT NULL,
+        topic_id INTEGER NOT NULL,
+        telemetry_id INTEGER NOT NULL,
+        payload TEXT NOT NULL,
+        timestamp TIMESTAMP,
+        PRIMARY KEY (device_id, topic_id),
+        FOREIGN KEY (device_id) REFERENCES devices (id) ON DELETE CASCADE,
+        FOREIGN KEY (topic_id) REFERENCES topics (id) ON DELETE CASCADE
+    ) WITHOUT ROWID
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_device_latest_topic ON device_latest (topic_id)',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_device_latest_insert AFTER INSERT ON telemetry_data
+    BEGIN
+        INSERT INTO device_latest (device_id, topic_id, telemetry_id, payload, timestamp)
+        VALUES (NEW.device_id, NEW.topic_id, NEW.id, NEW.payload, NEW.timestamp)
+        ON CONFLICT (device_id, topic_id) DO UPDATE SET
+            telemetry_id = excluded.telemetry_id,
+            payload = excluded.payload,
+            timestamp = excluded.timestamp
+        WHERE (excluded.timestamp, excluded.telemetry_id) > (timestamp, telemetry_id);
+    END
+    ''',
+    # Deleting the current latest row falls back to the next newest one. During
+    # a device/topic cascade the parent is already gone, so nothing is re-added.
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_device_latest_delete AFTER DELETE ON telemetry_data
+    BEGIN
+        DELETE FROM device_latest
+        WHERE device_id = OLD.device_id AND topic_id = OLD.topic_id AND telemetry_id = OLD.id;
+        INSERT INTO device_latest (device_id, topic_id, telemetry_id, payload, timestamp)
+        SELECT device_id, topic_id, id, payload, timestamp FROM telemetry_data
+        WHERE device_id = OLD.device_id AND topic_id = OLD.topic_id
+          AND NOT EXISTS (SELECT 1 FROM device_latest WHERE device_id = OLD.device_id AND topic_id = OLD.topic_id)
+          AND EXISTS (SELECT 1 FROM devices WHERE id = OLD.device_id)
+          AND EXISTS (SELECT 1 FROM topics WHERE id = OLD.topic_id)
+        ORDER BY timestamp DESC, id DESC
+        LIMIT 1;
+    END
+    ''',
+]
+
+def _device_latest_table(conn):
+    """Create the latest-reading-per-device table and its triggers, backfilled from existing rows."""
+    for statement in DEVICE_LATEST_DDL:
+        conn.execute(statement)
+
+    conn.execute('DELETE FROM device_latest')
+    conn.execute('''
+        INSERT INTO device_latest (device_id, topic_id, telemetry_id, payload, timestamp)
+        SELECT t.device_id, t.topic_id, t.id, t.payload, t.timestamp
+        FROM devices d
+        JOIN topics tp
+        JOIN telemetry_data t ON t.id = (
+            SELECT id FROM telemetry_data
+            WHERE device_id = d.id AND topic_id = tp.id
+            ORDER BY timestamp DESC, id DESC
+            LIMIT 1
+        )
+    ''')
+
+# Metadata generation counter (also in schema.sql): the ('generation', 0) stats
+# row is bumped whenever a client, topic or device is added, removed or
+# renamed, so API responses can be versioned without scanning any table.
+# devices.last_seen is left out: it only changes together with telemetry.
+GENERATION_DDL = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_generation_clients_insert AFTER INSERT ON clients
+    BEGIN
+        UPDATE stats SET row_count = row_count + 1 WHERE scope = 'generation' AND scope_id = 0;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_generation_clients_delete AFTER DELETE ON clients
+    BEGIN
+        UPDATE stats SET row_count = row_count + 1 WHERE scope = 'generation' AND scope_id = 0;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_generation_clients_update AFTER UPDATE OF name, api_key ON clients
+    BEGIN
+        UPDATE stats SET row_count = row_count + 1 WHERE scope = 'generation' AND scope_id = 0;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_generation_topics_insert AFTER INSERT ON topics
+    BEGIN
+        UPDATE stats SET row_count = row_count + 1 WHERE scope = 'generation' AND scope_id = 0;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_generation_topics_delete AFTER DELETE ON topics
+    BEGIN
+        UPDATE stats SET row_count = row_count + 1 WHERE scope = 'generation' AND scope_id = 0;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_generation_topics_update AFTER UPDATE OF name, description, client_id ON topics
+    BEGIN
+        UPDATE stats SET row_count = row_count + 1 WHERE scope = 'generation' AND scope_id = 0;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_generation_devices_insert AFTER INSERT ON devices
+    BEGIN
+        UPDATE stats SET row_count = row_count + 1 WHERE scope = 'generation' AND scope_id = 0;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_generation_devices_delete AFTER DELETE ON devices
+    BEGIN
+        UPDATE stats SET row_count = row_count + 1 WHERE scope = 'generation' AND scope_id = 0;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_generation_devices_update AFTER UPDATE OF name, description, client_id ON devices
+    BEGIN
+        UPDATE stats SET row_count = row_count + 1 WHERE scope = 'generation' AND scope_id = 0;
+    END
+    ''',
+]
+
+def _generation_counter(conn):
+    """Add the metadata generation counter and the triggers that bump it."""
+    for statement in GENERATION_DDL:
+        conn.execute(statement)
+    conn.execute("INSERT OR IGNORE INTO stats (scope, scope_id, row_count) VALUES ('generation', 0, 0)")
+
+def _json_payloads(conn):
+    """
+    Rewrite stored payloads that are not valid JSON text as JSON strings.
+
+    Responses splice stored payloads into their JSON verbatim, so every
+    payload must be valid JSON; new ones are normalized on ingest by
+    encode_payload, which is also used here so both agree on what is valid.
+    """
+    conn.create_function('encode_payload', 1, encode_payload, deterministic=True)
+    for table in ('telemetry_data', 'device_latest'):
+        conn.execute(f'''
+            UPDATE {table} SET payload = encode_payload(payload)
+            WHERE encode_payload(payload) IS NOT payload
+        ''')
+
+# Stored text timestamp (UTC 'YYYY-MM-DD HH:MM:SS' or ISO 8601) -> epoch milliseconds
+_TEXT_TO_MS = "CAST(ROUND((julianday({0}) - 2440587.5) * 86400000) AS INTEGER)"
+
+def _epoch_ms_timestamps(conn):
+    """
+    Store telemetry timestamps as integer epoch milliseconds (UTC).
+
+    SQLite cannot change a column's type in place, so telemetry_data is
+    rebuilt with the same row IDs (and AUTOINCREMENT sequence), then its
+    indexes and triggers are recreated. device_latest timestamps are
+    converted, the stats are recounted, and devices.last_seen is rewritten in the
+    UTC 'YYYY-MM-DD HH:MM:SS' format used for displaying timestamps.
+    Unparseable timestamps become 0.
+    """
+    sequence = conn.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name = 'telemetry_data'"
+    ).fetchone()
+
+    conn.execute('''
+        CREATE TABLE telemetry_data_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id INTEGER NOT NULL,
+            topic_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            timestamp INTEGER NOT NULL DEFAULT (CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)),
+            FOREIGN KEY (device_id) REFERENCES devices (id) ON DELETE CASCADE,
+            FOREIGN KEY (topic_id) REFERENCES topics (id) ON DELETE CASCADE
+        )
+    ''')
+    conn.execute(f'''
+        INSERT INTO telemetry_data_new (id, device_id, topic_id, payload, timestamp)
+        SELECT id, device_id, topic_id, payload, COALESCE({_TEXT_TO_MS.format('timestamp')}, 0)
+        FROM telemetry_data
+    ''')
+    # Also drops the old table's indexes and triggers
+    conn.execute('DROP TABLE telemetry_data')
+    conn.execute('ALTER TABLE telemetry_data_new RENAME TO telemetry_data')
+    if sequence:
+        # Keep IDs of deleted rows from being handed out again
+        conn.execute(
+            "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'telemetry_data'",
+            (sequence[0],)
+        )
+
+    _telemetry_time_indexes(conn)
+    _telemetry_device_time_index(conn)
+    for statement in DEVICE_LATEST_DDL:
+        conn.execute(statement)
+
+    conn.execute(f'''
+        UPDATE device_latest SET timestamp = COALESCE({_TEXT_TO_MS.format('timestamp')}, 0)
+        WHERE typeof(timestamp) = 'text'
+    ''')
+    # Rebuild the stats from the converted rows, keeping the generation counter
+    generation = conn.execute(
+        "SELECT row_count FROM stats WHERE scope = 'generation' AND scope_id = 0"
+    ).fetchone()
+    _stats_table(conn)
+    conn.execute(
+        "INSERT INTO stats (scope, scope_id, row_count) VALUES ('generation', 0, ?)",
+        (generation[0] if generation else 0,)
+    )
+    conn.execute('''
+        UPDATE devices SET last_seen = strftime('%Y-%m-%d %H:%M:%S', last_seen)
+        WHERE last_seen IS NOT NULL
+    ''')
+
+# Telemetry is split into time partitions: one table per UTC day or month,
+# listed in the telemetry_partitions catalog (also in schema.sql) with the
+# [start_ms, end_ms) range of timestamps it holds. Partition tables are created
+# on demand by database.py from this DDL ({table} is the partition name).
+# Row IDs are global: they are handed out from the ('telemetry_id', 0) stats row.
+TELEMETRY_PARTITIONS_DDL = '''
+    CREATE TABLE IF NOT EXISTS telemetry_partitions (
+        name TEXT PRIMARY KEY,
+        start_ms INTEGER NOT NULL,
+        end_ms INTEGER NOT NULL
+    )
+'''
+
+# Typed copies of the common payload fields, filled on ingest: value is a
+# numeric top-level 'value' key (or the payload itself when it is a bare
+# number), unit a text top-level 'unit' key; both are NULL otherwise. value
+# has no declared type (no affinity), so readings keep the integer or real
+# type they were sent as. The expressions take the JSON payload text as {0}.
+PAYLOAD_VALUE_SQL = '''CASE WHEN json_type({0}, '$.value') IN ('integer', 'real') THEN json_extract({0}, '$.value')
+                            WHEN json_type({0}) IN ('integer', 'real') THEN json_extract({0}, '$') END'''
+PAYLOAD_UNIT_SQL = "CASE WHEN json_type({0}, '$.unit') = 'text' THEN json_extract({0}, '$.unit') END"
+
+# The JSON text of a stored payload column {0}. Compressed payloads are BLOBs
+# (see compression.py), decoded by the payload_text() SQL function database.py
+# registers on its connections; JSON text is used as it is.
+PAYLOAD_TEXT_SQL = "CASE WHEN typeof({0}) = 'blob' THEN payload_text({0}) ELSE {0} END"
+
+TELEMETRY_VALUE_INDEX = 'CREATE INDEX IF NOT EXISTS idx_{table}_value ON {table} (value) WHERE value IS NOT NULL'
+
+TELEMETRY_PARTITION_DDL = [
+    '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY,
+        device_id INTEGER NOT NULL,
+        topic_id INTEGER NOT NULL,
+        payload TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        value,
+        unit TEXT,
+        FOREIGN KEY (device_id) REFERENCES devices (id) ON DELETE CASCADE,
+        FOREIGN KEY (topic_id) REFERENCES topics (id) ON DELETE CASCADE
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_{table}_device_topic_time ON {table} (device_id, topic_id, timestamp)',
+    'CREATE INDEX IF NOT EXISTS idx_{table}_device_time ON {table} (device_id, timestamp)',
+    'CREATE INDEX IF NOT EXISTS idx_{table}_topic_time ON {table} (topic_id, timestamp)',
+    'CREATE INDEX IF NOT EXISTS idx_{table}_time ON {table} (timestamp)',
+    TELEMETRY_VALUE_INDEX,
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_{table}_stats_insert AFTER INSERT ON {table}
+    BEGIN
+        INSERT INTO stats (scope, scope_id, row_count, first_timestamp, last_timestamp)
+        VALUES ('telemetry', 0, 1, NEW.timestamp, NEW.timestamp),
+               ('device', NEW.device_id, 1, NEW.timestamp, NEW.timestamp),
+               ('topic', NEW.topic_id, 1, NEW.timestamp, NEW.timestamp)
+        ON CONFLICT (scope, scope_id) DO UPDATE SET
+            row_count = row_count + 1,
+            first_timestamp = COALESCE(MIN(first_timestamp, excluded.first_timestamp), excluded.first_timestamp),
+            last_timestamp = COALESCE(MAX(last_timestamp, excluded.last_timestamp), excluded.last_timestamp);
+        INSERT INTO stats (scope, scope_id, row_count, first_timestamp, last_timestamp)
+        SELECT 'client', client_id, 1, NEW.timestamp, NEW.timestamp FROM devices WHERE id = NEW.device_id
+        ON CONFLICT (scope, scope_id) DO UPDATE SET
+            row_count = row_count + 1,
+            first_timestamp = COALESCE(MIN(first_timestamp, excluded.first_timestamp), excluded.first_timestamp),
+            last_timestamp = COALESCE(MAX(last_timestamp, excluded.last_timestamp), excluded.last_timestamp);
+    END
+    ''',
+    # first/last timestamps are not narrowed on delete; they stay outer bounds
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_{table}_stats_delete AFTER DELETE ON {table}
+    BEGIN
+        UPDATE stats SET row_count = row_count - 1 WHERE scope = 'telemetry' AND scope_id = 0;
+        UPDATE stats SET row_count = row_count - 1 WHERE scope = 'device' AND scope_id = OLD.device_id;
+        UPDATE stats SET row_count = row_count - 1 WHERE scope = 'topic' AND scope_id = OLD.topic_id;
+        UPDATE stats SET row_count = row_count - 1
+        WHERE scope = 'client' AND scope_id = (SELECT client_id FROM devices WHERE id = OLD.device_id);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_{table}_latest_insert AFTER INSERT ON {table}
+    BEGIN
+        INSERT INTO device_latest (device_id, topic_id, telemetry_id, payload, timestamp)
+        VALUES (NEW.device_id, NEW.topic_id, NEW.id, NEW.payload, NEW.timestamp)
+        ON CONFLICT (device_id, topic_id) DO UPDATE SET
+            telemetry_id = excluded.telemetry_id,
+            payload = excluded.payload,
+            timestamp = excluded.timestamp
+        WHERE (excluded.timestamp, excluded.telemetry_id) > (timestamp, telemetry_id);
+    END
+    ''',
+    # Falls back to the next newest row of the same partition only; older
+    # partitions are not searched (deletes normally remove the oldest rows)
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_{table}_latest_delete AFTER DELETE ON {table}
+    BEGIN
+        DELETE FROM device_latest
+        WHERE device_id = OLD.device_id AND topic_id = OLD.topic_id AND telemetry_id = OLD.id;
+        INSERT INTO device_latest (device_id, topic_id, telemetry_id, payload, timestamp)
+        SELECT device_id, topic_id, id, payload, timestamp FROM {table}
+        WHERE device_id = OLD.device_id AND topic_id = OLD.topic_id
+          AND NOT EXISTS (SELECT 1 FROM device_latest WHERE device_id = OLD.device_id AND topic_id = OLD.topic_id)
+          AND EXISTS (SELECT 1 FROM devices WHERE id = OLD.device_id)
+          AND EXISTS (SELECT 1 FROM topics WHERE id = OLD.topic_id)
+        ORDER BY timestamp DESC, id DESC
+        LIMIT 1;
+    END
+    ''',
+]
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def telemetry_partition_bounds(timestamp, period='month'):
+    """
+    Return the UTC day or month containing a timestamp.
+
+    Args:
+        timestamp (int): Epoch milliseconds
+        period (str, optional): 'day' or 'month'
+
+    Returns:
+        tuple: (start_ms, end_ms) of the period
+
+    Raises:
+        ValueError: If the period is unknown
+    """
+    moment = _EPOCH + timedelta(milliseconds=timestamp)
+    if period == 'day':
+        start = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+        end = start + timedelta(days=1)
+    elif period == 'month':
+        start = moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        end = start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    else:
+        raise ValueError(f"Unknown telemetry partition period: {period}. Use 'day' or 'month'")
+    return (start - _EPOCH) // timedelta(milliseconds=1), (end - _EPOCH) // timedelta(milliseconds=1)
+
+def telemetry_partition_name(start_ms):
+    """Name of the partition table starting at start_ms (telemetry_YYYYMMDD, UTC)."""
+    return 'telemetry_' + (_EPOCH + timedelta(milliseconds=start_ms)).strftime('%Y%m%d')
+
+def create_telemetry_partition(conn, start_ms, end_ms):
+    """
+    Create a partition table for [start_ms, end_ms) and add it to the catalog.
+
+    Returns:
+        str: The partition table name
+    """
+    table = telemetry_partition_name(start_ms)
+    for statement in TELEMETRY_PARTITION_DDL:
+        conn.execute(statement.format(table=table))
+    conn.execute(
+        'INSERT INTO telemetry_partitions (name, start_ms, end_ms) VALUES (?, ?, ?)',
+        (table, start_ms, end_ms)
+    )
+    return table
+
+def _telemetry_partitions(conn):
+    """
+    Move telemetry_data into monthly partition tables.
+
+    Rows keep their IDs; the next free ID is carried over from the
+    AUTOINCREMENT sequence to the ('telemetry_id', 0) stats row. Each
+    partition is filled before its indexes and triggers are created, so the
+    stats and device_latest tables (already correct) are left as they are.
+    """
+    conn.execute(TELEMETRY_PARTITIONS_DDL)
+    starts = {
+        telemetry_partition_bounds(row[0])
+        for row in conn.execute('''
+            SELECT DISTINCT CAST(strftime('%s', timestamp / 1000.0, 'unixepoch', 'start of month') AS INTEGER) * 1000
+            FROM telemetry_data
+        ''')
+    }
+    moved = 0
+    for start_ms, end_ms in sorted(starts):
+        table = telemetry_partition_name(start_ms)
+        statements = [statement.format(table=table) for statement in TELEMETRY_PARTITION_DDL]
+        conn.execute(statements[0])
+        moved += conn.execute(f'''
+            INSERT INTO {table} (id, device_id, topic_id, payload, timestamp)
+            SELECT id, device_id, topic_id, payload, timestamp FROM telemetry_data
+            WHERE timestamp >= ? AND timestamp < ?
+        ''', (start_ms, end_ms)).rowcount
+        for statement in statements[1:]:
+            conn.execute(statement)
+        conn.execute(
+            'INSERT INTO telemetry_partitions (name, start_ms, end_ms) VALUES (?, ?, ?)',
+            (table, start_ms, end_ms)
+        )
+
+    total = conn.execute('SELECT COUNT(*) FROM telemetry_data').fetchone()[0]
+    if moved != total:
+        raise RuntimeError(f"Only {moved} of {total} telemetry rows were assigned to a partition")
+
+    conn.execute('''
+        INSERT INTO stats (scope, scope_id, row_count)
+        SELECT 'telemetry_id', 0, MAX(
+            COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'telemetry_data'), 0),
+            COALESCE((SELECT MAX(id) FROM telemetry_data), 0))
+    ''')
+    # Also drops its indexes and triggers
+    conn.execute('DROP TABLE telemetry_data')
+
+# Retention policies (also in schema.sql). A 'topic' or 'client' row sets the
+# maximum age and/or row count kept for a topic, or for each topic of a client
+# that does not set its own; NULL means no limit.
+RETENTION_DDL = [
+    '''
+    CREATE TABLE IF NOT EXISTS retention_policies (
+        scope TEXT NOT NULL CHECK (scope IN ('topic', 'client')),
+        scope_id INTEGER NOT NULL,
+        max_age_days REAL CHECK (max_age_days > 0),
+        max_rows INTEGER CHECK (max_rows >= 0),
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (scope, scope_id)
+    )
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_retention_topic_delete AFTER DELETE ON topics
+    BEGIN
+        DELETE FROM retention_policies WHERE scope = 'topic' AND scope_id = OLD.id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_retention_client_delete AFTER DELETE ON clients
+    BEGIN
+        DELETE FROM retention_policies WHERE scope = 'client' AND scope_id = OLD.id;
+    END
+    ''',
+]
+
+def _retention_policies(conn):
+    """Add the per-topic/per-client retention policy table."""
+    for statement in RETENTION_DDL:
+        conn.execute(statement)
+
+# Rollups of numeric payload fields (also in schema.sql): one table per
+# resolution with count/min/max/sum/last per (device, topic, field, bucket).
+# A payload's numeric top-level keys are its fields; a bare number is
+# field 'value'. The ('rollup_watermark', 0) stats row is the highest
+# telemetry ID already added to the rollups.
+ROLLUP_RESOLUTIONS = {'1m': 60000, '1h': 3600000, '1d': 86400000}
+
+ROLLUP_DDL = [
+    '''
+    CREATE TABLE IF NOT EXISTS rollup_{name} (
+        device_id INTEGER NOT NULL,
+        topic_id INTEGER NOT NULL,
+        field TEXT NOT NULL,
+        bucket_ms INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        min REAL,
+        max REAL,
+        sum REAL,
+        last REAL,
+        last_ms INTEGER,
+        PRIMARY KEY (device_id, topic_id, field, bucket_ms),
+        FOREIGN KEY (device_id) REFERENCES devices (id) ON DELETE CASCADE,
+        FOREIGN KEY (topic_id) REFERENCES topics (id) ON DELETE CASCADE
+    ) WITHOUT ROWID
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_rollup_{name}_topic ON rollup_{name} (topic_id, field, bucket_ms)',
+]
+
+def _telemetry_rollups(conn):
+    """
+    Add the rollup tables.
+
+    The watermark starts at 0: existing telemetry is rolled up by the
+    background catch-up job (see rollups.py) rather than in the migration.
+    """
+    for name in ROLLUP_RESOLUTIONS:
+        for statement in ROLLUP_DDL:
+            conn.execute(statement.format(name=name))
+    conn.execute("INSERT OR IGNORE INTO stats (scope, scope_id, row_count) VALUES ('rollup_watermark', 0, 0)")
+
+def _typed_value_columns(conn):
+    """
+    Add the value/unit columns and value index to the existing partitions.
+
+    Partitions created by migration 9 in the same upgrade already have the
+    columns (from TELEMETRY_PARTITION_DDL) but not their contents, so every
+    partition is backfilled; only rows that have a value or unit are written.
+    """
+    value_sql = PAYLOAD_VALUE_SQL.format('payload')
+    unit_sql = PAYLOAD_UNIT_SQL.format('payload')
+    for (table,) in conn.execute('SELECT name FROM telemetry_partitions').fetchall():
+        columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+        if 'value' not in columns:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN value')
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN unit TEXT')
+        conn.execute(f'''
+            UPDATE {table} SET value = {value_sql}, unit = {unit_sql}
+            WHERE {value_sql} IS NOT NULL OR {unit_sql} IS NOT NULL
+        ''')
+        conn.execute(TELEMETRY_VALUE_INDEX.format(table=table))
+
+# Payload schema registry (also in schema.sql): per topic, every flattened
+# payload column seen ('payload.<key>', nested keys joined with '.', or
+# 'payload' for payloads that are not objects, as in the exports) with each
+# type it was seen with ('int', 'float', 'bool', 'string' or 'null'; arrays
+# count as 'string'), how often and when (telemetry timestamps, epoch ms).
+# Counts only grow: deleted rows are not subtracted.
+TOPIC_SCHEMA_DDL = '''
+    CREATE TABLE IF NOT EXISTS topic_schema (
+        topic_id INTEGER NOT NULL,
+        field TEXT NOT NULL,
+        type TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        first_seen INTEGER NOT NULL,
+        last_seen INTEGER NOT NULL,
+        PRIMARY KEY (topic_id, field, type),
+        FOREIGN KEY (topic_id) REFERENCES topics (id) ON DELETE CASCADE
+    ) WITHOUT ROWID
+'''
+
+# Leaf values of the payloads of a partition's rows matching {where}, counted
+# per parent path, key and JSON type. Objects are walked by json_tree; array
+# elements (integer keys) are left out, the array itself is the value. The
+# unary + keeps the planner from grouping through the topic/time index,
+# which would scan the whole partition instead of the rows asked for.
+PAYLOAD_SCHEMA_SQL = '''
+    SELECT +td.topic_id, j.path, j.key, j.type, COUNT(*), MIN(td.timestamp), MAX(td.timestamp)
+    FROM {table} td, json_tree(''' + PAYLOAD_TEXT_SQL.format('td.payload') + ''') j
+    WHERE {where} AND j.type != 'object' AND typeof(j.key) != 'integer'
+    GROUP BY 1, 2, 3, 4
+'''
+
+# json_tree type -> registry type (arrays are exported as JSON strings)
+PAYLOAD_SCHEMA_TYPES = {
+    'integer': 'int', 'real': 'float', 'true': 'bool', 'false': 'bool',
+    'null': 'null', 'text': 'string', 'array': 'string',
+}
+
+_JSON_PATH_STEP = re.compile(r'\.(?:"((?:[^"\\]|\\.)*)"|([^."\[]+))|(\[\d+\])')
+
+@lru_cache(maxsize=4096)
+def _path_column(path):
+    """The flattened column of a json_tree path ('$.a."b c"' -> 'payload.a.b c'), or None inside an array."""
+    column = 'payload'
+    for quoted, plain, index in _JSON_PATH_STEP.findall(path[1:]):
+        if index:
+            return None
+        column += '.' + (json.loads(f'"{quoted}"') if quoted else plain)
+    return column
+
+def record_payload_schema(conn, table, where='true', params=()):
+    """
+    Add the payloads of a partition's rows matching where to topic_schema.
+
+    The rows are aggregated in SQL first, so this costs one upsert per
+    topic, column and type however many rows match.
+
+    Args:
+        conn: An open sqlite3 connection, inside the caller's transaction
+        table (str): Partition table name
+        where (str, optional): Row condition on the partition (aliased td)
+        params (tuple, optional): Parameters of the condition
+    """
+    counts = {}
+    for topic_id, path, key, json_type, count, first_seen, last_seen in conn.execute(
+            PAYLOAD_SCHEMA_SQL.format(table=table, where=where), params):
+        column = _path_column(path)
+        if column is None:
+            continue
+        if key is not None:
+            column += '.' + key
+        entry = (topic_id, column, PAYLOAD_SCHEMA_TYPES[json_type])
+        if entry in counts:
+            previous = counts[entry]
+            count, first_seen, last_seen = (previous[0] + count, min(previous[1], first_seen),
+                                            max(previous[2], last_seen))
+        counts[entry] = (count, first_seen, last_seen)
+    conn.executemany('''
+        INSERT INTO topic_schema (topic_id, field, type, count, first_seen, last_seen)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (topic_id, field, type) DO UPDATE SET
+            count = count + excluded.count,
+            first_seen = MIN(first_seen, excluded.first_seen),
+            last_seen = MAX(last_seen, excluded.last_seen)
+    ''', [entry + values for entry, values in counts.items()])
+
+def _topic_schema(conn):
+    """Add the payload schema registry and fill it from the existing telemetry."""
+    conn.execute(TOPIC_SCHEMA_DDL)
+    for (table,) in conn.execute('SELECT name FROM telemetry_partitions').fetchall():
+        record_payload_schema(conn, table)
+
+# Compression dictionaries of stored payloads (also in schema.sql), one or
+# more per topic and codec; the newest is used for new rows. A dictionary is
+# never changed, and is kept while any row may still be compressed with it.
+# The ('compression_watermark', 0) stats row is the highest telemetry ID
+# known to be stored in the current encoding; ('payload_codec', 0) holds the
+# codec (compression.CODEC_IDS, 0 for none) that encoding refers to.
+PAYLOAD_DICTIONARIES_DDL = [
+    '''
+    CREATE TABLE IF NOT EXISTS payload_dictionaries (
+        id INTEGER PRIMARY KEY,
+        topic_id INTEGER NOT NULL,
+        codec TEXT NOT NULL CHECK (codec IN ('zstd', 'zlib')),
+        data BLOB NOT NULL,
+        samples INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (topic_id) REFERENCES topics (id) ON DELETE CASCADE
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_payload_dictionaries_topic ON payload_dictionaries (topic_id, codec, id)',
+]
+
+def _payload_dictionaries(conn):
+    """
+    Add the payload dictionary table.
+
+    Existing payloads stay JSON text; with compression on they are
+    compressed by the background job (see recompression.py) once their
+    topic has a dictionary, rather than in the migration.
+    """
+    for statement in PAYLOAD_DICTIONARIES_DDL:
+        conn.execute(statement)
+    conn.execute('''
+        INSERT OR IGNORE INTO stats (scope, scope_id, row_count)
+        VALUES ('compression_watermark', 0, 0), ('payload_codec', 0, 0)
+    ''')
+
+# (version, description, function) in the order they must be applied
+MIGRATIONS = [
+    (1, 'unique device names per client', _unique_device_names),
+    (2, 'time-ordered telemetry indexes', _telemetry_time_indexes),
+    (3, 'per-device telemetry time index', _telemetry_device_time_index),
+    (4, 'maintained telemetry stats table', _stats_table),
+    (5, 'latest reading per device and topic', _device_latest_table),
+    (6, 'metadata generation counter', _generation_counter),
+    (7, 'payloads stored as valid JSON text', _json_payloads),
+    (8, 'epoch millisecond telemetry timestamps', _epoch_ms_timestamps),
+    (9, 'time-partitioned telemetry tables', _telemetry_partitions),
+    (10, 'retention policies', _retention_policies),
+    (11, 'telemetry rollup tables', _telemetry_rollups),
+    (12, 'typed value/unit telemetry columns', _typed_value_columns),
+    (13, 'payload schema registry', _topic_schema),
+    (14, 'payload compression dictionaries', _payload_dictionaries),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(conn):
+    """Return the schema version recorded in the database."""
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def set_schema_version(conn, version):
+    """Record the schema version in the database."""
+    conn.execute(f'PRAGMA user_version = {int(version)}')
+
+def run_migrations(conn):
+    """
+    Apply all pending migrations to an existing database.
+
+    Args:
+        conn: An open sqlite3 connection
+
+    Returns:
+        int: Number of migrations applied
+    """
+    current = get_schema_version(conn)
+    applied = 0
+    for version, description, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        print(f"Applying database migration {version}: {description}")
+        conn.execute('BEGIN')
+        try:
+            migrate(conn)
+            set_schema_version(conn, version)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            print(f"Database migration {version} failed; database left at version {current}")
+            raise
+        current = version
+        applied += 1
+    return applied
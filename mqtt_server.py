@@ -1,8 +1,9 @@
 import paho.mqtt.client as mqtt
-import json
 import os
-from database import get_client_by_api_key, get_topic_by_name, get_device_by_name
-from database import create_device, create_topic, store_telemetry_data
+import json_codec
+from database import get_client_by_api_key, resolve_device_id, resolve_topic_id, release_db_connection
+from ingest_queue import IngestQueue
+from events import publish_telemetry
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -20,6 +21,8 @@ class MQTTServer:
         self.username = username
         self.password = password
         self.client = mqtt.Client()
+        # Rows the writer cannot store go to the invalid message log
+        self.ingest_queue = IngestQueue(dead_letter=self._log_invalid_message)
         
         # Set authentication credentials if provided
         if username and password:
@@ -31,6 +34,8 @@ class MQTTServer:
         
     def start(self):
         """Start the MQTT server."""
+        # Start the writer before any message can arrive
+        self.ingest_queue.start()
         try:
             self.client.connect(self.broker_host, self.broker_port, 60)
             # Start the loop in a non-blocking way
@@ -46,9 +51,11 @@ class MQTTServer:
             return True
             
     def stop(self):
-        """Stop the MQTT server."""
+        """Stop the MQTT server, flushing all queued telemetry first."""
         self.client.loop_stop()
         self.client.disconnect()
+        # No more messages can arrive; drain everything still queued
+        self.ingest_queue.stop()
         print("MQTT server stopped")
         
     def on_connect(self, client, userdata, flags, rc):
@@ -82,8 +89,8 @@ class MQTTServer:
             # Ensure payload is valid JSON
             try:
                 # Parse the JSON payload
-                payload = json.loads(payload_str)
-            except json.JSONDecodeError as e:
+                payload = json_codec.loads(payload_str)
+            except json_codec.JSONDecodeError as e:
                 print(f"Error: Invalid JSON payload: {e}")
                 self._log_invalid_message(topic, payload_str, f"Invalid JSON: {e}")
                 return
@@ -113,48 +120,30 @@ class MQTTServer:
             
             client_id = db_client['id']
             
-            # Get or create the device
-            device = get_device_by_name(device_name, client_id)
-            if not device:
-                try:
-                    device_id = create_device(device_name, f"Auto-created device for {device_name}", client_id)
-                    if not device_id:
-                        print(f"Error: Failed to create device: {device_name}")
-                        self._log_invalid_message(topic, payload_str, f"Failed to create device: {device_name}")
-                        return
-                    print(f"Created new device: {device_name} with ID {device_id}")
-                except Exception as e:
-                    print(f"Error creating device: {e}")
-                    self._log_invalid_message(topic, payload_str, f"Error creating device: {e}")
-                    return
-            else:
-                device_id = device['id']
+            # Resolve (or auto-create) the device and topic
+            device_id = resolve_device_id(client_id, device_name)
+            if not device_id:
+                print(f"Error: Failed to resolve device: {device_name}")
+                self._log_invalid_message(topic, payload_str, f"Failed to resolve device: {device_name}")
+                return
                 
-            # Get or create the topic if it doesn't exist
-            topic = get_topic_by_name(topic_name, client_id)
-            if not topic:
-                try:
-                    topic_id = create_topic(topic_name, f"Auto-created topic for {topic_name}", client_id)
-                    if not topic_id:
-                        print(f"Error: Failed to create topic: {topic_name} (might already exist)")
-                        self._log_invalid_message(topic, payload_str, f"Failed to create topic: {topic_name}")
-                        return
-                    print(f"Created new topic: {topic_name} with ID {topic_id}")
-                except Exception as e:
-                    print(f"Error creating topic: {e}")
-                    self._log_invalid_message(topic, payload_str, f"Error creating topic: {e}")
-                    return
-            else:
-                topic_id = topic['id']
+            topic_id = resolve_topic_id(client_id, topic_name)
+            if not topic_id:
+                print(f"Error: Failed to resolve topic: {topic_name}")
+                self._log_invalid_message(topic, payload_str, f"Failed to resolve topic: {topic_name}")
+                return
                 
-            # Store the telemetry data (with API key removed)
-            success = store_telemetry_data(device_id, topic_id, payload)
+            # Queue the telemetry data (with API key removed) for the batch writer
+            success = self.ingest_queue.submit(device_id, topic_id, payload)
             if not success:
-                print(f"Error: Failed to store telemetry data")
-                self._log_invalid_message(topic, payload_str, "Failed to store telemetry data")
+                print(f"Error: Failed to queue telemetry data")
+                self._log_invalid_message(topic, payload_str, "Failed to queue telemetry data")
                 return
+            
+            # Push the message to live /api/stream subscribers
+            publish_telemetry(client_id, device_id, device_name, topic_id, topic_name, payload)
                 
-            print(f"Successfully stored telemetry data from device '{device_name}' on topic '{topic_name}'")
+            print(f"Queued telemetry data from device '{device_name}' on topic '{topic_name}'")
             
         except Exception as e:
             print(f"Unexpected error processing MQTT message: {e}")
@@ -162,6 +151,9 @@ class MQTTServer:
                 self._log_invalid_message(topic, msg.payload, f"Unexpected error: {e}")
             except:
                 print("Error logging invalid message")
+        finally:
+            # Never leave a connection checked out by the network thread
+            release_db_connection()
                 
     def _log_invalid_message(self, topic, payload, reason):
         """Log invalid messages to a file for later analysis."""
@@ -175,7 +167,7 @@ class MQTTServer:
     def publish(self, topic, payload, qos=0, retain=False):
         """Publish a message to a topic."""
         if isinstance(payload, dict):
-            payload = json.dumps(payload)
+            payload = json_codec.dumps(payload)
         self.client.publish(topic, payload, qos, retain)
 
 # Create a single instance to be used by the Flask app
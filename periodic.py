@@ -0,0 +1,102 @@
+"""
+Base class for the background maintenance jobs.
+
+Each job (retention purges, rollup catch-up, payload re-compression) runs
+run_once() on a daemon thread every interval seconds and does its work in
+chunks of chunk_size, pausing chunk_pause seconds in between so ingest can
+take the write lock. A run that fails is counted and logged, and the job
+tries again on the next interval.
+"""
+import threading
+from database import release_db_connection
+
+class PeriodicJob:
+    """
+    Runs run_once() on a daemon thread and keeps its counters.
+
+    Subclasses set name (the thread name) and description (used in error
+    messages), implement run_once() and may extend stats().
+    """
+
+    name = 'periodic-job'
+    description = 'running background job'
+
+    def __init__(self, interval, chunk_size, chunk_pause, counters=()):
+        self.interval = interval
+        self.chunk_size = max(chunk_size, 1)
+        self.chunk_pause = chunk_pause
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._counters = dict({'runs': 0, 'failed': 0}, **{counter: 0 for counter in counters})
+
+    def start(self):
+        """Start the job's thread if it is not already running."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stop the job's thread; a run in progress stops after its current chunk."""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is None:
+            return
+        self._stopping.set()
+        thread.join()
+
+    def is_running(self):
+        """Return True if the job's thread is alive."""
+        thread = self._thread
+        return thread is not None and thread.is_alive()
+
+    def stats(self):
+        """Return the job's counters."""
+        with self._lock:
+            return dict(self._counters, running=self.is_running())
+
+    def run_once(self):
+        """Do one run of the job; called by the thread or directly."""
+        raise NotImplementedError
+
+    def _count(self, **increments):
+        """Add to the job's counters."""
+        with self._lock:
+            for counter, increment in increments.items():
+                self._counters[counter] += increment
+
+    def _pause(self):
+        """Pause between chunks; return True if the job is stopping."""
+        return self._stopping.wait(self.chunk_pause)
+
+    def _chunks(self, step):
+        """
+        Call step(chunk_size) until it does less than a full chunk or the job stops.
+
+        Returns:
+            int: Sum of what step returned
+        """
+        total = 0
+        while not self._stopping.is_set():
+            done = step(self.chunk_size)
+            total += done
+            if done < self.chunk_size or self._pause():
+                break
+        return total
+
+    def _run(self):
+        """Thread entry point."""
+        while not self._stopping.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                self._count(failed=1)
+                print(f"Error {self.description}: {e}")
+            finally:
+                release_db_connection()
+            self._stopping.wait(self.interval)
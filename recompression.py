@@ -0,0 +1,56 @@
+"""
+Background job that compresses stored telemetry payloads.
+
+Ingest compresses the payloads of topics that already have a dictionary
+(see compression.py). Topics get their dictionary here, once they hold
+PAYLOAD_DICT_MIN_ROWS rows, and the rows written before it - or in another
+encoding, after PAYLOAD_COMPRESSION was changed - are re-encoded behind the
+compression watermark in chunks of COMPRESSION_CHUNK_SIZE telemetry IDs,
+each in its own short transaction, checked every COMPRESSION_INTERVAL seconds.
+"""
+import os
+import time
+from dotenv import load_dotenv
+from database import train_payload_dictionaries, recompress_payloads, get_compression_lag
+from periodic import PeriodicJob
+
+# Load environment variables
+load_dotenv()
+
+# Seconds between checks
+COMPRESSION_INTERVAL = float(os.getenv('COMPRESSION_INTERVAL', 60))
+# Telemetry IDs re-encoded per transaction, and seconds to pause between transactions
+COMPRESSION_CHUNK_SIZE = int(os.getenv('COMPRESSION_CHUNK_SIZE', 5000))
+COMPRESSION_CHUNK_PAUSE = float(os.getenv('COMPRESSION_CHUNK_PAUSE', 0.05))
+
+class PayloadRecompressor(PeriodicJob):
+    """Trains payload dictionaries and re-encodes old rows on a daemon thread."""
+
+    name = 'payload-recompressor'
+    description = 'compressing telemetry payloads'
+
+    def __init__(self, interval=COMPRESSION_INTERVAL, chunk_size=COMPRESSION_CHUNK_SIZE,
+                 chunk_pause=COMPRESSION_CHUNK_PAUSE):
+        super().__init__(interval, chunk_size, chunk_pause, counters=('dictionaries', 'ids'))
+
+    def stats(self):
+        """Return the counters and how many telemetry IDs are not re-encoded yet."""
+        return dict(super().stats(), lag=get_compression_lag())
+
+    def run_once(self):
+        """
+        Train the dictionaries topics need, then re-encode everything behind the watermark.
+
+        Returns:
+            int: Number of telemetry IDs passed
+        """
+        started = time.monotonic()
+        dictionaries = train_payload_dictionaries()
+        passed = self._chunks(recompress_payloads)
+        self._count(runs=1, dictionaries=dictionaries, ids=passed)
+        if passed:
+            print(f"Payloads re-encoded up to {passed} telemetry IDs further in {time.monotonic() - started:.3f}s")
+        return passed
+
+# Global instance started by the web app
+payload_recompressor = PayloadRecompressor()
@@ -0,0 +1,113 @@
+"""
+Background enforcement of telemetry retention.
+
+A maintenance thread wakes up every RETENTION_INTERVAL seconds, drops the
+partitions older than TELEMETRY_RETENTION_DAYS and then applies the
+per-topic/per-client policies (see set_retention_policy). Policy deletes
+run in chunks of RETENTION_CHUNK_SIZE rows, each in its own short
+transaction, with a pause in between so ingest can take the write lock.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+from dotenv import load_dotenv
+from database import (
+    VN_TZ, now_ms, drop_expired_telemetry_partitions, get_effective_retention_policies,
+    purge_telemetry_chunk
+)
+from periodic import PeriodicJob
+
+# Load environment variables
+load_dotenv()
+
+# Seconds between purge runs
+RETENTION_INTERVAL = float(os.getenv('RETENTION_INTERVAL', 3600))
+# Rows deleted per transaction, and seconds to pause between transactions
+RETENTION_CHUNK_SIZE = int(os.getenv('RETENTION_CHUNK_SIZE', 500))
+RETENTION_CHUNK_PAUSE = float(os.getenv('RETENTION_CHUNK_PAUSE', 0.05))
+
+class RetentionPurger(PeriodicJob):
+    """
+    Runs retention purges on a daemon thread and keeps the last run's report.
+
+    The first run starts right after start(); run_once() can also be called
+    directly.
+    """
+
+    name = 'retention-purger'
+    description = 'enforcing telemetry retention'
+
+    def __init__(self, interval=RETENTION_INTERVAL, chunk_size=RETENTION_CHUNK_SIZE,
+                 chunk_pause=RETENTION_CHUNK_PAUSE):
+        super().__init__(interval, chunk_size, chunk_pause, counters=('purged',))
+        self._run_lock = threading.Lock()
+        self._last_run = None
+
+    def stats(self):
+        """Return run counters and the report of the last run."""
+        with self._lock:
+            last_run = self._last_run
+        return dict(super().stats(), last_run=last_run)
+
+    def run_once(self):
+        """
+        Apply every retention setting once.
+
+        Returns:
+            dict: Report of the run: rows (total rows removed), partitions
+                (dropped partition names), topics ({topic_id: rows purged}),
+                duration (seconds) and finished_at
+        """
+        with self._run_lock:
+            started = time.monotonic()
+            report = {'rows': 0, 'partitions': [], 'topics': {}}
+
+            dropped = drop_expired_telemetry_partitions()
+            if dropped:
+                report['partitions'] = dropped['partitions']
+                report['rows'] += dropped['rows']
+
+            for policy in get_effective_retention_policies():
+                if self._stopping.is_set():
+                    break
+                topic_id = policy['topic_id']
+                purged = 0
+                if policy['max_age_days'] is not None:
+                    cutoff = now_ms() - int(policy['max_age_days'] * 86400000)
+                    purged += self._purge(topic_id, before=cutoff)
+                if policy['max_rows'] is not None:
+                    # Rows removed by age are already off the count
+                    excess = policy['row_count'] - purged - policy['max_rows']
+                    if excess > 0:
+                        purged += self._purge(topic_id, limit=excess)
+                if purged:
+                    report['topics'][topic_id] = purged
+                    report['rows'] += purged
+
+            report['duration'] = round(time.monotonic() - started, 3)
+            report['finished_at'] = datetime.now(VN_TZ).isoformat()
+            self._count(runs=1, purged=report['rows'])
+            with self._lock:
+                self._last_run = report
+            print(f"Retention purge: {report['rows']} rows removed "
+                  f"({len(report['topics'])} topics, {len(report['partitions'])} partitions) "
+                  f"in {report['duration']}s")
+            return report
+
+    def _purge(self, topic_id, before=None, limit=None):
+        """Delete a topic's oldest rows chunk by chunk, pausing in between."""
+        purged = 0
+        while limit is None or purged < limit:
+            chunk = self.chunk_size if limit is None else min(self.chunk_size, limit - purged)
+            deleted = purge_telemetry_chunk(topic_id, chunk, before)
+            purged += deleted
+            if not deleted:
+                break
+            # Yield the write lock (and stop promptly on shutdown)
+            if self._pause():
+                break
+        return purged
+
+# Global instance started by the web app
+retention_purger = RetentionPurger()
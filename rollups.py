@@ -0,0 +1,54 @@
+"""
+Background catch-up job for the telemetry rollup tables.
+
+Ingest rolls its own batches up while the rollups are current (see
+ROLLUP_ON_INGEST). Whatever is left behind the watermark - existing data
+after the upgrade, batches written while the rollups lagged - is added here
+in chunks of ROLLUP_CHUNK_SIZE telemetry IDs, each in its own short
+transaction, checked every ROLLUP_INTERVAL seconds.
+"""
+import os
+import time
+from dotenv import load_dotenv
+from database import update_rollups, get_rollup_lag
+from periodic import PeriodicJob
+
+# Load environment variables
+load_dotenv()
+
+# Seconds between catch-up checks
+ROLLUP_INTERVAL = float(os.getenv('ROLLUP_INTERVAL', 10))
+# Telemetry IDs added per transaction, and seconds to pause between transactions
+ROLLUP_CHUNK_SIZE = int(os.getenv('ROLLUP_CHUNK_SIZE', 5000))
+ROLLUP_CHUNK_PAUSE = float(os.getenv('ROLLUP_CHUNK_PAUSE', 0.05))
+
+class RollupUpdater(PeriodicJob):
+    """Runs the rollup catch-up on a daemon thread and counts its work."""
+
+    name = 'rollup-updater'
+    description = 'updating telemetry rollups'
+
+    def __init__(self, interval=ROLLUP_INTERVAL, chunk_size=ROLLUP_CHUNK_SIZE,
+                 chunk_pause=ROLLUP_CHUNK_PAUSE):
+        super().__init__(interval, chunk_size, chunk_pause, counters=('ids',))
+
+    def stats(self):
+        """Return the counters and how many telemetry IDs are not rolled up yet."""
+        return dict(super().stats(), lag=get_rollup_lag())
+
+    def run_once(self):
+        """
+        Roll up everything behind the watermark, chunk by chunk.
+
+        Returns:
+            int: Number of telemetry IDs added
+        """
+        started = time.monotonic()
+        added = self._chunks(update_rollups)
+        self._count(runs=1, ids=added)
+        if added:
+            print(f"Rollups caught up by {added} telemetry IDs in {time.monotonic() - started:.3f}s")
+        return added
+
+# Global instance started by the web app
+rollup_updater = RollupUpdater()
@@ -1,4 +1,6 @@
 -- Schema for MQTT data server
+-- This file describes the latest schema version; existing databases are
+-- upgraded by the migrations in migrations.py.
 
 -- Table for storing user/client information
 CREATE TABLE IF NOT EXISTS clients (
@@ -30,13 +32,262 @@ CREATE TABLE IF NOT EXISTS devices (
     FOREIGN KEY (client_id) REFERENCES clients (id) ON DELETE CASCADE
 );
 
--- Table for storing the actual telemetry data
-CREATE TABLE IF NOT EXISTS telemetry_data (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
+-- Device names are unique per client (auto-create relies on this)
+CREATE UNIQUE INDEX IF NOT EXISTS idx_devices_name_client ON devices (name, client_id);
+
+-- Telemetry is stored in time partitions: one table per UTC day or month
+-- (telemetry_YYYYMMDD, named after its first day) holding the rows with
+-- start_ms <= timestamp < end_ms. The tables, with their time-ordered indexes,
+-- typed value/unit payload columns (and the index on value) and the
+-- stats/device_latest triggers, are created on demand from
+-- TELEMETRY_PARTITION_DDL in migrations.py. timestamp is UTC epoch
+-- milliseconds; it is formatted for display when it is read.
+CREATE TABLE IF NOT EXISTS telemetry_partitions (
+    name TEXT PRIMARY KEY,
+    start_ms INTEGER NOT NULL,
+    end_ms INTEGER NOT NULL
+);
+
+-- Maintained counters kept current by triggers, so stats never need COUNT(*).
+-- Scopes 'telemetry' (scope_id 0), 'client', 'device', 'topic' hold telemetry row
+-- counts and first/last timestamps (epoch ms); 'clients', 'devices', 'topics' hold entity counts;
+-- 'generation' counts metadata changes (triggers at the end of this file);
+-- 'telemetry_id' is the last telemetry row ID handed out (IDs span all partitions);
+-- 'rollup_watermark' is the last telemetry row ID added to the rollup tables;
+-- 'compression_watermark' is the last telemetry row ID known to be stored in
+-- the encoding of 'payload_codec' (see payload_dictionaries below).
+CREATE TABLE IF NOT EXISTS stats (
+    scope TEXT NOT NULL,
+    scope_id INTEGER NOT NULL,
+    row_count INTEGER NOT NULL DEFAULT 0,
+    first_timestamp TIMESTAMP,
+    last_timestamp TIMESTAMP,
+    PRIMARY KEY (scope, scope_id)
+) WITHOUT ROWID;
+
+-- Cascaded telemetry deletes run after the device row is gone and cannot find
+-- its client, so the device's whole count is moved off the client first
+CREATE TRIGGER IF NOT EXISTS trg_stats_device_before_delete BEFORE DELETE ON devices
+BEGIN
+    UPDATE stats SET row_count = row_count - COALESCE(
+        (SELECT row_count FROM stats WHERE scope = 'device' AND scope_id = OLD.id), 0)
+    WHERE scope = 'client' AND scope_id = OLD.client_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_stats_device_delete AFTER DELETE ON devices
+BEGIN
+    DELETE FROM stats WHERE scope = 'device' AND scope_id = OLD.id;
+    UPDATE stats SET row_count = row_count - 1 WHERE scope = 'devices' AND scope_id = 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_stats_device_insert AFTER INSERT ON devices
+BEGIN
+    UPDATE stats SET row_count = row_count + 1 WHERE scope = 'devices' AND scope_id = 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_stats_topic_delete AFTER DELETE ON topics
+BEGIN
+    DELETE FROM stats WHERE scope = 'topic' AND scope_id = OLD.id;
+    UPDATE stats SET row_count = row_count - 1 WHERE scope = 'topics' AND scope_id = 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_stats_topic_insert AFTER INSERT ON topics
+BEGIN
+    UPDATE stats SET row_count = row_count + 1 WHERE scope = 'topics' AND scope_id = 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_stats_client_delete AFTER DELETE ON clients
+BEGIN
+    DELETE FROM stats WHERE scope = 'client' AND scope_id = OLD.id;
+    UPDATE stats SET row_count = row_count - 1 WHERE scope = 'clients' AND scope_id = 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_stats_client_insert AFTER INSERT ON clients
+BEGIN
+    UPDATE stats SET row_count = row_count + 1 WHERE scope = 'clients' AND scope_id = 0;
+END;
+
+INSERT OR IGNORE INTO stats (scope, scope_id, row_count) VALUES
+    ('telemetry', 0, 0), ('clients', 0, 0), ('devices', 0, 0), ('topics', 0, 0),
+    ('generation', 0, 0), ('telemetry_id', 0, 0), ('rollup_watermark', 0, 0),
+    ('compression_watermark', 0, 0), ('payload_codec', 0, 0);
+
+-- Newest reading per (device, topic), kept current by the partition triggers so
+-- dashboards never have to sort telemetry. Ordered by (timestamp, telemetry_id);
+-- timestamp is epoch ms as in the partitions.
+CREATE TABLE IF NOT EXISTS device_latest (
     device_id INTEGER NOT NULL,
     topic_id INTEGER NOT NULL,
+    telemetry_id INTEGER NOT NULL,
     payload TEXT NOT NULL,
-    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    timestamp TIMESTAMP,
+    PRIMARY KEY (device_id, topic_id),
+    FOREIGN KEY (device_id) REFERENCES devices (id) ON DELETE CASCADE,
+    FOREIGN KEY (topic_id) REFERENCES topics (id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_device_latest_topic ON device_latest (topic_id);
+
+-- Metadata generation counter: the ('generation', 0) stats row is bumped whenever
+-- a client, topic or device is added, removed or renamed (see get_data_version).
+-- devices.last_seen is left out: it only changes together with telemetry.
+CREATE TRIGGER IF NOT EXISTS trg_generation_clients_insert AFTER INSERT ON clients
+BEGIN
+    UPDATE stats SET row_count = row_count + 1 WHERE scope = 'generation' AND scope_id = 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_generation_clients_delete AFTER DELETE ON clients
+BEGIN
+    UPDATE stats SET row_count = row_count + 1 WHERE scope = 'generation' AND scope_id = 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_generation_clients_update AFTER UPDATE OF name, api_key ON clients
+BEGIN
+    UPDATE stats SET row_count = row_count + 1 WHERE scope = 'generation' AND scope_id = 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_generation_topics_insert AFTER INSERT ON topics
+BEGIN
+    UPDATE stats SET row_count = row_count + 1 WHERE scope = 'generation' AND scope_id = 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_generation_topics_delete AFTER DELETE ON topics
+BEGIN
+    UPDATE stats SET row_count = row_count + 1 WHERE scope = 'generation' AND scope_id = 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_generation_topics_update AFTER UPDATE OF name, description, client_id ON topics
+BEGIN
+    UPDATE stats SET row_count = row_count + 1 WHERE scope = 'generation' AND scope_id = 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_generation_devices_insert AFTER INSERT ON devices
+BEGIN
+    UPDATE stats SET row_count = row_count + 1 WHERE scope = 'generation' AND scope_id = 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_generation_devices_delete AFTER DELETE ON devices
+BEGIN
+    UPDATE stats SET row_count = row_count + 1 WHERE scope = 'generation' AND scope_id = 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_generation_devices_update AFTER UPDATE OF name, description, client_id ON devices
+BEGIN
+    UPDATE stats SET row_count = row_count + 1 WHERE scope = 'generation' AND scope_id = 0;
+END;
+
+-- Retention policies enforced by the background purger (retention.py). A
+-- 'topic' row limits that topic; a 'client' row is the default for each of
+-- the client's topics without its own value. NULL means no limit.
+CREATE TABLE IF NOT EXISTS retention_policies (
+    scope TEXT NOT NULL CHECK (scope IN ('topic', 'client')),
+    scope_id INTEGER NOT NULL,
+    max_age_days REAL CHECK (max_age_days > 0),
+    max_rows INTEGER CHECK (max_rows >= 0),
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (scope, scope_id)
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_retention_topic_delete AFTER DELETE ON topics
+BEGIN
+    DELETE FROM retention_policies WHERE scope = 'topic' AND scope_id = OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_retention_client_delete AFTER DELETE ON clients
+BEGIN
+    DELETE FROM retention_policies WHERE scope = 'client' AND scope_id = OLD.id;
+END;
+
+-- Minute, hour and day rollups of numeric payload fields: count/min/max/sum
+-- and the last value per (device, topic, field, bucket_ms), where bucket_ms
+-- is the UTC start of the bucket. A payload's numeric top-level keys are its
+-- fields and a bare number is field 'value'. Kept current by the ingest path
+-- and a catch-up job (see ROLLUP_DDL in migrations.py and rollups.py).
+
+CREATE TABLE IF NOT EXISTS rollup_1m (
+    device_id INTEGER NOT NULL,
+    topic_id INTEGER NOT NULL,
+    field TEXT NOT NULL,
+    bucket_ms INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    min REAL,
+    max REAL,
+    sum REAL,
+    last REAL,
+    last_ms INTEGER,
+    PRIMARY KEY (device_id, topic_id, field, bucket_ms),
+    FOREIGN KEY (device_id) REFERENCES devices (id) ON DELETE CASCADE,
+    FOREIGN KEY (topic_id) REFERENCES topics (id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_rollup_1m_topic ON rollup_1m (topic_id, field, bucket_ms);
+
+CREATE TABLE IF NOT EXISTS rollup_1h (
+    device_id INTEGER NOT NULL,
+    topic_id INTEGER NOT NULL,
+    field TEXT NOT NULL,
+    bucket_ms INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    min REAL,
+    max REAL,
+    sum REAL,
+    last REAL,
+    last_ms INTEGER,
+    PRIMARY KEY (device_id, topic_id, field, bucket_ms),
+    FOREIGN KEY (device_id) REFERENCES devices (id) ON DELETE CASCADE,
+    FOREIGN KEY (topic_id) REFERENCES topics (id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_rollup_1h_topic ON rollup_1h (topic_id, field, bucket_ms);
+
+CREATE TABLE IF NOT EXISTS rollup_1d (
+    device_id INTEGER NOT NULL,
+    topic_id INTEGER NOT NULL,
+    field TEXT NOT NULL,
+    bucket_ms INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    min REAL,
+    max REAL,
+    sum REAL,
+    last REAL,
+    last_ms INTEGER,
+    PRIMARY KEY (device_id, topic_id, field, bucket_ms),
     FOREIGN KEY (device_id) REFERENCES devices (id) ON DELETE CASCADE,
     FOREIGN KEY (topic_id) REFERENCES topics (id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_rollup_1d_topic ON rollup_1d (topic_id, field, bucket_ms);
+
+-- Payload schema registry: per topic, every flattened payload column seen
+-- ('payload.<key>', nested keys joined with '.', or 'payload' for payloads
+-- that are not objects) with each type it was seen with, how often and the
+-- first/last telemetry timestamp (epoch ms). Kept current by the ingest path
+-- (see PAYLOAD_SCHEMA_SQL in migrations.py); counts are not reduced when
+-- telemetry is deleted.
+
+CREATE TABLE IF NOT EXISTS topic_schema (
+    topic_id INTEGER NOT NULL,
+    field TEXT NOT NULL,
+    type TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    first_seen INTEGER NOT NULL,
+    last_seen INTEGER NOT NULL,
+    PRIMARY KEY (topic_id, field, type),
+    FOREIGN KEY (topic_id) REFERENCES topics (id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+-- Dictionaries for compressed payloads (PAYLOAD_COMPRESSION, see compression.py),
+-- trained per topic and codec from the topic's own payloads. The newest one is
+-- used for new rows; a dictionary is never changed once written.
+
+CREATE TABLE IF NOT EXISTS payload_dictionaries (
+    id INTEGER PRIMARY KEY,
+    topic_id INTEGER NOT NULL,
+    codec TEXT NOT NULL CHECK (codec IN ('zstd', 'zlib')),
+    data BLOB NOT NULL,
+    samples INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (topic_id) REFERENCES topics (id) ON DELETE CASCADE
 );
+
+CREATE INDEX IF NOT EXISTS idx_payload_dictionaries_topic ON payload_dictionaries (topic_id, codec, id);
@@ -1,6 +1,7 @@
 /**
  * Real-time updates for IoT Data Server
- * This script handles WebSocket connections and periodic data fetching
+ * This script listens to the server's event stream (/api/stream) and falls
+ * back to periodic data fetching where EventSource is not available
  */
 
 // Configuration
@@ -15,8 +16,11 @@ const config = {
     api: {
         stats: '/api/stats',
         latestData: '/api/latest_data',
-        mqttStatus: '/api/mqtt_status'
-    }
+        mqttStatus: '/api/mqtt_status',
+        stream: '/api/stream'
+    },
+    // Rows kept in the latest data table
+    latestDataRows: 10
 };
 
 // Store for active update intervals
@@ -25,6 +29,9 @@ const activeIntervals = {};
 // Store for last data timestamp to detect changes
 let lastDataTimestamp = '';
 
+// Open EventSource for /api/stream (null when closed or unsupported)
+let eventStream = null;
+
 /**
  * Initialize real-time updates
  */
@@ -34,8 +41,12 @@ function initRealTimeUpdates() {
     // Initialize MQTT WebSocket connection if available on the page
     initMqttWebSocket();
     
-    // Initialize periodic updates for different components
-    initPeriodicUpdates();
+    // Prefer pushed updates; poll only if the browser lacks EventSource
+    if (window.EventSource) {
+        initEventStream();
+    } else {
+        initPeriodicUpdates();
+    }
     
     // Add event listeners for page visibility changes
     document.addEventListener('visibilitychange', handleVisibilityChange);
@@ -60,6 +71,62 @@ function initMqttWebSocket() {
     }
 }
 
+/**
+ * Open the server event stream and apply its events as they arrive
+ */
+function initEventStream() {
+    if (eventStream) return;
+    
+    // Load the current state once; the stream only carries changes
+    refreshAll();
+    
+    eventStream = new EventSource(config.api.stream);
+    let hadError = false;
+    
+    eventStream.addEventListener('telemetry', event => {
+        addLatestDataRow(JSON.parse(event.data));
+    });
+    
+    eventStream.addEventListener('heartbeat', event => {
+        const data = JSON.parse(event.data);
+        applyStats(data.stats);
+        applyMqttStatus(data.mqtt_connected);
+    });
+    
+    // Events were dropped for this client: reload everything
+    eventStream.addEventListener('resync', refreshAll);
+    
+    eventStream.onopen = () => {
+        // Anything sent while disconnected was missed
+        if (hadError) refreshAll();
+        hadError = false;
+    };
+    
+    // EventSource reconnects by itself
+    eventStream.onerror = () => {
+        hadError = true;
+    };
+}
+
+/**
+ * Close the server event stream
+ */
+function closeEventStream() {
+    if (eventStream) {
+        eventStream.close();
+        eventStream = null;
+    }
+}
+
+/**
+ * Reload all components present on the page
+ */
+function refreshAll() {
+    if (document.querySelector('.stat-card')) updateStats();
+    if (document.querySelector('#latest-data-table')) updateLatestData();
+    if (document.querySelector('#mqtt-status')) updateMqttStatus();
+}
+
 /**
  * Initialize periodic updates for different components
  */
@@ -89,9 +156,12 @@ function initPeriodicUpdates() {
 function handleVisibilityChange() {
     if (document.hidden) {
         // Page is hidden, pause updates
+        closeEventStream();
         Object.values(activeIntervals).forEach(interval => clearInterval(interval));
-    } else {
+    } else if (window.EventSource) {
         // Page is visible again, resume updates
+        initEventStream();
+    } else {
         initPeriodicUpdates();
     }
 }
@@ -105,17 +175,22 @@ async function updateStats() {
         if (!response.ok) throw new Error('Failed to fetch statistics');
         
         const data = await response.json();
-        
-        // Update each statistic card
-        updateStatCard('client_count', data.stats.client_count);
-        updateStatCard('topic_count', data.stats.topic_count);
-        updateStatCard('device_count', data.stats.device_count);
-        updateStatCard('data_count', data.stats.data_count);
+        applyStats(data.stats);
     } catch (error) {
         console.error('Error updating statistics:', error);
     }
 }
 
+/**
+ * Update each statistic card from a stats object
+ */
+function applyStats(stats) {
+    updateStatCard('client_count', stats.client_count);
+    updateStatCard('topic_count', stats.topic_count);
+    updateStatCard('device_count', stats.device_count);
+    updateStatCard('data_count', stats.data_count);
+}
+
 /**
  * Update a specific statistic card
  */
@@ -133,12 +208,73 @@ function updateStatCard(id, value) {
     }
 }
 
+/**
+ * Build a latest data table row
+ */
+function latestDataRowHtml(item, isNew) {
+    return `
+                <tr class="${isNew ? 'new-data-row' : ''}">
+                    <td>${item.timestamp}</td>
+                    <td>${item.device_id}</td>
+                    <td>${item.topic_id}</td>
+                    <td><code>${typeof item.payload === 'object' ? JSON.stringify(item.payload) : item.payload}</code></td>
+                </tr>`;
+}
+
+/**
+ * Flash the new data indicator
+ */
+function flashDataIndicator() {
+    const dataIndicator = document.getElementById('data-indicator');
+    if (dataIndicator) {
+        dataIndicator.classList.add('active');
+        // Remove the active class after 2 seconds
+        setTimeout(() => {
+            dataIndicator.classList.remove('active');
+        }, 2000);
+    }
+}
+
+/**
+ * Add one pushed telemetry message to the top of the latest data table
+ */
+function addLatestDataRow(item) {
+    lastDataTimestamp = item.timestamp;
+    flashDataIndicator();
+    
+    // The message is one more stored row
+    const countElement = document.querySelector('.stat-card .count[data-id="data_count"]');
+    if (countElement) {
+        const count = parseInt(countElement.textContent, 10);
+        if (!isNaN(count)) updateStatCard('data_count', count + 1);
+    }
+    
+    const tableBody = document.querySelector('#latest-data-table tbody');
+    if (!tableBody) return;
+    
+    // Clear "No data available" row if it exists
+    if (tableBody.querySelector('tr td[colspan="4"].text-center')) {
+        tableBody.innerHTML = '';
+    }
+    
+    tableBody.insertAdjacentHTML('afterbegin', latestDataRowHtml(item, true));
+    while (tableBody.children.length > config.latestDataRows) {
+        tableBody.lastElementChild.remove();
+    }
+    
+    setTimeout(() => {
+        tableBody.querySelectorAll('.new-data-row').forEach(row => {
+            row.classList.remove('new-data-row');
+        });
+    }, 1000);
+}
+
 /**
  * Update latest telemetry data table
  */
 async function updateLatestData() {
     try {
-        const response = await fetch(config.api.latestData);
+        const response = await fetch(`${config.api.latestData}?limit=${config.latestDataRows}`);
         if (!response.ok) throw new Error('Failed to fetch latest data');
         
         const data = await response.json();
@@ -146,9 +282,6 @@ async function updateLatestData() {
         
         if (!tableBody) return;
         
-        // Get the data indicator element
-        const dataIndicator = document.getElementById('data-indicator');
-        
         // Check if there's new data by comparing with the first item's timestamp
         let hasNewData = false;
         if (data.latest_data.length > 0) {
@@ -156,15 +289,7 @@ async function updateLatestData() {
             if (newTimestamp !== lastDataTimestamp) {
                 lastDataTimestamp = newTimestamp;
                 hasNewData = true;
-                
-                // Activate the indicator
-                if (dataIndicator) {
-                    dataIndicator.classList.add('active');
-                    // Remove the active class after 2 seconds
-                    setTimeout(() => {
-                        dataIndicator.classList.remove('active');
-                    }, 2000);
-                }
+                flashDataIndicator();
             }
         }
         
@@ -179,13 +304,7 @@ async function updateLatestData() {
             let newHtml = '';
             
             data.latest_data.forEach(item => {
-                newHtml += `
-                <tr class="${hasNewData ? 'new-data-row' : ''}">
-                    <td>${item.timestamp}</td>
-                    <td>${item.device_id}</td>
-                    <td>${item.topic_id}</td>
-                    <td><code>${typeof item.payload === 'object' ? JSON.stringify(item.payload) : item.payload}</code></td>
-                </tr>`;
+                newHtml += latestDataRowHtml(item, hasNewData);
             });
             
             // Replace table content
@@ -217,31 +336,38 @@ async function updateMqttStatus() {
         if (!response.ok) throw new Error('Failed to fetch MQTT status');
         
         const data = await response.json();
-        const statusElement = document.querySelector('#mqtt-status');
-        
-        if (!statusElement) return;
-        
-        // Update connection status
-        const statusBadge = statusElement.querySelector('.badge');
-        if (statusBadge) {
-            if (data.mqtt_info.is_connected) {
-                statusBadge.textContent = 'Connected';
-                statusBadge.classList.remove('bg-danger');
-                statusBadge.classList.add('bg-success');
-                statusElement.querySelector('i').classList.remove('text-danger');
-                statusElement.querySelector('i').classList.add('text-success');
-            } else {
-                statusBadge.textContent = 'Disconnected';
-                statusBadge.classList.remove('bg-success');
-                statusBadge.classList.add('bg-danger');
-                statusElement.querySelector('i').classList.remove('text-success');
-                statusElement.querySelector('i').classList.add('text-danger');
-            }
-        }
+        applyMqttStatus(data.mqtt_info.is_connected);
     } catch (error) {
         console.error('Error updating MQTT status:', error);
     }
 }
 
+/**
+ * Show the MQTT broker connection state
+ */
+function applyMqttStatus(isConnected) {
+    const statusElement = document.querySelector('#mqtt-status');
+    
+    if (!statusElement) return;
+    
+    // Update connection status
+    const statusBadge = statusElement.querySelector('.badge');
+    if (statusBadge) {
+        if (isConnected) {
+            statusBadge.textContent = 'Connected';
+            statusBadge.classList.remove('bg-danger');
+            statusBadge.classList.add('bg-success');
+            statusElement.querySelector('i').classList.remove('text-danger');
+            statusElement.querySelector('i').classList.add('text-success');
+        } else {
+            statusBadge.textContent = 'Disconnected';
+            statusBadge.classList.remove('bg-success');
+            statusBadge.classList.add('bg-danger');
+            statusElement.querySelector('i').classList.remove('text-success');
+            statusElement.querySelector('i').classList.add('text-danger');
+        }
+    }
+}
+
 // Initialize when the DOM is fully loaded
 document.addEventListener('DOMContentLoaded', initRealTimeUpdates);
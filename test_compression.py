@@ -0,0 +1,147 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import database
+from exporters import iter_export, resolve_fields
+
+START_MS = 1709251200000  # 2024-03-01 00:00:00 UTC
+HOUR_MS = 3600 * 1000
+STATUSES = ('ok', 'ok', 'warn', 'ok')
+
+def _payload(n):
+    """A sensor reading like the ones devices send, varying with n."""
+    return json.dumps({
+        'value': n % 97 / 4, 'humidity': 40 + n % 31, 'status': STATUSES[n % 4],
+        'firmware': '2.4.1', 'location': {'building': 'B2', 'floor': n % 3},
+    })
+
+class PayloadCompressionTest(unittest.TestCase):
+    """Compress stored payloads with zlib, read them back, and switch compression off again."""
+
+    rows_per_device = 60
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp(prefix='iot_test_')
+        cls.previous_path = database.DATABASE_PATH
+        cls.previous_codec = database.PAYLOAD_COMPRESSION
+        database.close_all_db_connections()
+        database.DATABASE_PATH = os.path.join(cls.directory, 'compression.db')
+        database.PAYLOAD_COMPRESSION = 'zlib'
+        database.init_db()
+
+        client_id, _ = database.create_client('client')
+        cls.topic_id = database.create_topic('sensors', None, client_id)
+        cls.device_ids = [database.create_device(f'sensor-{i}', None, client_id) for i in range(2)]
+        database._topic_dictionary_cache.invalidate(cls.topic_id)
+        cls._store(0, cls.rows_per_device)
+
+    @classmethod
+    def tearDownClass(cls):
+        database.PAYLOAD_COMPRESSION = cls.previous_codec
+        database._topic_dictionary_cache.invalidate(cls.topic_id)
+        database.close_all_db_connections()
+        database.DATABASE_PATH = cls.previous_path
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    @classmethod
+    def _store(cls, first, last):
+        """Store readings first..last - 1 of every device, one a minute."""
+        database.store_telemetry_batch([
+            (device_id, cls.topic_id, _payload(n + device_id), START_MS + n * 60000)
+            for n in range(first, last)
+            for device_id in cls.device_ids
+        ])
+
+    def _reads(self):
+        """Everything the read paths return for the topic."""
+        until = START_MS + 24 * HOUR_MS
+        return {
+            'data': [dict(row) for row in database.get_telemetry_data(topic_id=self.topic_id, limit=1000)],
+            'since': database.get_telemetry_since(0, topic_id=self.topic_id, limit=1000),
+            'latest': database.get_latest_by_device(topic_id=self.topic_id),
+            'csv': b''.join(iter_export('csv', resolve_fields(None, 'csv', topic_id=self.topic_id),
+                                        topic_id=self.topic_id)),
+            'ndjson': b''.join(iter_export('ndjson', None, topic_id=self.topic_id)),
+            'aggregate': database.aggregate_telemetry('value', HOUR_MS, topic_id=self.topic_id,
+                                                      since=START_MS, until=until, last=True),
+            'rollups': database.get_rollups('humidity', '1h', topic_id=self.topic_id, since=START_MS, until=until),
+        }
+
+    def _stored_payloads(self):
+        """The payloads as stored, in the partitions and in device_latest."""
+        conn = sqlite3.connect(database.DATABASE_PATH)
+        payloads = []
+        for (table,) in conn.execute('SELECT name FROM telemetry_partitions'):
+            payloads.extend(row[0] for row in conn.execute(f'SELECT payload FROM {table}'))
+        latest = [row[0] for row in conn.execute('SELECT payload FROM device_latest')]
+        conn.close()
+        return payloads, latest
+
+    def _assert_rollups_match(self, field):
+        """Hourly rollups agree with aggregating the stored payloads directly."""
+        until = START_MS + 24 * HOUR_MS
+        rollups = database.get_rollups(field, '1h', topic_id=self.topic_id, since=START_MS, until=until)
+        aggregate = database.aggregate_telemetry(field, HOUR_MS, topic_id=self.topic_id, since=START_MS, until=until)
+        keys = ('timestamp_ms', 'count', 'min', 'max', 'sum')
+        self.assertEqual([{key: row[key] for key in keys} for row in rollups],
+                         [{key: row[key] for key in keys} for row in aggregate])
+
+    def test_01_compress_existing_rows(self):
+        """A trained dictionary compresses the stored rows without changing any read"""
+        before = self._reads()
+        payloads, latest = self._stored_payloads()
+        self.assertTrue(all(isinstance(payload, str) for payload in payloads + latest))
+
+        self.assertEqual(database.train_payload_dictionaries(min_rows=self.rows_per_device), 1)
+        while database.recompress_payloads(max_ids=25):
+            pass
+        self.assertEqual(database.get_compression_lag(), 0)
+
+        payloads, latest = self._stored_payloads()
+        self.assertEqual(len(payloads), self.rows_per_device * len(self.device_ids))
+        self.assertTrue(all(isinstance(payload, bytes) for payload in payloads + latest))
+        self.assertEqual(self._reads(), before)
+        self._assert_rollups_match('value')
+
+    def test_02_ingest_compressed_rows(self):
+        """New rows are stored compressed and rolled up from their compressed payloads"""
+        ingest_rollups = database.ROLLUP_ON_INGEST
+        database.ROLLUP_ON_INGEST = False
+        try:
+            self._store(self.rows_per_device, 2 * self.rows_per_device)
+        finally:
+            database.ROLLUP_ON_INGEST = ingest_rollups
+        while database.update_rollups():
+            pass
+
+        payloads, latest = self._stored_payloads()
+        self.assertEqual(len(payloads), 2 * self.rows_per_device * len(self.device_ids))
+        self.assertTrue(all(isinstance(payload, bytes) for payload in payloads + latest))
+        self.assertEqual(database.get_compression_lag(), 0)
+
+        rows, _ = database.get_telemetry_since(0, topic_id=self.topic_id, limit=1000)
+        expected = [_payload(n + device_id) for n in range(2 * self.rows_per_device) for device_id in self.device_ids]
+        self.assertEqual([row['payload'] for row in rows], expected)
+        for field in ('value', 'humidity'):
+            self._assert_rollups_match(field)
+
+    def test_03_switch_compression_off(self):
+        """With compression set back to none every payload is re-encoded as JSON text"""
+        before = self._reads()
+        database.PAYLOAD_COMPRESSION = 'none'
+        self.assertTrue(database.sync_payload_codec())
+        self.assertFalse(database.sync_payload_codec())
+        self.assertEqual(database.get_compression_lag(), 2 * self.rows_per_device * len(self.device_ids))
+        while database.recompress_payloads(max_ids=25):
+            pass
+
+        payloads, latest = self._stored_payloads()
+        self.assertTrue(all(isinstance(payload, str) for payload in payloads + latest))
+        self.assertEqual(self._reads(), before)
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
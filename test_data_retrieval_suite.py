@@ -120,6 +120,41 @@ class IoTDataRetrievalTest(unittest.TestCase):
                 self.assertEqual(len(data), 0)  # Invalid requests should return empty data
                 logger.info(f"✓ {case['name']} test passed - received empty data array")
 
+    def test_06_paginate_telemetry_data(self):
+        """Test cursor pagination and time-range filters"""
+        seen_ids = set()
+        previous = None
+        params = {"limit": 5}
+        for page in range(3):
+            response = self.session.get(f"{self.API_BASE_URL}/data", params=params)
+            self.assertEqual(response.status_code, 200)
+            body = response.json()
+            data = body.get('data', [])
+            self.assertLessEqual(len(data), 5)
+
+            for item in data:
+                key = (item['timestamp_ms'], item['id'])
+                if previous is not None:
+                    self.assertLess(key, previous)  # Newest first, never repeated
+                previous = key
+                self.assertNotIn(item['id'], seen_ids)
+                seen_ids.add(item['id'])
+
+            logger.info(f"Page {page + 1}: {len(data)} records")
+            if not body.get('next_cursor'):
+                break
+            params = {"limit": 5, "cursor": body['next_cursor']}
+
+        response = self.session.get(
+            f"{self.API_BASE_URL}/data",
+            params={"since": "2000-01-01T00:00:00Z", "until": "2000-01-02T00:00:00Z"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json().get('data', [])), 0)
+
+        response = self.session.get(f"{self.API_BASE_URL}/data", params={"cursor": "invalid"})
+        self.assertEqual(response.status_code, 400)
+
     def _display_telemetry_data(self, data):
         """Helper method to display telemetry data in a table format"""
         table_data = []
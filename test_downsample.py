@@ -0,0 +1,147 @@
+import math
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import database
+import downsample
+
+def _series(n):
+    """A fixed series: one point a second, a slow wave with a spike every 97 points."""
+    points = []
+    for i in range(n):
+        # Integer values keep the bucket averages exact in both implementations
+        y = round(100 * math.sin(i / 50)) + (i % 7)
+        if i % 97 == 13:
+            y += 500
+        points.append((1700000000000 + i * 1000, y))
+    return points
+
+class LttbPythonTest(unittest.TestCase):
+    """Downsample with the pure-Python implementation (NumPy hidden)."""
+
+    def setUp(self):
+        patcher = mock.patch.object(downsample, 'np', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_01_length_and_endpoints(self):
+        """The output has exactly threshold points, starting and ending with the input's"""
+        points = _series(1000)
+        for threshold in (3, 4, 10, 250, 999):
+            kept = downsample.lttb(points, threshold)
+            self.assertEqual(len(kept), threshold, threshold)
+            self.assertEqual(kept[0], points[0])
+            self.assertEqual(kept[-1], points[-1])
+
+    def test_02_points_kept_in_order(self):
+        """Only input points are kept, in their original order"""
+        points = _series(1000)
+        kept = downsample.lttb(points, 100)
+        self.assertTrue(set(kept) <= set(points))
+        self.assertEqual(kept, sorted(kept))
+
+    def test_03_spikes_survive(self):
+        """Every spike is kept when there are more buckets than spikes"""
+        points = _series(1000)
+        spikes = [point for i, point in enumerate(points) if i % 97 == 13]
+        kept = downsample.lttb(points, 100)
+        for spike in spikes:
+            self.assertIn(spike, kept)
+
+    def test_04_short_input_unchanged(self):
+        """Series already short enough, or thresholds below 3, are returned as given"""
+        points = _series(10)
+        self.assertEqual(downsample.lttb(points, 10), points)
+        self.assertEqual(downsample.lttb(points, 50), points)
+        self.assertEqual(downsample.lttb(points, 2), points)
+        self.assertEqual(downsample.lttb([], 5), [])
+
+    def test_05_streamed_points(self):
+        """Points read from an iterator with a count give the same series as a list"""
+        points = _series(1000)
+        for threshold in (3, 10, 250, 999, 1000):
+            self.assertEqual(downsample.lttb(iter(points), threshold, len(points)),
+                             downsample.lttb(points, threshold), threshold)
+
+    def test_06_wrong_count(self):
+        """A count off in either direction still gives at most threshold points, ending with the last one"""
+        points = _series(1000)
+        for count in (0, 10, 500, 999, 1001, 1500, 10000):
+            kept = downsample.lttb(iter(points), 50, count)
+            self.assertLessEqual(len(kept), 50, count)
+            self.assertEqual(kept[0], points[0])
+            self.assertEqual(kept[-1], points[-1])
+            self.assertEqual(kept, sorted(set(kept)))
+
+@unittest.skipIf(downsample.np is None, "numpy is not installed")
+class LttbNumpyTest(unittest.TestCase):
+    """The NumPy implementation keeps the same points as the pure-Python one."""
+
+    def test_01_same_points(self):
+        """NumPy and pure Python keep the same points for every threshold"""
+        for n in (5, 101, 1000, 4099):
+            points = _series(n)
+            for threshold in (3, 4, 17, 100, n - 1):
+                if threshold >= n:
+                    continue
+                kept = downsample.lttb(points, threshold)
+                with mock.patch.object(downsample, 'np', None):
+                    self.assertEqual(kept, downsample.lttb(points, threshold), (n, threshold))
+
+    def test_02_dispatch(self):
+        """lttb computes the triangle areas with NumPy when it is installed"""
+        points = _series(1000)
+        with mock.patch.object(downsample, '_select_python') as python:
+            downsample.lttb(points, 50)
+        python.assert_not_called()
+
+class ChartSeriesTest(unittest.TestCase):
+    """Downsample a field streamed from the database."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp(prefix='iot_test_')
+        cls.previous_path = database.DATABASE_PATH
+        database.close_all_db_connections()
+        database.DATABASE_PATH = os.path.join(cls.directory, 'chart.db')
+        database.init_db()
+
+        client_id, _ = database.create_client('client')
+        cls.topic_id = database.create_topic('sensors', None, client_id)
+        cls.device_id = database.create_device('sensor-1', None, client_id)
+        cls.points = _series(3000)
+        rows = [(cls.device_id, cls.topic_id, f'{{"value": {y}}}', x) for x, y in cls.points]
+        # Rows without the field are not counted
+        rows += [(cls.device_id, cls.topic_id, '{"status": "ok"}', x + 1) for x, _ in cls.points[::10]]
+        database.store_telemetry_batch(rows)
+        cls.since, cls.until = cls.points[0][0], cls.points[-1][0] + 1
+
+    @classmethod
+    def tearDownClass(cls):
+        database.close_all_db_connections()
+        database.DATABASE_PATH = cls.previous_path
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    def test_01_series_from_stream(self):
+        """The series is LTTB of every value in the window, and total their count"""
+        chart = downsample.chart_series('value', 200, topic_id=self.topic_id, since=self.since, until=self.until)
+        self.assertEqual(chart['total'], len(self.points))
+        self.assertEqual([(point['timestamp_ms'], point['value']) for point in chart['series']],
+                         downsample.lttb(self.points, 200))
+
+    def test_02_short_window(self):
+        """A window holding fewer values than points returns all of them"""
+        until = self.points[99][0] + 1
+        chart = downsample.chart_series('value', 500, device_id=self.device_id, since=self.since, until=until)
+        self.assertEqual(chart['total'], 100)
+        self.assertEqual([(point['timestamp_ms'], point['value']) for point in chart['series']], self.points[:100])
+
+    def test_03_invalid_field(self):
+        """An unusable field name raises ValueError"""
+        with self.assertRaises(ValueError):
+            downsample.chart_series('a"b', 100, since=self.since, until=self.until)
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,169 @@
+import calendar
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+import database
+from migrations import telemetry_partition_bounds, telemetry_partition_name
+
+# schema.sql as it was before the migration runner (schema version 0)
+BASELINE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS clients (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    api_key TEXT NOT NULL UNIQUE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS topics (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    description TEXT,
+    client_id INTEGER,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (client_id) REFERENCES clients (id) ON DELETE CASCADE,
+    UNIQUE(name, client_id)
+);
+
+CREATE TABLE IF NOT EXISTS devices (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    description TEXT,
+    client_id INTEGER NOT NULL,
+    last_seen TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (client_id) REFERENCES clients (id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS telemetry_data (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    device_id INTEGER NOT NULL,
+    topic_id INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (device_id) REFERENCES devices (id) ON DELETE CASCADE,
+    FOREIGN KEY (topic_id) REFERENCES topics (id) ON DELETE CASCADE
+);
+'''
+
+# (device_id, topic_id, payload, timestamp) rows as the baseline stored them,
+# spanning two monthly partitions
+BASELINE_TELEMETRY = [
+    (1, 1, '{"value": 21.5, "unit": "C"}', '2024-01-31 23:59:58'),
+    (1, 1, '{"value": 22, "unit": "C"}', '2024-01-31 23:59:59'),
+    (2, 1, '{"value": 19.25}', '2024-01-15 08:00:00'),
+    (1, 2, '{"humidity": 40, "nested": {"a": [1, 2]}}', '2024-02-01 00:00:00'),
+    (2, 2, '17', '2024-02-10 12:30:00'),
+    (2, 1, 'not json', '2024-02-11 12:30:00'),
+    (1, 1, '{"value": 23, "unit": "C"}', '2024-02-29 23:59:59'),
+]
+
+class BaselineUpgradeTest(unittest.TestCase):
+    """Upgrade a database created with the baseline schema.sql through every migration."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp(prefix='iot_test_')
+        cls.previous_path = database.DATABASE_PATH
+        database.close_all_db_connections()
+        database.DATABASE_PATH = os.path.join(cls.directory, 'baseline.db')
+
+        conn = sqlite3.connect(database.DATABASE_PATH)
+        conn.executescript(BASELINE_SCHEMA)
+        conn.execute("INSERT INTO clients (name, api_key) VALUES ('client', 'key-1')")
+        conn.executemany("INSERT INTO topics (name, client_id) VALUES (?, 1)", [('temperature',), ('climate',)])
+        conn.executemany("INSERT INTO devices (name, client_id, last_seen) VALUES (?, 1, ?)",
+                         [('sensor-1', '2024-02-29 23:59:59'), ('sensor-2', '2024-02-11 12:30:00')])
+        conn.executemany('INSERT INTO telemetry_data (device_id, topic_id, payload, timestamp) VALUES (?, ?, ?, ?)',
+                         BASELINE_TELEMETRY)
+        # A deleted row leaves a gap in the IDs that must never be reused
+        conn.execute("INSERT INTO telemetry_data (device_id, topic_id, payload) VALUES (1, 1, '{}')")
+        conn.execute('DELETE FROM telemetry_data WHERE id = ?', (len(BASELINE_TELEMETRY) + 1,))
+        conn.commit()
+        conn.close()
+
+        database.init_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        database.close_all_db_connections()
+        database.DATABASE_PATH = cls.previous_path
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    def setUp(self):
+        self.conn = sqlite3.connect(database.DATABASE_PATH)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def _telemetry(self):
+        rows = []
+        for (table,) in self.conn.execute('SELECT name FROM telemetry_partitions ORDER BY start_ms'):
+            rows.extend(self.conn.execute(
+                f'SELECT id, device_id, topic_id, payload, timestamp FROM {table}'
+            ).fetchall())
+        return sorted(rows)
+
+    def test_01_schema_version(self):
+        """Every migration is applied"""
+        self.assertEqual(self.conn.execute('PRAGMA user_version').fetchone()[0], 14)
+
+    def test_02_rows_preserved(self):
+        """Row IDs, payloads and timestamps survive the upgrade"""
+        expected = []
+        for row_id, (device_id, topic_id, payload, timestamp) in enumerate(BASELINE_TELEMETRY, 1):
+            ms = calendar.timegm(time.strptime(timestamp, '%Y-%m-%d %H:%M:%S')) * 1000
+            # Payloads that are not JSON are stored as JSON strings
+            payload = payload if payload != 'not json' else '"not json"'
+            expected.append((row_id, device_id, topic_id, payload, ms))
+        self.assertEqual(self._telemetry(), expected)
+
+        # The migration moves existing rows into monthly partitions
+        for row_id, _, _, _, ms in expected:
+            table = telemetry_partition_name(telemetry_partition_bounds(ms)[0])
+            self.assertEqual(self.conn.execute(f'SELECT COUNT(*) FROM {table} WHERE id = ?', (row_id,)).fetchone()[0], 1)
+        self.assertEqual(self.conn.execute("SELECT name FROM sqlite_master WHERE name = 'telemetry_data'").fetchall(), [])
+
+    def test_03_stats_backfilled(self):
+        """Entity and telemetry counts are backfilled, and IDs continue after the deleted row"""
+        stats = {(scope, scope_id): row_count for scope, scope_id, row_count in
+                 self.conn.execute('SELECT scope, scope_id, row_count FROM stats')}
+        self.assertEqual(stats[('telemetry', 0)], len(BASELINE_TELEMETRY))
+        self.assertEqual(stats[('clients', 0)], 1)
+        self.assertEqual(stats[('devices', 0)], 2)
+        self.assertEqual(stats[('topics', 0)], 2)
+        for scope, column in (('device', 1), ('topic', 2)):
+            for scope_id in (1, 2):
+                count = sum(1 for row in BASELINE_TELEMETRY if row[column - 1] == scope_id)
+                self.assertEqual(stats[(scope, scope_id)], count, (scope, scope_id))
+        self.assertEqual(stats[('telemetry_id', 0)], len(BASELINE_TELEMETRY) + 1)
+
+        self.assertTrue(database.store_telemetry_data(1, 1, {'value': 1}))
+        self.assertEqual(database.get_max_telemetry_id(), len(BASELINE_TELEMETRY) + 2)
+        database.close_all_db_connections()
+
+    def test_04_device_latest_backfilled(self):
+        """device_latest holds the newest row of every device/topic pair"""
+        expected = {}
+        for row_id, device_id, topic_id, payload, ms in self._telemetry():
+            if row_id > len(BASELINE_TELEMETRY):
+                continue
+            current = expected.get((device_id, topic_id))
+            if current is None or (ms, row_id) > (current[2], current[0]):
+                expected[(device_id, topic_id)] = (row_id, payload, ms)
+        latest = {(device_id, topic_id): (row_id, payload, ms) for device_id, topic_id, row_id, payload, ms in
+                  self.conn.execute('SELECT device_id, topic_id, telemetry_id, payload, timestamp FROM device_latest')}
+        # test_03 adds a newer row for (1, 1)
+        latest.pop((1, 1), None)
+        expected.pop((1, 1), None)
+        self.assertEqual(latest, expected)
+
+    def test_05_integrity(self):
+        """The upgraded database passes SQLite's integrity and foreign key checks"""
+        self.assertEqual(self.conn.execute('PRAGMA integrity_check').fetchall(), [('ok',)])
+        self.assertEqual(self.conn.execute('PRAGMA foreign_key_check').fetchall(), [])
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,184 @@
+import calendar
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import database
+from migrations import telemetry_partition_bounds, telemetry_partition_name
+
+def _ms(timestamp):
+    """Epoch milliseconds of a UTC 'YYYY-mm-dd HH:MM:SS' timestamp."""
+    return calendar.timegm(time.strptime(timestamp, '%Y-%m-%d %H:%M:%S')) * 1000
+
+def _values(rows):
+    """The value field of each row's JSON payload."""
+    return [json.loads(row['payload'])['value'] for row in rows]
+
+# Rows in two partitions (whatever TELEMETRY_PARTITION_PERIOD is), written in
+# ID order; sensor-2 only has rows in the older one
+OLD_ROWS = [
+    ('sensor-1', 1.0, '2024-01-15 10:00:00'),
+    ('sensor-2', 2.0, '2024-01-15 10:00:01'),
+    ('sensor-1', 3.0, '2024-01-15 10:00:02'),
+    ('sensor-2', 4.0, '2024-01-15 10:00:02'),
+    ('sensor-1', 5.0, '2024-01-15 23:59:59'),
+]
+NEW_ROWS = [
+    ('sensor-1', 6.0, '2024-02-15 00:00:00'),
+    ('sensor-1', 7.0, '2024-02-15 00:00:00'),
+    ('sensor-1', 8.0, '2024-02-15 12:00:00'),
+    ('sensor-1', 9.0, '2024-02-15 12:00:01'),
+]
+
+class TelemetryPartitionTest(unittest.TestCase):
+    """Route reads across two telemetry partitions and drop the older one."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp(prefix='iot_test_')
+        cls.previous_path = database.DATABASE_PATH
+        database.close_all_db_connections()
+        database.DATABASE_PATH = os.path.join(cls.directory, 'partitions.db')
+        database.init_db()
+
+        client_id, _ = database.create_client('client')
+        cls.topic_id = database.create_topic('temperature', None, client_id)
+        cls.devices = {name: database.create_device(name, None, client_id) for name in ('sensor-1', 'sensor-2')}
+        database.store_telemetry_batch([
+            (cls.devices[device], cls.topic_id, f'{{"value": {value}}}', _ms(timestamp))
+            for device, value, timestamp in OLD_ROWS + NEW_ROWS
+        ])
+
+        period = database.TELEMETRY_PARTITION_PERIOD
+        cls.old_start, cls.old_end = telemetry_partition_bounds(_ms(OLD_ROWS[0][2]), period)
+        cls.new_start, _ = telemetry_partition_bounds(_ms(NEW_ROWS[0][2]), period)
+
+    @classmethod
+    def tearDownClass(cls):
+        database.close_all_db_connections()
+        database.DATABASE_PATH = cls.previous_path
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    def _pages(self, limit, **filters):
+        """Read every page of get_telemetry_page, following the cursors."""
+        rows, cursor = database.get_telemetry_page(limit=limit, **filters)
+        pages = [rows]
+        while cursor is not None:
+            rows, cursor = database.get_telemetry_page(limit=limit, cursor=database.decode_cursor(cursor), **filters)
+            pages.append(rows)
+        return pages
+
+    def test_01_rows_routed_to_partitions(self):
+        """Each row is written to the partition covering its timestamp"""
+        conn = database.get_db_connection()
+        names = [name for name, _, _ in database._telemetry_partitions(conn)]
+        old_table = telemetry_partition_name(self.old_start)
+        new_table = telemetry_partition_name(self.new_start)
+        self.assertEqual(names, [old_table, new_table])
+        self.assertEqual(conn.execute(f'SELECT COUNT(*) FROM {old_table}').fetchone()[0], len(OLD_ROWS))
+        self.assertEqual(conn.execute(f'SELECT COUNT(*) FROM {new_table}').fetchone()[0], len(NEW_ROWS))
+        conn.close()
+
+    def test_02_cursor_paging_across_partitions(self):
+        """Cursor pages run newest first across the partition boundary without gaps or repeats"""
+        expected = [value for _, value, _ in reversed(OLD_ROWS + NEW_ROWS)]
+        for limit in (1, 2, 3, 4, 100):
+            pages = self._pages(limit)
+            values = _values(row for page in pages for row in page)
+            self.assertEqual(values, expected, limit)
+            self.assertTrue(all(len(page) == limit for page in pages[:-1]), limit)
+
+        # A time window ending inside the newer partition
+        pages = self._pages(2, since=_ms(OLD_ROWS[2][2]), until=_ms(NEW_ROWS[2][2]))
+        values = _values(row for page in pages for row in page)
+        self.assertEqual(values, [7.0, 6.0, 5.0, 4.0, 3.0])
+
+        pages = self._pages(2, device_id=self.devices['sensor-2'])
+        self.assertEqual(_values(row for page in pages for row in page), [4.0, 2.0])
+
+    def test_03_since_id_across_partitions(self):
+        """get_telemetry_since returns the rows after since_id in ID order, from both partitions"""
+        rows, last_id = database.get_telemetry_since(0, limit=100)
+        ids = [row['id'] for row in rows]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(_values(rows), [value for _, value, _ in OLD_ROWS + NEW_ROWS])
+        self.assertEqual(last_id, ids[-1])
+
+        since_id = ids[3]
+        rows, last_id = database.get_telemetry_since(since_id, limit=3)
+        self.assertEqual([row['id'] for row in rows], ids[4:7])
+        rows, last_id = database.get_telemetry_since(last_id, limit=3)
+        self.assertEqual([row['id'] for row in rows], ids[7:])
+
+        # Nothing newer: the high-water mark stays put
+        self.assertEqual(database.get_telemetry_since(ids[-1]), ([], ids[-1]))
+
+    def test_04_drop_partition(self):
+        """Dropping the older partition removes its rows from every read and count"""
+        # A cutoff inside the newer partition only drops partitions that end before it
+        result = database.drop_telemetry_partitions(_ms(NEW_ROWS[-1][2]))
+        self.assertEqual(result, {'partitions': [telemetry_partition_name(self.old_start)], 'rows': len(OLD_ROWS)})
+        self.assertEqual(database.drop_telemetry_partitions(self.old_end), {'partitions': [], 'rows': 0})
+
+        self.assertEqual(database.get_telemetry_data_count(), len(NEW_ROWS))
+        self.assertEqual(database.get_dashboard_stats()['data_count'], len(NEW_ROWS))
+        self.assertEqual(database.get_telemetry_stats('device', self.devices['sensor-1'])['row_count'], len(NEW_ROWS))
+        self.assertEqual(database.get_telemetry_stats('device', self.devices['sensor-2'])['row_count'], 0)
+        self.assertEqual(database.get_telemetry_stats('topic', self.topic_id)['row_count'], len(NEW_ROWS))
+
+        values = _values(row for page in self._pages(3) for row in page)
+        self.assertEqual(values, [9.0, 8.0, 7.0, 6.0])
+        rows, _ = database.get_telemetry_since(0)
+        self.assertEqual(_values(rows), [6.0, 7.0, 8.0, 9.0])
+
+        # sensor-2 had no rows left, so its latest value is gone too
+        latest = database.get_latest_by_device(device_id=self.devices['sensor-2'])
+        self.assertEqual(latest, [])
+
+class LateRowTest(unittest.TestCase):
+    """A row written into the older partition after rows in the newer one."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp(prefix='iot_test_')
+        cls.previous_path = database.DATABASE_PATH
+        database.close_all_db_connections()
+        database.DATABASE_PATH = os.path.join(cls.directory, 'late.db')
+        database.init_db()
+
+        client_id, _ = database.create_client('client')
+        cls.topic_id = database.create_topic('temperature', None, client_id)
+        cls.device_id = database.create_device('sensor-1', None, client_id)
+
+    @classmethod
+    def tearDownClass(cls):
+        database.close_all_db_connections()
+        database.DATABASE_PATH = cls.previous_path
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    def _store(self, value, timestamp):
+        database.store_telemetry_batch([(self.device_id, self.topic_id, f'{{"value": {value}}}', _ms(timestamp))])
+        return database.get_max_telemetry_id()
+
+    def test_01_since_id_sees_late_row(self):
+        """A poller past the newer partition's rows still gets a higher-ID row in the older one"""
+        self._store(1.0, '2024-01-31 23:59:58')
+        # An HTTP publish received after midnight is written first...
+        http_id = self._store(2.0, '2024-02-01 00:00:00')
+        rows, last_id = database.get_telemetry_since(0)
+        self.assertEqual(_values(rows), [1.0, 2.0])
+        self.assertEqual(last_id, http_id)
+
+        # ...then a queued MQTT row received just before it
+        late_id = self._store(3.0, '2024-01-31 23:59:59')
+        self.assertGreater(late_id, http_id)
+        rows, last_id = database.get_telemetry_since(http_id)
+        self.assertEqual([row['id'] for row in rows], [late_id])
+        self.assertEqual(_values(rows), [3.0])
+        self.assertEqual(last_id, late_id)
+        self.assertEqual(database.get_telemetry_since(last_id), ([], late_id))
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)